@@ -0,0 +1,72 @@
+""" Template compilation benchmark on embedded storage.
+
+Usage: python -m benchmarks.bench_compile [screens counts...]
+For every template size prints time of compilation of loaded template, of full compilation
+with loading, of linking of stored screens segments and of compilation served from compiled program cache.
+Time per screen must stay flat """
+import sys
+import time
+
+from telegram_bot_constructor import set_redis_connection
+from telegram_bot_constructor.constructor import BotTemplate, Screen, SendMessage, GetInput, ForwardToScreen, \
+    load_screens_components
+from telegram_bot_constructor.storage import MemoryStorage
+
+SIZES = (10, 100, 1000, 10000)
+
+
+def build_template(screens_count):
+    """ Return template with screens of three components, last one forwards to next screen """
+    template = BotTemplate.create('Benchmark')
+    screens = (template.start_screen,) + tuple(Screen.create_many(('Screen %d' % i,)
+                                                                   for i in range(1, screens_count)))
+    for screen in screens[1:]:
+        template.add_screen(screen)
+    messages = SendMessage.create_many(('Message %d' % i,) for i in range(screens_count))
+    inputs = GetInput.create_many(('variable',) for _ in range(screens_count))
+    forwards = ForwardToScreen.create_many(('variable', screens[(i + 1) % screens_count], 'yes')
+                                           for i in range(screens_count))
+    for screen, components in zip(screens, zip(messages, inputs, forwards)):
+        for component in components:
+            screen.add_component(component)
+    return template
+
+
+def measure(function, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(sizes):
+    print('%8s %14s %14s %14s %14s %16s' % ('screens', 'compile, ms', 'load+compile', 'relink, ms', 'cached, ms',
+                                            'us per screen'))
+    for size in sizes:
+        set_redis_connection(MemoryStorage())
+        template = build_template(size)
+        screens = template.screens
+        components = load_screens_components(screens)
+        compile_time = measure(lambda: BotTemplate.compile_screens(screens, components))
+
+        def full_compile():
+            template.redis.delete(template.collection_key('compiled'), template.collection_key('segments'))
+            template.compile()
+
+        def relink():
+            template.redis.delete(template.collection_key('compiled'))
+            template.compile()
+
+        full_time = measure(full_compile)
+        relink_time = measure(relink)
+        cached_time = measure(template.compile)
+        print('%8d %14.2f %14.2f %14.2f %14.2f %16.2f' % (size, compile_time * 1000, full_time * 1000,
+                                                         relink_time * 1000, cached_time * 1000,
+                                                         full_time * 1e6 / size))
+
+
+if __name__ == '__main__':
+    main([int(s) for s in sys.argv[1:]] or SIZES)
@@ -1,4 +1,5 @@
 redis_connection = None
+async_redis_connection = None
 
 
 def get_redis_connection():
@@ -7,5 +8,17 @@ def get_redis_connection():
 
 
 def set_redis_connection(connection):
+    """ Set storage backend: redis.Redis or storage.MemoryStorage """
     global redis_connection
     redis_connection = connection
+
+
+def get_async_redis_connection():
+    global async_redis_connection
+    return async_redis_connection
+
+
+def set_async_redis_connection(connection):
+    """ Set shared asyncio connection pool (aioredis) for async API """
+    global async_redis_connection
+    async_redis_connection = connection
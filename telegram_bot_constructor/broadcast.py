@@ -0,0 +1,160 @@
+""" Mailing of message to all chats of bot context: recipients are streamed from chats sorted set by cursor,
+messages are sent by pool of threads through token bucket rate limiter, progress is saved after every batch,
+so interrupted broadcast continues from the last saved cursor """
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+from .helpers import StoredObject
+
+BROADCAST_RUNNING = 'running'  # Broadcast is not finished, it continues when its bot context runs
+BROADCAST_CANCELLED = 'cancelled'
+BROADCAST_FINISHED = 'finished'
+
+DEFAULT_RATE = 25  # Messages per second, telegram allows about 30
+DEFAULT_CONCURRENCY = 4
+DEFAULT_BATCH_SIZE = 100
+MAX_RETRIES = 3  # Retries of message sending after flood control errors
+MAX_STORED_FAILURES = 1000  # Failures of broadcast stored with reasons, the rest are only counted
+
+logger = getLogger('Broadcast')
+
+
+class TokenBucket:
+    """ Thread safe rate limiter: rate tokens per second, at most capacity tokens are accumulated """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(self.rate, 1))
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Take one token, wait until it is available. Tokens are reserved in order of calls,
+        so concurrent callers wait for their own tokens without polling """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            self.sleep(wait)
+
+    def delay(self, seconds):
+        """ Hold all callers for seconds, used when server asks to retry later """
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class Broadcast(StoredObject):
+    MNEMONIC = 'broadcast'
+    PREFIX = 'broadcasts'
+    COLLECTIONS = ('failures',)  # Chat id to failure reason hash
+
+    def init(self, bot_context_id, text, rate=DEFAULT_RATE, concurrency=DEFAULT_CONCURRENCY):
+        self.set_field('bot_context', bot_context_id)
+        self.set_field('text', text)
+        self.set_field('rate', rate)
+        self.set_field('concurrency', concurrency)
+        self.set_field('status', BROADCAST_RUNNING)
+        self.set_field('cursor', 0)
+        self.set_field('started', time.time())
+        self.redis.rpush('bot_contexts:%d:broadcasts' % bot_context_id, self.id)
+
+    @property
+    def chats_key(self):
+        return 'bot_contexts:%d:chats' % int(self.get_field('bot_context'))
+
+    @property
+    def text(self):
+        return self.get_field('text').decode()
+
+    @property
+    def status(self):
+        return self.get_field('status').decode()
+
+    def cancel(self):
+        """ Stop broadcast forever, running broadcast stops after current batch """
+        self.set_field('status', BROADCAST_CANCELLED)
+
+    @property
+    def failures(self):
+        """ Return chat id to failure reason dict of at most MAX_STORED_FAILURES failures """
+        failures = self.redis.hgetall(self.collection_key('failures'))
+        return {int(c): r.decode() for c, r in failures.items()}
+
+    @property
+    def statistics(self):
+        """ Return current progress: counts of sent and failed messages, total count of chats,
+        sending time and throughput in messages per second """
+        fields = {k.decode(): v for k, v in self.redis.hgetall(self.key).items()}
+        sent, failed = int(fields.get('sent', 0)), int(fields.get('failed', 0))
+        duration = float(fields.get('duration', 0))
+        return {'status': fields['status'].decode(),
+                'sent': sent,
+                'failed': failed,
+                'total': self.redis.zcard(self.chats_key),
+                'duration': duration,
+                'throughput': (sent + failed) / duration if duration != 0 else 0.0}
+
+    def run(self, send, batch_size=DEFAULT_BATCH_SIZE, stop=None, clock=time.monotonic, sleep=time.sleep):
+        """ Send text to chats with send(chat_id, text) from the last saved cursor.
+        Return when all chats are scanned, broadcast is cancelled or stop event is set.
+        Chats scanned in interrupted batch may receive message twice, others receive it once """
+        fields = {k.decode(): v for k, v in self.redis.hgetall(self.key).items()}
+        if fields['status'].decode() != BROADCAST_RUNNING:
+            return
+        text, cursor = fields['text'].decode(), int(fields['cursor'])
+        bucket = TokenBucket(float(fields['rate']), clock=clock, sleep=sleep)
+        stored_failures = int(fields.get('failed', 0))
+        with ThreadPoolExecutor(int(fields['concurrency'])) as executor:
+            while True:
+                started = clock()
+                cursor, chats = self.redis.zscan(self.chats_key, cursor, count=batch_size)
+                results = list(executor.map(lambda chat: _send(send, bucket, chat, text),
+                                            (int(c) for c, _ in chats)))
+                stored_failures = self._save_batch(cursor, results, clock() - started, stored_failures)
+                if cursor == 0:
+                    self.set_field('status', BROADCAST_FINISHED)
+                    statistics = self.statistics
+                    logger.info('Broadcast %d finished: %d sent, %d failed, %.1f messages per second' %
+                                (self.id, statistics['sent'], statistics['failed'], statistics['throughput']))
+                    return
+                if stop is not None and stop.is_set():
+                    return
+                if self.redis.hget(self.key, 'status') != BROADCAST_RUNNING.encode():
+                    return  # Cancelled
+
+    def _save_batch(self, cursor, results, duration, stored_failures):
+        """ Save cursor and counters of sent batch in one transaction, return count of stored failures """
+        failures = tuple((chat, reason) for chat, reason in results if reason is not None)
+        pipeline = self.redis.pipeline(transaction=True)
+        pipeline.hset(self.key, 'cursor', cursor)
+        pipeline.hincrby(self.key, 'sent', len(results) - len(failures))
+        pipeline.hincrby(self.key, 'failed', len(failures))
+        pipeline.hincrbyfloat(self.key, 'duration', duration)
+        for chat, reason in failures[:max(MAX_STORED_FAILURES - stored_failures, 0)]:
+            pipeline.hset(self.collection_key('failures'), chat, reason)
+        pipeline.execute()
+        if len(failures) != 0:
+            logger.warning('Broadcast %d: %d of %d messages failed' % (self.id, len(failures), len(results)))
+        return stored_failures + len(failures)
+
+
+def _send(send, bucket, chat, text):
+    """ Return (chat, None) if message is sent, (chat, failure reason) otherwise """
+    for attempt in range(MAX_RETRIES + 1):
+        bucket.acquire()
+        try:
+            send(chat, text)
+            return chat, None
+        except Exception as e:
+            retry_after = getattr(e, 'retry_after', None)  # Flood control error of telegram
+            if retry_after is None or attempt == MAX_RETRIES:
+                return chat, '%s: %s' % (type(e).__name__, e)
+            bucket.delay(float(retry_after))
@@ -0,0 +1,119 @@
+""" Process local read-through cache of stored objects fields """
+import json
+import threading
+from collections import OrderedDict
+
+from . import get_redis_connection
+
+INVALIDATION_CHANNEL = 'stored_objects_invalidation'
+
+_cache = None
+
+
+class ObjectsCache:
+    """ Bounded LRU cache with (mnemonic, id, field) keys, field None holds all fields of object """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.objects = {}  # (mnemonic, id) to cached keys map
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # Incremented on invalidation, protects from caching of stale reads
+        self.listener = None
+
+    def get(self, key):
+        """ Return (found, value) pair """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, self.entries[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, generation=None):
+        """ Store value read when cache had given generation """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self.objects.setdefault(key[:2], set()).add(key)
+            while len(self.entries) > self.maxsize:
+                old_key, _ = self.entries.popitem(last=False)
+                self._forget(old_key)
+
+    def invalidate(self, mnemonic, id_, field=None):
+        """ Drop field and whole object entries, all object entries if field is None """
+        with self.lock:
+            self.generation += 1
+            keys = tuple(self.objects.get((mnemonic, id_), ())) if field is None \
+                else ((mnemonic, id_, field), (mnemonic, id_, None))
+            for key in keys:
+                self.entries.pop(key, None)
+                self._forget(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.objects.clear()
+
+    def _forget(self, key):
+        keys = self.objects.get(key[:2])
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.objects[key[:2]]
+
+    def listen(self, redis_):
+        """ Start thread dropping entries invalidated by other processes """
+        pubsub = redis_.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: self._handle_invalidation})
+        self.listener = threading.Thread(target=self._listen, args=(pubsub,), daemon=True)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None:
+            listener = self.listener
+            self.listener = None
+            listener.join()
+
+    def _listen(self, pubsub):
+        try:
+            while self.listener is not None:
+                pubsub.get_message(timeout=0.1)
+        finally:
+            pubsub.close()
+
+    def _handle_invalidation(self, message):
+        mnemonic, id_, field = json.loads(message['data'].decode())
+        self.invalidate(mnemonic, id_, field)
+
+
+def enable_cache(maxsize=10000, redis_=None):
+    """ Enable cache for objects with CACHED flag and subscribe to invalidations """
+    global _cache
+    disable_cache()
+    _cache = ObjectsCache(maxsize)
+    _cache.listen(redis_ if redis_ is not None else get_redis_connection())
+    return _cache
+
+
+def disable_cache():
+    global _cache
+    if _cache is not None:
+        _cache.stop()
+        _cache = None
+
+
+def get_cache():
+    return _cache
+
+
+def invalidate(redis_, mnemonic, id_, field=None):
+    """ Drop cached object fields in this and other processes """
+    if _cache is not None:
+        _cache.invalidate(mnemonic, id_, field)
+    redis_.publish(INVALIDATION_CHANNEL, json.dumps((mnemonic, id_, field)))
@@ -0,0 +1,181 @@
+""" Persistent execution state of chats of running bots.
+
+State of chat is kept in 'bot_contexts:<id>:states:<chat>' string expiring after STATE_TTL seconds of chat
+inactivity, it is compact JSON [screen id, component id, variables, conversation id, operator id].
+Position is stored as its source component, so state survives template changes (see constructor.source_locator).
+Changed states are written with one pipeline every FLUSH_INTERVAL seconds, chats executing actions are counted
+as unique users of bot by statistics.visits_collector. State of chat is loaded when VM
+creates context of chat the first time after restart, contexts idle for IDLE_TIMEOUT seconds are evicted
+from process and loaded again on the next message """
+import json
+import threading
+import time
+from logging import getLogger
+
+from . import get_redis_connection
+from .constructor import source_locator
+from .statistics import visits_collector
+
+STATE_TTL = 7 * 86400
+FLUSH_INTERVAL = 1
+IDLE_TIMEOUT = 3600
+
+logger = getLogger('Chat states')
+
+
+class _Contexts(dict):
+    """ VM contexts by chat id, state of chat is restored when VM adds its context """
+
+    def __init__(self, states):
+        super().__init__()
+        self.states = states
+
+    def __setitem__(self, chat, vm_context):
+        super().__setitem__(chat, vm_context)
+        self.states.attach(chat, vm_context)
+
+
+class ChatStates:
+    """ States of chats of running bot, VM contexts of bot must be replaced with contexts of states
+    and executed actions must be tracked by track() """
+
+    def __init__(self, context_id, sources, dispatcher=None, redis_=None, ttl=STATE_TTL,
+                 flush_interval=FLUSH_INTERVAL, idle_timeout=IDLE_TIMEOUT, clock=time.monotonic, collector=None):
+        self.context_id = context_id
+        self.sources = sources
+        self.locate = source_locator(sources)
+        self.dispatcher = dispatcher  # Restores operator conversations
+        self.redis = redis_ if redis_ is not None else get_redis_connection()
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.collector = collector if collector is not None else visits_collector
+        self.contexts = _Contexts(self)
+        self.chats = {}  # id() of VM context to chat map
+        self.dirty = {}  # Chat to VM context with unsaved state map
+        self.activity = {}  # Chat to time of the last executed action map
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.stopped = threading.Event()
+
+    def key(self, chat):
+        return 'bot_contexts:%d:states:%s' % (self.context_id, chat)
+
+    def set_sources(self, sources):
+        """ Use sources of reloaded program, must be called under lock with positions remapping """
+        self.sources = sources
+        self.locate = source_locator(sources)
+
+    def track(self, actions):
+        """ Mark context of chat changed after execution of every action, actions are returned """
+        for action in actions:
+            action.exec = self._tracked(action.exec)
+        return actions
+
+    def _tracked(self, exec_):
+        def tracked(vm_context):
+            try:
+                return exec_(vm_context)
+            finally:
+                chat = self.chats.get(id(vm_context))
+                if chat is not None:
+                    with self.lock:
+                        self.dirty[chat] = vm_context
+                        self.activity[chat] = self.clock()
+                    self.collector.add_user(self.context_id, chat)
+
+        return tracked
+
+    def attach(self, chat, vm_context):
+        """ Restore saved state of chat into new VM context """
+        with self.lock:
+            self.chats[id(vm_context)] = chat
+            self.activity[chat] = self.clock()
+        try:
+            data = self.redis.get(self.key(chat))
+            if data is not None:
+                self.decode(vm_context, data)
+        except Exception:
+            logger.exception('State of chat %s of bot context %d is not restored' % (chat, self.context_id))
+
+    def chat_of(self, vm_context):
+        """ Return chat of VM context, None if context is not attached """
+        return self.chats.get(id(vm_context)) if vm_context is not None else None
+
+    def encode(self, vm_context):
+        position = vm_context.position
+        screen_id, component_id = self.sources[position] if 0 <= position < len(self.sources) else (None, None)
+        conversation = getattr(vm_context, 'conversation', None)
+        conversation = conversation if conversation is not None and not conversation.stopped else None
+        return json.dumps((screen_id, component_id, getattr(vm_context, 'variables', None),
+                           conversation.id if conversation is not None else None,
+                           conversation.operator.id if conversation is not None else None),
+                          separators=(',', ':'), ensure_ascii=False)
+
+    def decode(self, vm_context, data):
+        screen_id, component_id, variables, conversation_id, operator_id = json.loads(data.decode())
+        vm_context.position = self.locate(screen_id, component_id)
+        if variables is not None:
+            vm_context.variables = variables
+        if conversation_id is not None and self.dispatcher is not None:
+            conversation = self.dispatcher.restore_conversation(conversation_id, operator_id)
+            if conversation is not None:
+                conversation.vm_context = vm_context
+                vm_context.conversation = conversation
+
+    def flush(self):
+        """ Write changed states with one pipeline, evict idle contexts. Return count of written states.
+        State which can not be encoded is skipped, saved state of its chat is kept until the next change """
+        with self.lock:  # Program and positions are not changed by reload while states are encoded
+            dirty, self.dirty = self.dirty, {}
+            states = []
+            for chat, vm_context in dirty.items():
+                try:
+                    states.append((chat, self.encode(vm_context)))
+                except Exception:
+                    logger.exception('State of chat %s of bot context %d is not saved' % (chat, self.context_id))
+        if len(states) != 0:
+            pipeline = self.redis.pipeline(transaction=False)
+            for chat, state in states:
+                pipeline.set(self.key(chat), state, ex=self.ttl)
+            try:
+                pipeline.execute()
+            except Exception:
+                with self.lock:
+                    dirty.update(self.dirty)
+                    self.dirty = dirty  # States changed after failed flush are newer
+                raise
+        self._evict()
+        return len(states)
+
+    def _evict(self):
+        if self.idle_timeout is None:
+            return
+        deadline = self.clock() - self.idle_timeout
+        with self.lock:
+            idle = [c for c, t in self.activity.items() if t < deadline and c not in self.dirty]
+            for chat in idle:
+                del self.activity[chat]
+                vm_context = self.contexts.pop(chat, None)
+                if vm_context is not None:
+                    self.chats.pop(id(vm_context), None)
+
+    def start(self):
+        self.flusher = threading.Thread(target=self._flush_periodically,
+                                        name='Chat states of bot context %d' % self.context_id, daemon=True)
+        self.flusher.start()
+
+    def _flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Chat states of bot context %d are not saved' % self.context_id)
+
+    def stop(self):
+        """ Stop background flushing and save changed states """
+        self.stopped.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.flush()
@@ -0,0 +1,137 @@
+""" Regular expressions of forward conditions: validation and process wide interning of compiled patterns """
+import re
+import string
+from functools import lru_cache
+from logging import getLogger
+
+try:
+    from re import _parser as sre_parse
+    from re import _compiler as sre_compile
+    from re import _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_compile
+    import sre_constants
+
+MAX_CONDITION_LENGTH = 1000
+
+_REPEATS = tuple(getattr(sre_constants, name) for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+                 if hasattr(sre_constants, name))
+_CHARACTERS = (sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY, sre_constants.IN)
+_ZERO_WIDTH = (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT)
+_ALPHABET = frozenset(string.printable + '\u00a0\u2003\u00e9\u044f\u042f\u0663\u4e2d')  # Samples of classes
+_EMPTY = frozenset()
+
+logger = getLogger('Conditions')
+
+
+class InvalidCondition(Exception):
+    pass
+
+
+def _subpatterns(value):
+    """ Yield parsed subpatterns nested in node argument """
+    if isinstance(value, sre_parse.SubPattern):
+        yield value
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            yield from _subpatterns(item)
+
+
+def _characters(state, node):
+    """ Return sample characters matched by one character node """
+    pattern = sre_compile.compile(sre_parse.SubPattern(state, [node]))
+    return frozenset(c for c in _ALPHABET if pattern.fullmatch(c))
+
+
+def _scan(state, pattern):
+    """ Return (first characters, nullable, continuations) of pattern, continuations are characters
+    which pattern can consume after it could already end having consumed something """
+    first, nullable, continuations = _EMPTY, True, _EMPTY
+    for op, av in pattern:
+        node_first, node_nullable, node_continuations = _scan_node(state, op, av)
+        if node_nullable:
+            node_continuations |= continuations | (node_first if len(first) != 0 else _EMPTY)
+        first = first | node_first if nullable else first
+        nullable = nullable and node_nullable
+        continuations = node_continuations
+    return first, nullable, continuations
+
+
+def _scan_node(state, op, av):
+    if op in _CHARACTERS:
+        return _characters(state, (op, av)), False, _EMPTY
+    elif op in _REPEATS:
+        first, nullable, continuations = _scan(state, av[2])
+        if av[1] > max(av[0], 1):  # Next iteration may follow completed one
+            continuations |= first
+        return first, av[0] == 0 or nullable, continuations
+    elif op is sre_constants.SUBPATTERN:
+        return _scan(state, av[-1])
+    elif op is sre_constants.BRANCH:
+        scanned = [_scan(state, alternative) for alternative in av[1]]
+        return (frozenset().union(*(f for f, _, _ in scanned)), any(n for _, n, _ in scanned),
+                frozenset().union(*(c for _, _, c in scanned)))
+    elif op is sre_constants.GROUPREF_EXISTS:
+        return _scan_node(state, sre_constants.BRANCH, (None, [av[1], av[2] or []]))
+    elif op in _ZERO_WIDTH:
+        return _EMPTY, True, _EMPTY
+    elif op is getattr(sre_constants, 'ATOMIC_GROUP', None):
+        return _scan(state, av)
+    return _ALPHABET, True, _EMPTY  # Back references may match anything
+
+
+def _has_overlapping_alternatives(state, pattern):
+    """ Check for alternatives which can match the same text start, like (x|\\w+) or [\\w\\d],
+    single character alternatives are merged to set by parser """
+    for op, av in pattern:
+        if op is sre_constants.BRANCH:
+            alternatives = [_scan(state, alternative) for alternative in av[1]]
+        elif op is sre_constants.IN and not any(o is sre_constants.NEGATE for o, _ in av):
+            alternatives = [(_characters(state, (op, [item])), False) for item in av]
+        else:
+            alternatives = ()
+        for i, (first, nullable, *_) in enumerate(alternatives):
+            for other_first, other_nullable, *_ in alternatives[i + 1:]:
+                if len(first & other_first) != 0 or nullable and other_nullable:
+                    return True
+        if any(_has_overlapping_alternatives(state, p) for p in _subpatterns(av)):
+            return True
+    return False
+
+
+def _has_ambiguous_repeat(state, pattern):
+    """ Check for repeated subpattern which can match the same text in several ways, like (a|aa)* or (aa?)*,
+    such patterns backtrack exponentially on non matching input too """
+    for op, av in pattern:
+        if op in _REPEATS and av[1] > 1:
+            first, _, continuations = _scan(state, av[2])
+            if len(first & continuations) != 0 or _has_overlapping_alternatives(state, av[2]):
+                return True
+        if any(_has_ambiguous_repeat(state, p) for p in _subpatterns(av)):
+            return True
+    return False
+
+
+def validate_condition(condition):
+    """ Raise InvalidCondition if condition is not valid regular expression or may backtrack catastrophically """
+    if len(condition) > MAX_CONDITION_LENGTH:
+        raise InvalidCondition('Condition is longer than %d characters' % MAX_CONDITION_LENGTH)
+    try:
+        parsed = sre_parse.parse(condition)
+    except re.error as e:
+        raise InvalidCondition('Invalid regular expression %r: %s' % (condition, e))
+    if _has_ambiguous_repeat(parsed.state, parsed):
+        raise InvalidCondition('Regular expression %r has ambiguous repeat' % condition)
+
+
+@lru_cache(maxsize=4096)
+def compile_condition(condition):
+    """ Return compiled pattern for condition, patterns are shared by all bots of process.
+    Conditions are validated on write, conditions stored before validation are compiled with warning,
+    so their bots still start """
+    try:
+        validate_condition(condition)
+    except InvalidCondition as e:
+        logger.warning('%s, condition is used as is' % e)
+    return re.compile(condition)
@@ -1,24 +1,38 @@
-from .helpers import StoredObject, get_redis_connection
+import io
+import json
+from logging import getLogger
+
+from . import get_async_redis_connection, exchange
+from .conditions import compile_condition, validate_condition
+from .helpers import StoredObject, get_storage
+from .optimizer import optimize
+from .scripts import ORDERED_APPEND, ORDERED_MOVE
 from telegram_bot_vm.actions import *
 from .operators_server import OperatorDialogAction
 
+logger = getLogger('Constructor')
+
 
 class BaseComponent(StoredObject):
     MNEMONIC = 'component'
+    PREFIX = 'components'
+    CACHED = True
+    OWNERS = (('screen', 'screens'), ('bot_template', 'bot_templates'))
 
     @property
     def type(self):
-        return self.redis.get('components:%d:type' % self.id).decode()
+        return self.get_field('type').decode()
 
     @type.setter
     def type(self, type_):
-        self.redis.set('components:%d:type' % self.id, type_)
+        self.set_field('type', type_)
 
     def init(self, *args, **kwargs):
         self.type = type(self).__name__
 
-    def clean_up(self):
-        self.redis.delete('components:%d:type' % self.id)
+    @classmethod
+    def resolve_class(cls, fields):
+        return _COMPONENTS_TYPES_MAP[fields['type'].decode()]
 
 
 class SendMessage(BaseComponent):
@@ -30,15 +44,11 @@ class SendMessage(BaseComponent):
 
     @property
     def text(self):
-        return self.redis.get('components:%d:text' % self.id, ).decode()
+        return self.get_field('text').decode()
 
     @text.setter
     def text(self, text):
-        self.redis.set('components:%d:text' % self.id, text)
-
-    def clean_up(self):
-        super().clean_up()
-        self.redis.delete('components:%d:text' % self.id)
+        self.set_field('text', text)
 
 
 class GetInput(BaseComponent):
@@ -50,15 +60,11 @@ class GetInput(BaseComponent):
 
     @property
     def variable_name(self):
-        return self.redis.get('components:%d:variable_name' % self.id).decode()
+        return self.get_field('variable_name').decode()
 
     @variable_name.setter
     def variable_name(self, variable_name):
-        self.redis.set('components:%d:variable_name' % self.id, variable_name)
-
-    def clean_up(self):
-        super().clean_up()
-        self.redis.delete('components:%d:variable_name' % self.id)
+        self.set_field('variable_name', variable_name)
 
 
 class ForwardToScreen(BaseComponent):
@@ -75,33 +81,30 @@ class ForwardToScreen(BaseComponent):
 
     @property
     def variable_name(self):
-        return self.redis.get('components:%d:variable_name' % self.id).decode()
+        return self.get_field('variable_name').decode()
 
     @variable_name.setter
     def variable_name(self, variable_name):
-        self.redis.set('components:%d:variable_name' % self.id, variable_name)
+        self.set_field('variable_name', variable_name)
 
     @property
     def target_screen(self):
-        return int(self.redis.get('components:%d:target_screen' % self.id))
+        return int(self.get_field('target_screen'))
 
     @target_screen.setter
     def target_screen(self, screen):
-        self.redis.set('components:%d:target_screen' % self.id, screen.id)
+        self.set_field('target_screen', screen.id)
 
     @property
     def condition_regex(self):
-        return self.redis.get('components:%d:condition' % self.id).decode()
+        return self.get_field('condition').decode()
 
     @condition_regex.setter
     def condition_regex(self, condition):
-        self.redis.set('components:%d:condition' % self.id, condition)
-
-    def clean_up(self):
-        super().clean_up()
-        self.redis.delete('components:%d:variable_name' % self.id)
-        self.redis.delete('components:%d:target_screen' % self.id)
-        self.redis.delete('components:%d:condition' % self.id)
+        """ Raise conditions.InvalidCondition for invalid or dangerous regular expressions """
+        if condition:
+            validate_condition(condition)
+        self.set_field('condition', condition if condition is not None else '')
 
 
 class OperatorDialog(BaseComponent):
@@ -115,33 +118,27 @@ class OperatorDialog(BaseComponent):
 
     @property
     def start_message(self):
-        return self.redis.get('components:%d:start_message' % self.id).decode()
+        return self.get_field('start_message').decode()
 
     @start_message.setter
     def start_message(self, start_message):
-        self.redis.set('components:%d:start_message' % self.id, start_message)
+        self.set_field('start_message', start_message)
 
     @property
     def stop_message(self):
-        return self.redis.get('components:%d:stop_message' % self.id).decode()
+        return self.get_field('stop_message').decode()
 
     @stop_message.setter
     def stop_message(self, stop_message):
-        self.redis.set('components:%d:stop_message' % self.id, stop_message)
+        self.set_field('stop_message', stop_message)
 
     @property
     def fail_message(self):
-        return self.redis.get('components:%d:fail_message' % self.id).decode()
+        return self.get_field('fail_message').decode()
 
     @fail_message.setter
     def fail_message(self, fail_message):
-        self.redis.set('components:%d:fail_message' % self.id, fail_message)
-
-    def clean_up(self):
-        super().clean_up()
-        self.redis.delete('components:%d:start_message' % self.id)
-        self.redis.delete('components:%d:stop_message' % self.id)
-        self.redis.delete('components:%d:fail_message' % self.id)
+        self.set_field('fail_message', fail_message)
 
 
 _COMPONENTS_TYPES_MAP = {'SendMessage': SendMessage,
@@ -151,77 +148,82 @@ _COMPONENTS_TYPES_MAP = {'SendMessage': SendMessage,
 
 
 def get_component_by_id(id_):
-    redis_ = get_redis_connection()
-    type_ = redis_.get('components:%d:type' % id_).decode()
-    return _COMPONENTS_TYPES_MAP[type_](id_)
+    return load_components((id_,))[0]
+
+
+def load_components(ids):
+    """ Return components of matching types for ids, loaded in one pipeline """
+    return BaseComponent.load_many(ids)
+
+
+async def aload_components(ids):
+    return await BaseComponent.aload_many(ids)
 
 
 class Screen(StoredObject):
     MNEMONIC = 'screen'
+    PREFIX = 'screens'
+    CACHED = True
+    COLLECTIONS = ('components',)
+    CHILDREN = {'components': BaseComponent}
+    VERSIONED = True
+    OWNERS = (('bot_template', 'bot_templates'),)
+    ORDER_GAP = 1024  # Difference of scores of appended components, moved components get scores between
 
     def init(self, name):
         self.name = name
 
     @property
     def name(self):
-        return self.redis.get('screens:%d:name' % self.id).decode()
+        return self.get_field('name').decode()
 
     @name.setter
     def name(self, name):
-        self.redis.set('screens:%d:name' % self.id, name)
+        self.set_field('name', name)
 
     def clean_up(self):
         for component in self.components:
             component.delete()
-        self.redis.delete('screens:%d:name' % self.id)
-        self.redis.delete('screens:%d:components' % self.id)
 
     def add_component(self, component):
         """ Add component to screen """
-        components_count = int(self.redis.zcard('screens:%d:components' % self.id))
-        self.redis.zadd('screens:%d:components' % self.id, component.id, components_count)
+        self.run_script(ORDERED_APPEND, keys=('screens:%d:components' % self.id,),
+                        args=(component.id, self.ORDER_GAP))
+        bot_template_id = self.get_field('bot_template')
+        if bot_template_id is not None:
+            component.set_field('bot_template', bot_template_id)
+        component.set_field('screen', self.id)
 
     @property
     def components(self):
         """ Return components """
-        result = []
         components = self.redis.zrange('screens:%d:components' % self.id, 0, -1)
-        for c in components:
-            result.append(get_component_by_id(int(c)))
-        return tuple(result)
+        return load_components(components)
 
     def change_component_position(self, component, target_index):
-        """ change index for component in screen """
-        component_index = self.redis.zrank('screens:%d:components' % self.id, component.id)
+        """ change index for component in screen, component gets score between its new neighbours """
         components_count = self.redis.zcard('screens:%d:components' % self.id)
         assert 0 <= target_index < components_count
-        if component_index is not None:
-            if component_index < target_index:
-                center_components = self.redis.zrange('screens:%d:components' % self.id,
-                                                      component_index + 1, target_index)
-                for c in center_components:
-                    self.redis.zincrby('screens:%d:components' % self.id, int(c), -1)
-                self.redis.zincrby('screens:%d:components' % self.id, component.id, target_index - component_index)
-            elif component_index > target_index:
-                center_components = self.redis.zrange('screens:%d:components' % self.id,
-                                                      target_index, component_index - 1)
-                for c in center_components:
-                    self.redis.zincrby('screens:%d:components' % self.id, int(c), +1)
-                self.redis.zincrby('screens:%d:components' % self.id, component.id, target_index - component_index)
+        self.run_script(ORDERED_MOVE, keys=('screens:%d:components' % self.id,),
+                        args=(component.id, target_index, self.ORDER_GAP))
+        self.changed()
 
     def delete_component(self, component):
         """ Delete component from screen """
-        component_index = self.redis.zrank('screens:%d:components' % self.id, component.id)
-        if component_index is not None:
+        if self.redis.zscore('screens:%d:components' % self.id, component.id) is not None:
             self.redis.zrem('screens:%d:components' % self.id, component.id)
-            tail_components = self.redis.zrange('screens:%d:components' % self.id, component_index, -1)
-            for c in tail_components:
-                self.redis.zincrby('screens:%d:components' % self.id, int(c), -1)
             component.delete()
+            self.changed()
 
 
 class BotTemplate(StoredObject):
     MNEMONIC = 'bot_template'
+    PREFIX = 'bot_templates'
+    CACHED = True
+    COLLECTIONS = ('screens', 'compiled', 'segments', 'contexts')  # Contexts is reverse index of bot contexts
+    VERSIONED = True
+    CHILDREN = {'screens': Screen}
+    LIST_KEY = 'bot_templates_list'
 
     @property
     def start_screen(self):
@@ -231,71 +233,246 @@ class BotTemplate(StoredObject):
         """ Delete screen from bot template """
         self.redis.lrem('bot_templates:%d:screens' % self.id, screen.id)
         screen.delete()
+        self.changed()
 
     def add_screen(self, screen):
         """ Add new screen to bot template """
         self.redis.rpush('bot_templates:%d:screens' % self.id, screen.id)
+        screen.set_field('bot_template', self.id)
+        for component in screen.components:
+            component.set_field('bot_template', self.id)
 
     @property
     def screens(self):
         """ return screens iterator """
         screens = self.redis.lrange('bot_templates:%d:screens' % self.id, 0, -1)
-        return tuple(Screen(int(screen)) for screen in screens)
-
-    def compile(self):
-        """ return actions for execution in Virtual Machine """
-
-        def calculate_forward_position(screens, screen=None):
-            position = 0
-            if screen is not None:
-                screen_index = screens.index(screen)
-                screens = self.screens[:screen_index]
-            for s in screens:
-                position += len(s.components) + 1
-            return position
-
-        actions = []
-        screens = self.screens
-        for screen in screens:
-            for action in screen.components:
-                if isinstance(action, SendMessage):
-                    actions.append(SendMessageAction(action.text))
-                elif isinstance(action, GetInput):
-                    actions.append(GetInputAction(action.variable_name))
-                elif isinstance(action, ForwardToScreen):
-                    actions.append(ForwardToPositionAction(calculate_forward_position(screens, screen),
-                                                           action.variable_name,
-                                                           action.condition_regex))
-                elif isinstance(action, OperatorDialog):
-                    actions.append(OperatorDialogAction(action.start_message,
-                                                        action.stop_message,
-                                                        action.fail_message))
-            actions.append(ForwardToPositionAction(calculate_forward_position(screens)))
-        return actions
+        return Screen.load_many(screens)
+
+    def compile(self, optimize=False, merge_messages=False):
+        """ return actions for execution in Virtual Machine, optionally optimized (see compile_optimized) """
+        if optimize:
+            return build_actions(self.compile_optimized(merge_messages)[0])
+        return build_actions(self.compile_program())
+
+    def compile_optimized(self, merge_messages=False):
+        """ Return (program, sources, statistics) of optimized program, see optimizer.optimize """
+        program, sources, statistics = optimize(*self.compile_with_sources(), merge_messages=merge_messages)
+        logger.info('Template %d optimized: %s' % (self.id, statistics))
+        return program, sources, statistics
+
+    def compile_program(self):
+        """ Return program of template, it is compiled once per template version """
+        return self.compile_with_sources()[0]
+
+    def compile_with_sources(self):
+        """ Return (program, sources) pair, sources are [screen id, component id] of program positions,
+        component id is None for forward ending screen """
+        version = self.get_version()
+        compiled_version, program, sources = self.redis.hmget(self.collection_key('compiled'),
+                                                               'version', 'program', 'sources')
+        if program is not None and sources is not None and int(compiled_version) == version:
+            return json.loads(program.decode()), json.loads(sources.decode())
+        screens_ids = [int(i) for i in self.redis.lrange('bot_templates:%d:screens' % self.id, 0, -1)]
+        program, sources = link_segments(screens_ids, self.compile_segments(screens_ids))
+        self.redis.hmset(self.collection_key('compiled'), {'version': version,
+                                                           'program': json.dumps(program),
+                                                           'sources': json.dumps(sources)})
+        return program, sources
+
+    def compile_segments(self, screens_ids):
+        """ Return segments of screens, only screens changed since previous compilation are compiled again """
+        pipeline = self.redis.pipeline(transaction=False)
+        for screen_id in screens_ids:
+            pipeline.hget('screens:%d' % screen_id, 'version')
+        versions = [int(v or 0) for v in pipeline.execute()] if len(screens_ids) != 0 else []
+        stored = {int(k): v for k, v in self.redis.hgetall(self.collection_key('segments')).items()}
+        segments = {}
+        changed = []
+        for screen_id, version in zip(screens_ids, versions):
+            segment = json.loads(stored[screen_id].decode()) if screen_id in stored else None
+            if segment is not None and segment['version'] == version:
+                segments[screen_id] = segment
+            else:
+                changed.append((screen_id, version))
+        if len(changed) != 0:
+            screens = Screen.load_many(screen_id for screen_id, _ in changed)
+            for (screen_id, version), components in zip(changed, load_screens_components(screens)):
+                segments[screen_id] = dict(compile_segment(components), version=version)
+            self.redis.hmset(self.collection_key('segments'),
+                             {screen_id: json.dumps(segments[screen_id]) for screen_id, _ in changed})
+        deleted = set(stored) - set(screens_ids)
+        if len(deleted) != 0:
+            self.redis.hdel(self.collection_key('segments'), *deleted)
+        return [segments[screen_id] for screen_id in screens_ids]
+
+    async def acompile(self):
+        """ Async compile(), template is loaded without blocking """
+        redis_ = get_async_redis_connection()
+        version = int(await redis_.hget(self.key, 'version') or 0)
+        compiled_version, program = await redis_.hmget(self.collection_key('compiled'), 'version', 'program')
+        if program is not None and int(compiled_version) == version:
+            return build_actions(json.loads(program.decode()))
+        screens = await Screen.aload_many(await redis_.lrange('bot_templates:%d:screens' % self.id, 0, -1))
+        program, sources = link_segments([s.id for s in screens],
+                                         [compile_segment(c) for c in await aload_screens_components(screens)])
+        await redis_.hmset_dict(self.collection_key('compiled'), {'version': version,
+                                                                  'program': json.dumps(program),
+                                                                  'sources': json.dumps(sources)})
+        return build_actions(program)
 
-    def init(self, name):
+    @classmethod
+    def compile_loaded(cls, screens, components):
+        """ return actions for loaded screens and sequences of their components """
+        return build_actions(cls.compile_screens(screens, components))
+
+    @staticmethod
+    def compile_screens(screens, components):
+        """ Return program for loaded screens and sequences of their components """
+        return link_segments([s.id for s in screens], [compile_segment(c) for c in components])[0]
+
+    def export(self, stream, compress=True):
+        """ Write template to binary stream, see exchange module for format """
+        exchange.export_template(self, stream, compress)
+
+    @classmethod
+    def import_(cls, stream, name=None, batch_size=500):
+        """ Create template from binary stream written by export() """
+        return exchange.import_template(stream, name, batch_size)
+
+    def clone(self, name=None):
+        """ Return copy of template """
+        stream = io.BytesIO()
+        self.export(stream, compress=False)
+        stream.seek(0)
+        return self.import_(stream, name)
+
+    def init(self, name, start_screen=None):
         """ add bot template to db and return """
         self.name = name
         self.redis.rpush('bot_templates_list', self.id)
-        self.add_screen(Screen.create('Start screen'))
+        self.add_screen(start_screen if start_screen is not None else Screen.create('Start screen'))
+
+    @classmethod
+    async def acreate(cls, name):
+        return await super().acreate(name, await Screen.acreate('Start screen'))
 
     def clean_up(self):
         for screen in self.screens:
             screen.delete()
         self.redis.lrem('bot_templates_list', self.id)
-        self.redis.delete('bot_templates:%d:screens' % self.id)
-        self.redis.delete('bot_templates:%d:name' % self.id)
 
     @property
     def name(self):
-        return self.redis.get('bot_templates:%d:name' % self.id).decode()
+        return self.get_field('name').decode()
 
     @name.setter
     def name(self, name):
-        self.redis.set('bot_templates:%d:name' % self.id, name)
+        self.set_field('name', name)
 
     @classmethod
     def list(cls):
-        redis_ = get_redis_connection()
+        redis_ = get_storage()
         bot_templates_list = redis_.lrange('bot_templates_list', 0, -1)
-        return tuple(cls(int(t)) for t in bot_templates_list)
+        return cls.load_many(bot_templates_list, redis_)
+
+
+_ACTIONS = {'SendMessage': SendMessageAction,
+            'GetInput': GetInputAction,
+            'Forward': ForwardToPositionAction,
+            'OperatorDialog': OperatorDialogAction}
+
+
+def compile_segment(components):
+    """ Return segment of screen: its instructions with forwards to screens by id and components ids """
+    instructions = []
+    components_ids = []
+    for action in components:
+        if isinstance(action, SendMessage):
+            instruction = ['SendMessage', action.text]
+        elif isinstance(action, GetInput):
+            instruction = ['GetInput', action.variable_name]
+        elif isinstance(action, ForwardToScreen):
+            instruction = ['ForwardToScreen', action.target_screen, action.variable_name, action.condition_regex]
+        elif isinstance(action, OperatorDialog):
+            instruction = ['OperatorDialog', action.start_message, action.stop_message, action.fail_message]
+        else:
+            continue
+        instructions.append(instruction)
+        components_ids.append(action.id)
+    return {'instructions': instructions, 'components': components_ids}
+
+
+def link_segments(screens_ids, segments):
+    """ Return (program, sources) for screens segments.
+    Program is JSON serializable list of instructions: [action name, *arguments].
+    Every screen ends with forward to program end, forwards to screens missing in template too """
+    offsets = {}  # Screen id to position of its first action map
+    position = 0
+    for screen_id, segment in zip(screens_ids, segments):
+        offsets[screen_id] = position
+        position += len(segment['instructions']) + 1
+    end = position
+
+    program = []
+    sources = []
+    for screen_id, segment in zip(screens_ids, segments):
+        for instruction, component_id in zip(segment['instructions'], segment['components']):
+            if instruction[0] == 'ForwardToScreen':
+                instruction = ['Forward', offsets.get(instruction[1], end)] + instruction[2:]
+            program.append(instruction)
+            sources.append([screen_id, component_id])
+        program.append(['Forward', end])
+        sources.append([screen_id, None])
+    return program, sources
+
+
+def source_locator(sources):
+    """ Return function mapping (screen id, component id) source to position of program with sources:
+    position of the same component, start of the same screen if component is deleted, 0 if screen is deleted too """
+    components = {}
+    screens_starts = {}
+    for position, (screen_id, component_id) in enumerate(sources):
+        components[(screen_id, component_id)] = position
+        screens_starts.setdefault(screen_id, position)
+    return lambda screen_id, component_id: components.get((screen_id, component_id),
+                                                          screens_starts.get(screen_id, 0))
+
+
+def remap_positions(old_sources, new_sources):
+    """ Return new positions for positions of old program (see source_locator) """
+    locate = source_locator(new_sources)
+    return [locate(screen_id, component_id) for screen_id, component_id in old_sources]
+
+
+def build_actions(program):
+    """ Return actions for Virtual Machine from compiled program, forward conditions are passed
+    as compiled patterns shared by all programs """
+    actions = []
+    for instruction in program:
+        if instruction[0] == 'Forward' and len(instruction) == 4 and instruction[3]:
+            instruction = instruction[:3] + [compile_condition(instruction[3])]
+        actions.append(_ACTIONS[instruction[0]](*instruction[1:]))
+    return actions
+
+
+def load_screens_components(screens):
+    """ Return tuple of components for every screen, all of them are loaded in two round trips """
+    pipeline = get_storage().pipeline(transaction=False)
+    for screen in screens:
+        pipeline.zrange('screens:%d:components' % screen.id, 0, -1)
+    ids = pipeline.execute() if len(screens) != 0 else ()
+    return _split_components(ids, load_components(id_ for screen_ids in ids for id_ in screen_ids))
+
+
+async def aload_screens_components(screens):
+    pipeline = get_async_redis_connection().pipeline()
+    for screen in screens:
+        pipeline.zrange('screens:%d:components' % screen.id, 0, -1)
+    ids = await pipeline.execute()
+    return _split_components(ids, await aload_components(id_ for screen_ids in ids for id_ in screen_ids))
+
+
+def _split_components(ids, components):
+    """ Split flat components sequence by screens """
+    components = iter(components)
+    return tuple(tuple(next(components) for _ in screen_ids) for screen_ids in ids)
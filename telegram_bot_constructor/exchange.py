@@ -0,0 +1,209 @@
+""" Bot templates export/import format.
+
+Stream starts with MAGIC, format version byte and flags byte, bit FLAG_ZLIB means records are compressed.
+Records are 4 bytes big endian length prefixed JSON objects with sorted keys:
+    {"record": "template", "name": ...}
+    {"record": "screen", "id": ..., "fields": {...}}  - all screens in template order
+    {"record": "component", "id": ..., "screen": ..., "fields": {...}}  - components in screens order
+    {"record": "end", "screens": ..., "components": ...}
+Ids are ids of exported objects, import allocates new ones.
+
+Usage: python -m telegram_bot_constructor.exchange <file> - print records of exported template """
+import json
+import struct
+import sys
+import zlib
+from logging import getLogger
+
+from . import constructor
+from .conditions import InvalidCondition, validate_condition
+from .helpers import get_storage
+
+MAGIC = b'TBCT'
+FORMAT_VERSION = 1
+FLAG_ZLIB = 1
+
+# Fields maintained by storage, they are not exported
+_INTERNAL_FIELDS = frozenset(('version', 'screen', 'bot_template'))
+
+_LENGTH = struct.Struct('>I')
+
+logger = getLogger('Exchange')
+
+
+class InvalidTemplateStream(Exception):
+    pass
+
+
+def _public_fields(fields):
+    return {k: v.decode() for k, v in sorted(fields.items()) if k not in _INTERNAL_FIELDS}
+
+
+def _template_records(template):
+    screens = template.screens
+    components = constructor.load_screens_components(screens)
+    yield {'record': 'template', 'name': template.name}
+    for screen in screens:
+        if screen.fields is None:
+            screen.load()
+        yield {'record': 'screen', 'id': screen.id, 'fields': _public_fields(screen.fields)}
+    for screen, screen_components in zip(screens, components):
+        for component in screen_components:
+            if component.fields is None:
+                component.load()
+            yield {'record': 'component', 'id': component.id, 'screen': screen.id,
+                   'fields': _public_fields(component.fields)}
+    yield {'record': 'end', 'screens': len(screens), 'components': sum(len(c) for c in components)}
+
+
+def export_template(template, stream, compress=True):
+    """ Write template to binary stream """
+    stream.write(MAGIC + bytes((FORMAT_VERSION, FLAG_ZLIB if compress else 0)))
+    compressor = zlib.compressobj() if compress else None
+    for record in _template_records(template):
+        data = json.dumps(record, sort_keys=True, separators=(',', ':')).encode()
+        data = _LENGTH.pack(len(data)) + data
+        stream.write(compressor.compress(data) if compressor is not None else data)
+    if compressor is not None:
+        stream.write(compressor.flush())
+
+
+def read_records(stream, chunk_size=65536):
+    """ Yield records of exported template from binary stream """
+    header = stream.read(len(MAGIC) + 2)
+    if len(header) != len(MAGIC) + 2 or header[:len(MAGIC)] != MAGIC:
+        raise InvalidTemplateStream('Not a bot template stream')
+    version, flags = header[len(MAGIC)], header[len(MAGIC) + 1]
+    if version != FORMAT_VERSION:
+        raise InvalidTemplateStream('Unsupported format version %d' % version)
+    decompressor = zlib.decompressobj() if flags & FLAG_ZLIB else None
+    buffer = b''
+    while True:
+        data = stream.read(chunk_size)
+        if decompressor is not None:
+            buffer += decompressor.decompress(data) if data else decompressor.flush()
+        else:
+            buffer += data
+        while len(buffer) >= _LENGTH.size:
+            length = _LENGTH.unpack_from(buffer)[0]
+            if len(buffer) < _LENGTH.size + length:
+                break
+            record = json.loads(buffer[_LENGTH.size:_LENGTH.size + length].decode())
+            buffer = buffer[_LENGTH.size + length:]
+            yield record
+            if record['record'] == 'end':
+                return
+        if not data:
+            raise InvalidTemplateStream('Stream is truncated')
+
+
+def _batches(records, kind, batch_size):
+    """ Yield batches of consecutive records of kind and the first record of other kind """
+    batch = []
+    for record in records:
+        if record['record'] != kind:
+            if len(batch) != 0:
+                yield batch, None
+            yield [], record
+            return
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch, None
+            batch = []
+    raise InvalidTemplateStream('Stream is truncated')
+
+
+class _Importer:
+    """ Writes template objects by batches, every batch is one transaction """
+
+    def __init__(self, redis_, name):
+        self.redis = redis_
+        self.template_id = constructor.BotTemplate.allocate_ids(1, redis_)
+        self.screens = {}  # Exported screen id to new id map
+        self.components_counts = {}  # New screen id to count of imported components map
+        self.components = 0
+        pipeline = redis_.pipeline(transaction=True)
+        pipeline.sadd('%s_exists' % constructor.BotTemplate.MNEMONIC, self.template_id)
+        pipeline.hmset('bot_templates:%d' % self.template_id, {'name': name, 'version': 1})
+        pipeline.execute()
+
+    def add_screens(self, records):
+        first_id = constructor.Screen.allocate_ids(len(records), self.redis)
+        ids = range(first_id, first_id + len(records))
+        pipeline = self.redis.pipeline(transaction=True)
+        pipeline.sadd('%s_exists' % constructor.Screen.MNEMONIC, *ids)
+        for id_, record in zip(ids, records):
+            self.screens[record['id']] = id_
+            pipeline.hmset('screens:%d' % id_, dict(record['fields'], bot_template=self.template_id))
+        pipeline.rpush('bot_templates:%d:screens' % self.template_id, *ids)
+        pipeline.execute()
+
+    def add_components(self, records):
+        first_id = constructor.BaseComponent.allocate_ids(len(records), self.redis)
+        ids = range(first_id, first_id + len(records))
+        pipeline = self.redis.pipeline(transaction=True)
+        pipeline.sadd('%s_exists' % constructor.BaseComponent.MNEMONIC, *ids)
+        scores = {}  # Screen id to flat (component id, score) pairs map
+        for id_, record in zip(ids, records):
+            if record['screen'] not in self.screens:
+                raise InvalidTemplateStream('Component %d of unknown screen' % record['id'])
+            screen_id = self.screens[record['screen']]
+            fields = dict(record['fields'], screen=screen_id, bot_template=self.template_id)
+            if fields.get('type') not in constructor._COMPONENTS_TYPES_MAP:
+                raise InvalidTemplateStream('Unknown component type %r' % fields.get('type'))
+            if 'target_screen' in fields:
+                fields['target_screen'] = self.screens.get(int(fields['target_screen']), -1)
+            if fields.get('condition'):
+                try:
+                    validate_condition(fields['condition'])
+                except InvalidCondition as e:  # Stored before validation, such templates are runnable too
+                    logger.warning('%s, condition of component %d is imported as is' % (e, record['id']))
+            position = self.components_counts.get(screen_id, 0)
+            self.components_counts[screen_id] = position + 1
+            pipeline.hmset('components:%d' % id_, fields)
+            scores.setdefault(screen_id, []).extend((id_, position * constructor.Screen.ORDER_GAP))
+        for screen_id, pairs in scores.items():
+            pipeline.zadd('screens:%d:components' % screen_id, *pairs)
+        pipeline.execute()
+        self.components += len(records)
+
+    def finish(self, end):
+        if end['screens'] != len(self.screens) or end['components'] != self.components:
+            raise InvalidTemplateStream('Stream is inconsistent')
+        self.redis.rpush(constructor.BotTemplate.LIST_KEY, self.template_id)
+        return constructor.BotTemplate(self.template_id, check=False)
+
+
+def import_template(stream, name=None, batch_size=500):
+    """ Create template from binary stream, objects are written by batches of batch_size.
+    Partially imported template is deleted if stream is invalid """
+    records = read_records(stream)
+    template = next(records, None)
+    if template is None or template['record'] != 'template':
+        raise InvalidTemplateStream('Template record expected')
+    importer = _Importer(get_storage(), name if name is not None else template['name'])
+    try:
+        record = None
+        for kind, add in (('screen', importer.add_screens), ('component', importer.add_components)):
+            records = _chain(record, records)
+            for batch, record in _batches(records, kind, batch_size):
+                if len(batch) != 0:
+                    add(batch)
+        if record['record'] != 'end':
+            raise InvalidTemplateStream('Unexpected %s record' % record['record'])
+        return importer.finish(record)
+    except Exception:
+        constructor.BotTemplate(importer.template_id, check=False).delete()
+        raise
+
+
+def _chain(first, records):
+    if first is not None:
+        yield first
+    yield from records
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1], 'rb') as file:
+        for record in read_records(file):
+            print(json.dumps(record, sort_keys=True, ensure_ascii=False))
@@ -1,51 +1,607 @@
+import json
 import random
 import string
+import threading
 
-from . import get_redis_connection
+from . import get_redis_connection, get_async_redis_connection
+from .cache import get_cache, invalidate
+from .scripts import cascade_delete, async_cascade_delete, run_script
+
+_local = threading.local()
 
 
 class ObjectDoesNotExist(Exception):
     pass
 
 
+class ResultNotAvailable(Exception):
+    pass
+
+
+class BufferedResult:
+    """ Result of write command buffered by session, it is known only after session flush. Any usage of it
+    raises ResultNotAvailable, so code depending on results of writes fails instead of getting a truthy value """
+
+    def __init__(self, command):
+        self.command = command
+
+    def _unavailable(self, *args):
+        raise ResultNotAvailable('Result of %s is not available inside session, writes are executed on its exit'
+                                 % self.command)
+
+    __bool__ = __int__ = __float__ = __index__ = __len__ = __iter__ = __getitem__ = __eq__ = __ne__ = \
+        __lt__ = __le__ = __gt__ = __ge__ = _unavailable
+    __hash__ = object.__hash__
+
+    def __getattr__(self, item):
+        self._unavailable()
+
+    def __repr__(self):
+        return '<BufferedResult of %s>' % self.command
+
+
+class SessionRedis:
+    """ Connection proxy used by objects inside session.
+    Writes are buffered to session transaction, reads go to connection with buffered changes applied
+    for fields of objects and existence sets. Lists and sorted sets are read as committed.
+
+    Commands of IMMEDIATE_COMMANDS and overridden reads (hget, hgetall, sismember) are session-safe and return
+    results. Other commands, including run_script() through proxy, return BufferedResult, so counts of srem, lrem
+    or hincrby must not be used inside session: read the state before writing it or run such code outside
+    of session """
+
+    # Commands executed immediately, ids allocation is not a part of unit of work
+    IMMEDIATE_COMMANDS = frozenset(('get', 'hmget', 'exists', 'type', 'smembers', 'scard', 'lrange', 'llen',
+                                    'lindex', 'zrange', 'zrevrange', 'zrangebyscore', 'zrank', 'zcard',
+                                    'zscore', 'zscan', 'zscan_iter', 'scan_iter', 'incrby', 'pubsub', 'pipeline',
+                                    'register_script'))
+
+    def __init__(self, session):
+        self.session = session
+        self.active = True
+
+    def __getattr__(self, item):
+        if not self.active or item in self.IMMEDIATE_COMMANDS:
+            return getattr(self.session.connection, item)
+        command = getattr(self.session.pipeline, item)
+        if not callable(command):
+            return command
+
+        def buffered(*args, **kwargs):
+            command(*args, **kwargs)
+            return BufferedResult(item)
+
+        return buffered
+
+    def hget(self, key, field):
+        if self.active and key in self.session.changes:
+            changes = self.session.changes[key]
+            if field in changes or changes.get(None):
+                return changes.get(field)
+        return self.session.connection.hget(key, field)
+
+    def hgetall(self, key):
+        fields = {} if self.active and self.session.changes.get(key, {}).get(None) \
+            else self.session.connection.hgetall(key)
+        if self.active:
+            for field, value in self.session.changes.get(key, {}).items():
+                if field is None:
+                    continue
+                elif value is None:
+                    fields.pop(field.encode(), None)
+                else:
+                    fields[field.encode()] = value
+        return fields
+
+    def hset(self, key, field, value):
+        result = self.__getattr__('hset')(key, field, value)
+        if self.active:
+            self.session.changes.setdefault(key, {})[field] = value
+        return result
+
+    def hdel(self, key, *fields):
+        result = self.__getattr__('hdel')(key, *fields)
+        if self.active:
+            for field in fields:
+                self.session.changes.setdefault(key, {})[field] = None
+        return result
+
+    def delete(self, *keys):
+        result = self.__getattr__('delete')(*keys)
+        if self.active:
+            for key in keys:
+                self.session.changes[key] = {None: True}  # Whole key removed
+        return result
+
+    def sadd(self, key, *members):
+        result = self.__getattr__('sadd')(key, *members)
+        if self.active:
+            for member in members:
+                self.session.memberships[(key, str(member))] = True
+        return result
+
+    def srem(self, key, *members):
+        result = self.__getattr__('srem')(key, *members)
+        if self.active:
+            for member in members:
+                self.session.memberships[(key, str(member))] = False
+        return result
+
+    def sismember(self, key, member):
+        if self.active and (key, str(member)) in self.session.memberships:
+            return self.session.memberships[(key, str(member))]
+        return self.session.connection.sismember(key, member)
+
+
+class Session:
+    """ Unit of work: identity map of loaded objects and writes buffered to one MULTI/EXEC transaction,
+    executed on exit from context. Nested sessions join outer one """
+
+    def __init__(self, redis_=None):
+        self.connection = redis_ if redis_ is not None else get_redis_connection()
+        self.pipeline = self.connection.pipeline(transaction=True)
+        self.redis = SessionRedis(self)
+        self.identity_map = {}  # (mnemonic, id) to object map
+        self.changes = {}  # Hash key to buffered field changes map, None field marks deleted key
+        self.memberships = {}  # (set key, member) to buffered membership map
+        self.depth = 0
+
+    def flush(self):
+        """ Execute buffered writes """
+        self.pipeline.execute()
+        self.changes = {}
+        self.memberships = {}
+
+    def close(self):
+        self.redis.active = False
+        self.pipeline.reset()
+        self.identity_map = {}
+        self.changes = {}
+        self.memberships = {}
+
+    def __enter__(self):
+        if self.depth == 0:
+            _local.__dict__.setdefault('sessions', []).append(self)
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.depth -= 1
+        if self.depth == 0:
+            _local.sessions.pop()
+            try:
+                if exc_type is None:
+                    self.flush()
+            finally:
+                self.close()
+
+
+class CommandsRecorder:
+    """ Connection stand-in recording redis-py style write commands for execution on async connection """
+
+    def __init__(self):
+        self.commands = []
+
+    def __getattr__(self, item):
+        def record(*args):
+            self.commands.append((item, args))
+
+        return record
+
+
+# Commands with arguments order differing between redis-py and aioredis
+_ASYNC_ARGUMENTS = {'zadd': lambda key, *pairs: (key,) + tuple(pairs[i + j] for i in range(0, len(pairs), 2)
+                                                               for j in (1, 0)),
+                    'lrem': lambda key, value, num=0: (key, num, value),
+                    'zincrby': lambda key, value, amount=1: (key, amount, value)}
+
+
+async def execute_recorded(redis_, commands, transaction=True):
+    """ Execute recorded commands on async connection in one MULTI/EXEC transaction or pipeline """
+    pipeline = redis_.multi_exec() if transaction else redis_.pipeline()
+    for name, args in commands:
+        if name in _ASYNC_ARGUMENTS:
+            args = _ASYNC_ARGUMENTS[name](*args)
+        getattr(pipeline, name)(*args)
+    return await pipeline.execute()
+
+
+def get_session():
+    """ Return active session of current thread """
+    sessions = getattr(_local, 'sessions', None)
+    if sessions:
+        return sessions[-1]
+
+
+def session(redis_=None):
+    """ Return active session or new one for usage as context manager """
+    current = get_session()
+    return current if current is not None else Session(redis_)
+
+
+def get_storage():
+    """ Return connection for objects: session proxy if session is active """
+    current = get_session()
+    return current.redis if current is not None else get_redis_connection()
+
+
 class StoredObject:
     """ Abstract class for stored in redis database objects """
 
     MNEMONIC = ''
+    PREFIX = ''  # Object fields are stored in '<PREFIX>:<id>' hash
+    COLLECTIONS = ()  # Names of owned '<PREFIX>:<id>:<name>' keys, deleted with object
+    IDENTITY_MAPPED = True  # Instances are shared inside session
+    CACHED = False  # Fields are read through process local cache, if it is enabled
+    CHILDREN = {}  # Collection name to class of owned objects map, they are deleted with object
+    LIST_KEY = ''  # Key of list with all objects of class
+    VERSIONED = False  # Object hash has 'version' field counting changes of object
+    OWNERS = ()  # (field, prefix) pairs of back references to versioned owners, they count changes of object too
 
-    def __init__(self, id_, redis_=None):
-        self.redis = redis_ if redis_ is not None else get_redis_connection()
-        if not type(self).exists(id_, self.redis):
+    def __new__(cls, id_, *args, **kwargs):
+        current = get_session()
+        if current is not None and cls.IDENTITY_MAPPED:
+            obj = current.identity_map.get((cls.MNEMONIC or cls.__name__, id_))
+            if isinstance(obj, cls):
+                return obj
+        return super().__new__(cls)
+
+    def __init__(self, id_, redis_=None, check=True):
+        if 'id' in self.__dict__:  # Instance is taken from session identity map
+            return
+        self.redis = redis_ if redis_ is not None else get_storage()
+        if check and not type(self).exists(id_, self.redis):
             raise ObjectDoesNotExist
         self.id = id_
+        self.fields = None  # Fields snapshot, filled by load()
+        self.new = False  # Object is being initialized, nobody could cache it yet
+        current = get_session()
+        if current is not None and type(self).IDENTITY_MAPPED:
+            current.identity_map[(self.MNEMONIC or type(self).__name__, id_)] = self
+
+    @property
+    def key(self):
+        return '%s:%d' % (self.PREFIX, self.id)
+
+    def collection_key(self, name):
+        return '%s:%d:%s' % (self.PREFIX, self.id, name)
+
+    @classmethod
+    def get_cache(cls, redis_):
+        """ Return cache for reads through given connection, None if reads are not cached """
+        if cls.CACHED and not isinstance(redis_, SessionRedis):
+            return get_cache()
+
+    def load(self):
+        """ Load all fields with one request, following fields reads are served from snapshot """
+        mnemonic = self.MNEMONIC or type(self).__name__
+        cache = self.get_cache(self.redis)
+        if cache is not None:
+            found, fields = cache.get((mnemonic, self.id, None))
+            if found:
+                self.fields = dict(fields)
+                return self
+            generation = cache.generation
+        self.fields = {k.decode(): v for k, v in self.redis.hgetall(self.key).items()}
+        if cache is not None:
+            cache.set((mnemonic, self.id, None), dict(self.fields), generation)
+        return self
+
+    def refresh(self):
+        """ Drop fields snapshot of load() or load_many(), following reads return current values """
+        self.fields = None
+        return self
+
+    def get_field(self, name):
+        if self.fields is None and isinstance(self.redis, SessionRedis) and self.redis.active:
+            self.load()  # Inside session object is loaded once
+        if self.fields is not None:
+            return self.fields.get(name)
+        cache = self.get_cache(self.redis)
+        if cache is not None:
+            key = (self.MNEMONIC or type(self).__name__, self.id, name)
+            found, value = cache.get(key)
+            if not found:
+                generation = cache.generation
+                value = self.redis.hget(self.key, name)
+                cache.set(key, value, generation)
+            return value
+        return self.redis.hget(self.key, name)
+
+    def set_field(self, name, value):
+        value = value if isinstance(value, bytes) else str(value).encode()
+        self.redis.hset(self.key, name, value)
+        if self.fields is not None:
+            self.fields[name] = value
+        if not self.new:
+            if self.CACHED:
+                invalidate(self.redis, self.MNEMONIC or type(self).__name__, self.id, name)
+            self.changed()
+
+    def delete_field(self, name):
+        self.redis.hdel(self.key, name)
+        if self.fields is not None:
+            self.fields.pop(name, None)
+        if self.CACHED:
+            invalidate(self.redis, self.MNEMONIC or type(self).__name__, self.id, name)
+        self.changed()
+
+    def changed(self):
+        """ Bump versions of object and its owners """
+        if self.VERSIONED:
+            self.redis.hincrby(self.key, 'version', 1)
+        for field, prefix in self.OWNERS:
+            owner_id = self.get_field(field)
+            if owner_id is not None:
+                self.redis.hincrby('%s:%d' % (prefix, int(owner_id)), 'version', 1)
+
+    def run_script(self, source, keys=(), args=()):
+        """ Run script on object connection, inside session script is a part of session transaction
+        and its result is not available """
+        redis_ = self.redis
+        if isinstance(redis_, SessionRedis) and redis_.active:
+            redis_ = redis_.session.pipeline
+        return run_script(redis_, source, keys, args)
+
+    def get_version(self):
+        """ Return current version, it is always read from storage """
+        return int(self.redis.hget(self.key, 'version') or 0)
+
+    @classmethod
+    def allocate_ids(cls, count=1, redis_=None):
+        """ Atomically reserve count sequential ids, return the first one """
+        mnemonic = cls.MNEMONIC or cls.__name__
+        redis_ = redis_ if redis_ is not None else get_storage()
+        last_id = int(redis_.incrby('last_%s_id' % mnemonic, count))
+        return last_id - count
 
     @classmethod
     def create(cls, *args, **kwargs):
-        redis_ = get_redis_connection()
+        return cls._create_rows(((args, kwargs),))[0]
+
+    @classmethod
+    def create_many(cls, rows):
+        """ Create object for every row of init arguments (tuple of positional or dict of keyword ones).
+        Ids allocation, existence set and initial fields are written in one transaction """
+        rows = tuple(((), row) if isinstance(row, dict) else (tuple(row), {}) for row in rows)
+        return cls._create_rows(rows)
+
+    @classmethod
+    def _create_rows(cls, rows):
+        if len(rows) == 0:
+            return ()
+        redis_ = get_storage()
         mnemonic = cls.MNEMONIC or cls.__name__
-        last_id = redis_.get('last_%s_id' % mnemonic)
-        last_id = int(last_id) if last_id is not None else 0
-        redis_.sadd('%s_exists' % mnemonic, last_id)
-        redis_.incr('last_%s_id' % mnemonic)
-        obj = cls(last_id, redis_)
-        obj.init(*args, **kwargs)
-        return obj
+        first_id = cls.allocate_ids(len(rows), redis_)
+        current = get_session()
+        pipeline = redis_.pipeline(transaction=True) if current is None else redis_  # Session buffers writes itself
+        objects = []
+        for id_, (args, kwargs) in enumerate(rows, first_id):
+            pipeline.sadd('%s_exists' % mnemonic, id_)
+            obj = cls(id_, pipeline, check=False)
+            obj.new = True
+            obj.init(*args, **kwargs)
+            objects.append(obj)
+        if current is None:
+            pipeline.execute()
+        for obj in objects:
+            obj.redis = redis_
+            obj.new = False
+        return tuple(objects)
+
+    @classmethod
+    def load_many(cls, ids, redis_=None):
+        """ Return loaded objects for ids, existence and fields of all objects are fetched in one pipeline.
+        Like after load(), fields are read from snapshot: changes by other objects and processes are not seen
+        until refresh(), so objects kept for long time must be refreshed or loaded again """
+        mnemonic = cls.MNEMONIC or cls.__name__
+        redis_ = redis_ if redis_ is not None else get_storage()
+        current = get_session()
+        ids = tuple(int(id_) for id_ in ids)
+        cache = cls.get_cache(redis_)
+        loaded, generation = cls._get_cached_fields(ids, cache)
+        fetched_ids = tuple(id_ for id_ in ids if id_ not in loaded)
+        pipeline = redis_.pipeline(transaction=False)
+        for id_ in fetched_ids:
+            pipeline.sismember('%s_exists' % mnemonic, id_)
+            pipeline.hgetall('%s:%d' % (cls.PREFIX, id_))
+        results = pipeline.execute() if len(fetched_ids) != 0 else ()
+        if current is not None:
+            results = list(results)
+            for i, id_ in enumerate(fetched_ids):
+                results[i * 2] = current.memberships.get(('%s_exists' % mnemonic, str(id_)), results[i * 2])
+        cls._set_fetched_fields(loaded, fetched_ids, results, cache, generation)
+        objects = []
+        for id_ in ids:
+            fields = loaded[id_]
+            obj = cls.resolve_class(fields)(id_, redis_, check=False)
+            if obj.fields is None:
+                if current is not None and obj.key in current.changes:
+                    obj.load()  # Apply buffered changes
+                else:
+                    obj.fields = fields
+            objects.append(obj)
+        return tuple(objects)
+
+    @classmethod
+    def _get_cached_fields(cls, ids, cache):
+        """ Return (id to cached fields map, cache generation) """
+        loaded = {}
+        if cache is None:
+            return loaded, None
+        for id_ in ids:
+            found, fields = cache.get((cls.MNEMONIC or cls.__name__, id_, None))
+            if found:
+                loaded[id_] = dict(fields)
+        return loaded, cache.generation
+
+    @classmethod
+    def _set_fetched_fields(cls, loaded, ids, results, cache, generation):
+        """ Fill loaded map from pipelined (exists, fields) results pairs """
+        for id_, exists, fields in zip(ids, results[::2], results[1::2]):
+            if not exists:
+                raise ObjectDoesNotExist
+            loaded[id_] = {k.decode(): v for k, v in fields.items()}
+            if cache is not None:
+                cache.set((cls.MNEMONIC or cls.__name__, id_, None), dict(loaded[id_]), generation)
+
+    @classmethod
+    def resolve_class(cls, fields):
+        """ Return class for object with given fields, used by polymorphic loading """
+        return cls
 
     def init(self, *args, **kwargs):
         pass
 
-    def delete(self):
+    @classmethod
+    def cascade_spec(cls):
+        """ Return description of owned objects tree for server side deletion """
+        return {'mnemonic': cls.MNEMONIC or cls.__name__,
+                'prefix': cls.PREFIX,
+                'collections': list(cls.COLLECTIONS),
+                'children': {name: child.cascade_spec() for name, child in cls.CHILDREN.items()},
+                'lists': [cls.LIST_KEY] if cls.LIST_KEY else [],
+                'cached': cls.CACHED}
+
+    def delete(self, chunk_size=1000):
+        """ Delete object. before_delete() is called first in any case. Then object with CHILDREN is deleted
+        with its owned objects on server side by chunks of chunk_size objects as cascade_spec() describes,
+        clean_up() is called instead only inside session and for objects without children. So clean_up() must
+        only delete what cascade_spec() describes: owned objects, collections and lists entries. Other side
+        effects belong to before_delete(), it is not called for owned objects deleted on server side """
+        self.before_delete()
+        self._delete(chunk_size)
+
+    def _delete(self, chunk_size):
+        if len(self.CHILDREN) != 0 and not isinstance(self.redis, SessionRedis):
+            cascade_delete(self.redis, json.dumps(self.cascade_spec()), self.id, chunk_size)
+            return
         mnemonic = self.MNEMONIC or type(self).__name__
         self.redis.srem('%s_exists' % mnemonic, self.id)
         self.clean_up()
+        self.redis.delete(self.key, *(self.collection_key(c) for c in self.cascade_spec()['collections']))
+        if self.CACHED:
+            invalidate(self.redis, mnemonic, self.id)
+        current = get_session()
+        if current is not None:
+            current.identity_map.pop((mnemonic, self.id), None)
+
+    def before_delete(self):
+        """ Side effects of deletion out of owned objects tree, like removal from indexes of other objects """
+        pass
+
+    async def abefore_delete(self):
+        """ Async before_delete() called by adelete() """
+        pass
 
     def clean_up(self):
         pass
 
+    @classmethod
+    async def acreate(cls, *args, **kwargs):
+        return (await cls._acreate_rows(((args, kwargs),)))[0]
+
+    @classmethod
+    async def acreate_many(cls, rows):
+        """ Async create_many(), objects are returned with loaded fields """
+        rows = tuple(((), row) if isinstance(row, dict) else (tuple(row), {}) for row in rows)
+        return await cls._acreate_rows(rows)
+
+    @classmethod
+    async def _acreate_rows(cls, rows):
+        if len(rows) == 0:
+            return ()
+        redis_ = get_async_redis_connection()
+        mnemonic = cls.MNEMONIC or cls.__name__
+        first_id = int(await redis_.incrby('last_%s_id' % mnemonic, len(rows))) - len(rows)
+        recorder = CommandsRecorder()
+        objects = []
+        for id_, (args, kwargs) in enumerate(rows, first_id):
+            recorder.sadd('%s_exists' % mnemonic, id_)
+            obj = cls(id_, recorder, check=False)
+            obj.new = True
+            obj.fields = {}
+            obj.init(*args, **kwargs)
+            objects.append(obj)
+        await execute_recorded(redis_, recorder.commands)
+        for obj in objects:
+            obj.redis = get_storage()
+            obj.new = False
+        return tuple(objects)
+
+    @classmethod
+    async def aexists(cls, id_, redis_=None):
+        mnemonic = cls.MNEMONIC or cls.__name__
+        redis_ = redis_ if redis_ is not None else get_async_redis_connection()
+        return bool(await redis_.sismember('%s_exists' % mnemonic, id_))
+
+    @classmethod
+    async def aget(cls, id_, redis_=None):
+        """ Async constructor, return object with loaded fields """
+        return (await cls.aload_many((id_,), redis_))[0]
+
+    @classmethod
+    async def aload_many(cls, ids, redis_=None):
+        """ Async load_many() """
+        mnemonic = cls.MNEMONIC or cls.__name__
+        redis_ = redis_ if redis_ is not None else get_async_redis_connection()
+        ids = tuple(int(id_) for id_ in ids)
+        cache = cls.get_cache(redis_)
+        loaded, generation = cls._get_cached_fields(ids, cache)
+        fetched_ids = tuple(id_ for id_ in ids if id_ not in loaded)
+        pipeline = redis_.pipeline()
+        for id_ in fetched_ids:
+            pipeline.sismember('%s_exists' % mnemonic, id_)
+            pipeline.hgetall('%s:%d' % (cls.PREFIX, id_))
+        results = await pipeline.execute()
+        cls._set_fetched_fields(loaded, fetched_ids, results, cache, generation)
+        objects = []
+        for id_ in ids:
+            obj = cls.resolve_class(loaded[id_])(id_, get_storage(), check=False)
+            obj.fields = loaded[id_]
+            objects.append(obj)
+        return tuple(objects)
+
+    async def aload(self, redis_=None):
+        """ Async load(), after it properties are read without blocking """
+        redis_ = redis_ if redis_ is not None else get_async_redis_connection()
+        self.fields = {k.decode(): v for k, v in (await redis_.hgetall(self.key)).items()}
+        return self
+
+    async def aset(self, **properties):
+        """ Assign properties, writes are executed on async connection in one transaction """
+        if self.fields is None and len(self.OWNERS) != 0:
+            await self.aload()  # Owners references are read from snapshot, recorder can not read
+        recorder = CommandsRecorder()
+        redis_ = self.redis
+        self.redis = recorder
+        try:
+            for name, value in properties.items():
+                setattr(self, name, value)
+        finally:
+            self.redis = redis_
+        await execute_recorded(get_async_redis_connection(), recorder.commands)
+
+    async def adelete(self, chunk_size=1000):
+        """ Async delete() """
+        await self.abefore_delete()
+        if len(self.CHILDREN) != 0:
+            await async_cascade_delete(get_async_redis_connection(), json.dumps(self.cascade_spec()),
+                                       self.id, chunk_size)
+            return
+        recorder = CommandsRecorder()
+        redis_ = self.redis
+        self.redis = recorder
+        try:
+            self._delete(chunk_size)
+        finally:
+            self.redis = redis_
+        await execute_recorded(get_async_redis_connection(), recorder.commands)
+
     @classmethod
     def exists(cls, id_, redis_=None):
         mnemonic = cls.MNEMONIC or cls.__name__
-        redis_ = redis_ if redis_ is not None else get_redis_connection()
+        redis_ = redis_ if redis_ is not None else get_storage()
         exists = redis_.sismember('%s_exists' % mnemonic, id_)
         return exists
 
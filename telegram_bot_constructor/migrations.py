@@ -0,0 +1,155 @@
+""" Keyspace migrations between storage layouts """
+import re
+import sys
+
+from . import get_redis_connection
+from .scripts import PYTHON_SCRIPTS, run_script
+from .storage import connect
+
+# Fields stored in '<prefix>:<id>:<field>' string keys by per-field layout, other string keys like
+# 'bot_contexts:<id>:lease' are collections of current layout
+LEGACY_FIELDS = {'components': ('type', 'text', 'variable_name', 'target_screen', 'condition', 'start_message',
+                                'stop_message', 'fail_message'),
+                 'screens': ('name',),
+                 'bot_templates': ('name',),
+                 'messages': ('direction', 'text'),
+                 'operators': ('name', 'token'),
+                 'bot_contexts': ('name', 'token', 'bot_template')}
+
+# Fold '<prefix>:<id>:<field>' string keys of ARGV fields into '<prefix>:<id>' hashes
+_FOLD_FIELDS_SCRIPT = """
+local fields = {}
+for _, field in ipairs(ARGV) do
+    fields[field] = true
+end
+local migrated = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('TYPE', key).ok == 'string' then
+        local object_key, field = string.match(key, '^(.-:%d+):([^:]+)$')
+        if object_key and fields[field] then
+            redis.call('HSET', object_key, field, redis.call('GET', key))
+            redis.call('DEL', key)
+            migrated = migrated + 1
+        end
+    end
+end
+return migrated
+"""
+
+
+def _fold_fields(storage, keys, args):
+    """ _FOLD_FIELDS_SCRIPT for embedded storage """
+    migrated = 0
+    fields = set(f if isinstance(f, str) else f.decode() for f in args)
+    for key in keys:
+        key = key if isinstance(key, str) else key.decode()
+        match = re.match(r'^(.*?:\d+):([^:]+)$', key)
+        if storage.type(key) == b'string' and match is not None and match.group(2) in fields:
+            storage.hset(match.group(1), match.group(2), storage.get(key))
+            storage.delete(key)
+            migrated += 1
+    return migrated
+
+
+PYTHON_SCRIPTS[_FOLD_FIELDS_SCRIPT] = _fold_fields
+
+
+def _batches(iterator, size):
+    batch = []
+    for item in iterator:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch) != 0:
+        yield batch
+
+
+def migrate_to_hashes(redis_=None, batch_size=500):
+    """ Convert per-field string keys to hash per object layout in place.
+    Keyspace is streamed with SCAN, every batch is converted atomically on server side.
+    Return count of migrated fields """
+    redis_ = redis_ if redis_ is not None else get_redis_connection()
+    migrated = 0
+    for prefix, fields in LEGACY_FIELDS.items():
+        keys = redis_.scan_iter(match='%s:*:*' % prefix, count=batch_size)
+        for batch in _batches(keys, batch_size):
+            migrated += int(run_script(redis_, _FOLD_FIELDS_SCRIPT, keys=batch, args=fields))
+    # Operator conversations were duplicated in 'operator:<id>:conversations', 'operators:<id>:conversations' is kept
+    for batch in _batches(redis_.scan_iter(match='operator:*:conversations', count=batch_size), batch_size):
+        redis_.delete(*batch)
+    return migrated
+
+
+def add_back_references(redis_=None):
+    """ Set owners references of screens and components stored before templates versioning.
+    Every template is updated with one pipeline, return count of updated objects """
+    redis_ = redis_ if redis_ is not None else get_redis_connection()
+    updated = 0
+    for template_id in redis_.lrange('bot_templates_list', 0, -1):
+        screens = redis_.lrange('bot_templates:%d:screens' % int(template_id), 0, -1)
+        pipeline = redis_.pipeline(transaction=False)
+        for screen_id in screens:
+            pipeline.zrange('screens:%d:components' % int(screen_id), 0, -1)
+        components = pipeline.execute() if len(screens) != 0 else ()
+        pipeline = redis_.pipeline(transaction=True)
+        for screen_id, screen_components in zip(screens, components):
+            pipeline.hset('screens:%d' % int(screen_id), 'bot_template', template_id)
+            for component_id in screen_components:
+                pipeline.hset('components:%d' % int(component_id), 'bot_template', template_id)
+                pipeline.hset('components:%d' % int(component_id), 'screen', screen_id)
+            updated += len(screen_components) + 1
+        pipeline.hincrby('bot_templates:%d' % int(template_id), 'version', 1)
+        pipeline.execute()
+    return updated
+
+
+def add_contexts_indexes(redis_=None):
+    """ Build reverse indexes of bot contexts for templates and operators stored before them.
+    Return count of indexed references """
+    redis_ = redis_ if redis_ is not None else get_redis_connection()
+    contexts = redis_.lrange('bot_contexts_list', 0, -1)
+    pipeline = redis_.pipeline(transaction=False)
+    for context_id in contexts:
+        pipeline.hget('bot_contexts:%d' % int(context_id), 'bot_template')
+        pipeline.lrange('bot_contexts:%d:operators' % int(context_id), 0, -1)
+    results = pipeline.execute() if len(contexts) != 0 else ()
+    indexed = 0
+    pipeline = redis_.pipeline(transaction=True)
+    for context_id, template_id, operators in zip(contexts, results[::2], results[1::2]):
+        if template_id is not None:
+            pipeline.sadd('bot_templates:%d:contexts' % int(template_id), context_id)
+            indexed += 1
+        for operator_id in operators:
+            pipeline.sadd('operators:%d:contexts' % int(operator_id), context_id)
+            indexed += 1
+    if indexed != 0:
+        pipeline.execute()
+    return indexed
+
+
+def chats_to_sorted_sets(redis_=None):
+    """ Convert bot contexts chats lists to sorted sets by last activity, duplicates are dropped.
+    Activity of converted chats is unknown, they get zero score. Return count of converted contexts """
+    redis_ = redis_ if redis_ is not None else get_redis_connection()
+    converted = 0
+    for context_id in redis_.lrange('bot_contexts_list', 0, -1):
+        key = 'bot_contexts:%d:chats' % int(context_id)
+        if redis_.type(key) != b'list':
+            continue
+        chats = redis_.lrange(key, 0, -1)
+        pipeline = redis_.pipeline(transaction=True)
+        pipeline.delete(key)
+        for batch in _batches(chats, 1000):
+            pipeline.zadd(key, *(item for chat in batch for item in (chat, 0)))
+        pipeline.execute()
+        converted += 1
+    return converted
+
+
+if __name__ == '__main__':
+    url = sys.argv[1] if len(sys.argv) > 1 else 'redis://127.0.0.1:6379/0'
+    print('Migrated fields: %d' % migrate_to_hashes(connect(url)))
+    print('Updated objects: %d' % add_back_references(connect(url)))
+    print('Indexed contexts references: %d' % add_contexts_indexes(connect(url)))
+    print('Converted chats lists: %d' % chats_to_sorted_sets(connect(url)))
@@ -1,9 +1,11 @@
+import asyncio
 import json
 
-from . import get_redis_connection
+from . import get_redis_connection, get_async_redis_connection
 from .helpers import random_token
-from .operators_server import ConversationStopped, OPERATOR_ACCESS_DENIED, \
-    OPERATOR_ALREADY_CONNECTED, OPERATOR_STATUSES
+from .operators_server import ConversationStopped, OPERATOR_ACCESS_DENIED, OPERATOR_ALREADY_CONNECTED, \
+    OPERATOR_STATUSES, CLIENT_EVENTS, CLIENTS_GROUP, operator_channel, publishing_channel, channel_event, \
+    get_transport, publish, apublish, async_subscription
 
 
 class NotAuthenticated(Exception):
@@ -62,13 +64,15 @@ class OperatorInterface:
     @conversation_check
     def send_message(self, text):
         """ Send message to user """
-        self.redis.publish('message_to_user', json.dumps((self.operator_token, text)))
+        publish(self.redis, publishing_channel('message_to_user', self.operator_token),
+                json.dumps((self.operator_token, text)))
 
     @authentication_check
     @conversation_check
     def stop_conversation(self):
         """ Stop conversation if started """
-        self.redis.publish('conversation_stopped_by_operator', json.dumps(self.operator_token))
+        publish(self.redis, publishing_channel('conversation_stopped_by_operator', self.operator_token),
+                json.dumps(self.operator_token))
         self.conversation_started = False
 
     def __eq__(self, other):
@@ -76,19 +80,25 @@ class OperatorInterface:
 
 
 class OperatorInterfaceDispatcher:
+    CHANNELS = CLIENT_EVENTS  # Global channels
+
     def __init__(self):
         self.redis = get_redis_connection()
-        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self.pubsub = get_transport().subscribe(self.redis, self.CHANNELS, CLIENTS_GROUP)
         self.interfaces = {}  # Operator token to conversation map
         self.authentications = {}
-        self.pubsub.subscribe('authentication_result', 'conversation_started',
-                              'message_to_operator', 'conversation_stopped_by_user')
+
+    @staticmethod
+    def operator_channels(operator_token):
+        return tuple(operator_channel(e, operator_token) for e in CLIENT_EVENTS)
 
     def get_interface(self, operator_token):
-        """ Get interface for given operator """
+        """ Get interface for given operator, events of operator are received from its channels """
         if operator_token not in self.interfaces:
             auth_token = random_token()
-            self.redis.publish('authentication', json.dumps((operator_token, auth_token)))
+            self.pubsub.subscribe(*self.operator_channels(operator_token))
+            publish(self.redis, publishing_channel('authentication', operator_token),
+                    json.dumps((operator_token, auth_token)))
             interface = OperatorInterface(operator_token)
             self.authentications[auth_token] = interface
             self.interfaces[operator_token] = interface
@@ -96,7 +106,9 @@ class OperatorInterfaceDispatcher:
 
     def release_interface(self, interface):
         """ Release interface to pool """
-        self.redis.publish('disconnected', json.dumps(interface.operator_token))
+        publish(self.redis, publishing_channel('disconnected', interface.operator_token),
+                json.dumps(interface.operator_token))
+        self.pubsub.unsubscribe(*self.operator_channels(interface.operator_token))
         del self.interfaces[interface.operator_token]
 
     def update(self):
@@ -105,26 +117,94 @@ class OperatorInterfaceDispatcher:
             message = self.pubsub.get_message()
             if message is not None:
                 if message['type'] == 'message':
-                    channel = message['channel'].decode()
-                    message = json.loads(message['data'].decode())
-                    # Get authentication result
-                    if channel == 'authentication_result':
-                        token, result = message
-                        if token in self.authentications:
-                            if result in OPERATOR_STATUSES:
-                                self.authentications[token].authentication = result
-                                del self.authentications[token]
-                    # Conversation started by user
-                    elif channel == 'conversation_started':
-                        # for interface in self.interfaces:
-                        if message in self.interfaces:
-                            self.interfaces[message].conversation_started = True
-                    # Conversation stopped by user
-                    elif channel == 'conversation_stopped_by_user':
-                        if message in self.interfaces:
-                            self.interfaces[message].conversation_started = False
-                    # Get message from user
-                    elif channel == 'message_to_operator':
-                        operator_token, text = message
-                        if operator_token in self.interfaces:
-                            self.interfaces[operator_token].incoming_messages.append(text)
+                    self.handle_message(channel_event(message['channel'].decode()),
+                                        json.loads(message['data'].decode()))
+
+    def handle_message(self, channel, message):
+        """ Process message from channel """
+        # Get authentication result
+        if channel == 'authentication_result':
+            token, result = message
+            if token in self.authentications:
+                if result in OPERATOR_STATUSES:
+                    self.authentications[token].authentication = result
+                    del self.authentications[token]
+        # Conversation started by user
+        elif channel == 'conversation_started':
+            # for interface in self.interfaces:
+            if message in self.interfaces:
+                self.interfaces[message].conversation_started = True
+        # Conversation stopped by user
+        elif channel == 'conversation_stopped_by_user':
+            if message in self.interfaces:
+                self.interfaces[message].conversation_started = False
+        # Get message from user
+        elif channel == 'message_to_operator':
+            operator_token, text = message
+            if operator_token in self.interfaces:
+                self.interfaces[operator_token].incoming_messages.append(text)
+
+
+class AsyncOperatorInterface(OperatorInterface):
+    """ OperatorInterface for asyncio """
+
+    @authentication_check
+    @conversation_check
+    async def asend_message(self, text):
+        """ Send message to user """
+        await apublish(self.redis, publishing_channel('message_to_user', self.operator_token),
+                       json.dumps((self.operator_token, text)))
+
+    @authentication_check
+    @conversation_check
+    async def astop_conversation(self):
+        """ Stop conversation if started """
+        self.conversation_started = False
+        await apublish(self.redis, publishing_channel('conversation_stopped_by_operator', self.operator_token),
+                       json.dumps(self.operator_token))
+
+
+class AsyncOperatorInterfaceDispatcher(OperatorInterfaceDispatcher):
+    """ OperatorInterfaceDispatcher for asyncio, messages are handled by listen() task as they arrive """
+
+    def __init__(self):
+        self.redis = get_async_redis_connection()
+        self.interfaces = {}
+        self.authentications = {}
+        self.pubsub = None  # Subscription of listen() task, channels of new interfaces are subscribed to it
+
+    async def aget_interface(self, operator_token):
+        """ Get interface for given operator """
+        if operator_token not in self.interfaces:
+            auth_token = random_token()
+            interface = AsyncOperatorInterface(operator_token, self.redis)
+            self.authentications[auth_token] = interface
+            self.interfaces[operator_token] = interface
+            if self.pubsub is not None:
+                await self.pubsub.subscribe(self.adispatch, self.operator_channels(operator_token))
+            await apublish(self.redis, publishing_channel('authentication', operator_token),
+                           json.dumps((operator_token, auth_token)))
+            return interface
+
+    async def arelease_interface(self, interface):
+        """ Release interface to pool """
+        del self.interfaces[interface.operator_token]
+        await apublish(self.redis, publishing_channel('disconnected', interface.operator_token),
+                       json.dumps(interface.operator_token))
+        if self.pubsub is not None:
+            await self.pubsub.unsubscribe(self.adispatch, self.operator_channels(interface.operator_token))
+
+    async def listen(self):
+        """ Handle messages until cancelled, they are received by subscription of current transport """
+        self.pubsub = pubsub = async_subscription(CLIENTS_GROUP)
+        channels = self.CHANNELS + tuple(c for t in self.interfaces for c in self.operator_channels(t))
+        try:
+            await pubsub.subscribe(self.adispatch, channels)
+            await asyncio.get_event_loop().create_future()
+        finally:
+            self.pubsub = None
+            await pubsub.unsubscribe(self.adispatch, self.CHANNELS + tuple(c for t in self.interfaces
+                                                                           for c in self.operator_channels(t)))
+
+    async def adispatch(self, channel, message):
+        self.handle_message(channel_event(channel), message)
@@ -1,14 +1,17 @@
+import asyncio
 import json
 import random
+import threading
 import time
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from datetime import datetime
 from logging import getLogger
 
 from telegram_bot_vm.actions import BaseAction
 
-from . import get_redis_connection
-from .helpers import random_token, StoredObject
+from . import get_redis_connection, get_async_redis_connection
+from .helpers import random_token, StoredObject, get_storage, execute_recorded
+from .transport import PubSubTransport, StreamTransport
 
 OPERATOR_ALREADY_CONNECTED = 0
 OPERATOR_ACCESS_DENIED = 1
@@ -16,35 +19,107 @@ OPERATOR_ACCESS_GRANTED = 2
 
 OPERATOR_STATUSES = (OPERATOR_ALREADY_CONNECTED, OPERATOR_ACCESS_DENIED, OPERATOR_ACCESS_GRANTED)
 
+# Events of operator are published to '<event>:<operator token>' channels, bots and operator clients subscribe
+# to channels of their operators only. Global '<event>' channels are still received, while legacy channels are
+# enabled events are published to them for processes not updated yet
+BOT_EVENTS = ('authentication', 'disconnected', 'conversation_stopped_by_operator', 'message_to_user')
+CLIENT_EVENTS = ('authentication_result', 'conversation_started', 'message_to_operator',
+                 'conversation_stopped_by_user')
+
+# Consumer group of operator clients in stream of events of operator, so events published while client of
+# operator is disconnected are received by its next client
+CLIENTS_GROUP = 'operator_clients'
+
+legacy_channels = False
+transport = PubSubTransport()  # See transport module
+
 logger = getLogger('Operators server')
 
 
+def set_legacy_channels(enabled):
+    """ Publish events to global channels, it is enabled while processes with global channels are running """
+    global legacy_channels
+    legacy_channels = enabled
+
+
+def operator_channel(event, operator_token):
+    """ Return channel of event of operator """
+    return '%s:%s' % (event, operator_token)
+
+
+def publishing_channel(event, operator_token):
+    """ Return channel for publishing event of operator """
+    return event if legacy_channels else operator_channel(event, operator_token)
+
+
+def channel_event(channel):
+    """ Return event of global or operator channel """
+    return channel.split(':', 1)[0]
+
+
+def set_transport(transport_):
+    """ Deliver operator events by transport_, all processes of deployment must use the same transport.
+    With streams_transport() events of global legacy channels are published by pub/sub and not received """
+    global transport
+    transport = transport_
+
+
+def get_transport():
+    return transport
+
+
+def operator_stream(channel):
+    """ Return stream of recipients of operator channel for StreamTransport, global channels are not streamed """
+    event, _, operator_token = channel.partition(':')
+    if operator_token == '':
+        return None
+    return 'operator_events:%s:%s' % (operator_token, 'bots' if event in BOT_EVENTS else 'clients')
+
+
+def streams_transport(**kwargs):
+    """ Return StreamTransport of operator channels """
+    return StreamTransport(operator_stream, **kwargs)
+
+
+def async_subscription(group=None):
+    """ Return subscription of async dispatcher for current transport: AsyncSharedPubSub of process
+    or own AsyncStreamSubscription with group """
+    if isinstance(transport, PubSubTransport):
+        return get_async_pubsub()
+    return transport.asubscribe(get_async_redis_connection(), group)
+
+
+def publish(redis_, channel, data):
+    transport.publish(redis_, channel, data)
+
+
+async def apublish(redis_, channel, data):
+    await transport.apublish(redis_, channel, data)
+
+
 class Message(StoredObject):
     MNEMONIC = 'message'
+    PREFIX = 'messages'
 
     def init(self, direction, text):
         self.direction = direction
         self.text = text
 
-    def clean_up(self):
-        self.redis.delete('messages:%d:direction' % self.id)
-        self.redis.delete('messages:%d:text' % self.id)
-
     @property
     def direction(self):
-        return int(self.redis.get('messages:%d:direction' % self.id))
+        return int(self.get_field('direction'))
 
     @direction.setter
     def direction(self, direction):
-        self.redis.set('messages:%d:direction' % self.id, direction)
+        self.set_field('direction', direction)
 
     @property
     def text(self):
-        return self.redis.get('messages:%d:text' % self.id).decode()
+        return self.get_field('text').decode()
 
     @text.setter
     def text(self, text):
-        self.redis.set('messages:%d:text' % self.id, text)
+        self.set_field('text', text)
 
 
 class ConversationStopped(Exception):
@@ -63,54 +138,92 @@ def conversation_check(func):
 
 class Conversation(StoredObject):
     MNEMONIC = 'conversation'
+    PREFIX = 'conversations'
+    COLLECTIONS = ('messages',)
+    CHILDREN = {'messages': Message}
+    IDENTITY_MAPPED = False  # Holds runtime state of dialog
 
-    def __init__(self, id_, redis_=None):
-        super().__init__(id_, redis_)
+    def __init__(self, id_, redis_=None, check=True):
+        super().__init__(id_, redis_, check)
         self.stopped = False
-        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
         self.incoming_messages = []
         self.operator = None
+        self.restored = False  # Conversation is restored after restart and waits for its operator
+        self.vm_context = None  # Context of chat in conversation, messages of operator are pushed to it
 
     def init(self, operator):
         self.operator = operator
-        self.redis.publish('conversation_started', json.dumps(operator.token))
-        self.redis.rpush('operators:%s:conversations' % operator.id, self.id)
+        publish(self.redis, publishing_channel('conversation_started', operator.token), json.dumps(operator.token))
+        self.redis.rpush('operators:%d:conversations' % operator.id, self.id)
         logger.info('Conversation started with operator %s' % operator.token)
 
     def clean_up(self):
         for message in self.messages.values():
             message.delete()
-        self.redis.delete('conversations:%d:messages' % self.id)
 
     @conversation_check
     def send_message(self, text):
         message = Message.create(1, text)
         self.redis.zadd('conversations:%d:messages' % self.id, message.id, time.time())
-        self.redis.publish('message_to_operator', json.dumps((self.operator.token, text)))
+        publish(self.redis, publishing_channel('message_to_operator', self.operator.token),
+                json.dumps((self.operator.token, text)))
         logger.info('Message %s received from user %s' % (text, self.operator.token))
 
     @conversation_check
     def receive_messages(self):
-        for text in self.incoming_messages:
+        # Queue is taken first, messages added by dispatcher listener meanwhile are received next time
+        incoming_messages, self.incoming_messages = self.incoming_messages, []
+        for text in incoming_messages:
             message = Message.create(0, text)
             self.redis.zadd('conversations:%d:messages' % self.id, message.id, time.time())
             logger.info('Message %s received from operator %s' % (text, self.operator.token))
+        return incoming_messages
+
+    @conversation_check
+    def stop(self):
+        publish(self.redis, publishing_channel('conversation_stopped_by_user', self.operator.token),
+                json.dumps(self.operator.token))
+        self.stopped = True
+        self.incoming_messages = []
+
+    @conversation_check
+    async def asend_message(self, text):
+        """ Async send_message() """
+        message = await Message.acreate(1, text)
+        redis_ = get_async_redis_connection()
+        await execute_recorded(redis_, (('zadd', ('conversations:%d:messages' % self.id, message.id, time.time())),))
+        await apublish(redis_, publishing_channel('message_to_operator', self.operator.token),
+                       json.dumps((self.operator.token, text)))
+        logger.info('Message %s received from user %s' % (text, self.operator.token))
+
+    @conversation_check
+    async def areceive_messages(self):
+        """ Async receive_messages() """
         incoming_messages = self.incoming_messages
         self.incoming_messages = []
+        messages = await Message.acreate_many((0, text) for text in incoming_messages)
+        await execute_recorded(get_async_redis_connection(),
+                               tuple(('zadd', ('conversations:%d:messages' % self.id, m.id, time.time()))
+                                     for m in messages))
         return incoming_messages
 
     @conversation_check
-    def stop(self):
-        self.redis.publish('conversation_stopped_by_user', json.dumps(self.operator.token))
+    async def astop(self):
+        """ Async stop() """
         self.stopped = True
         self.incoming_messages = []
+        await apublish(get_async_redis_connection(), publishing_channel('conversation_stopped_by_user',
+                                                                        self.operator.token),
+                       json.dumps(self.operator.token))
 
     @property
     def messages(self):
         """ return messages OrderedDict """
         messages = OrderedDict()
-        for message, time_ in self.redis.zrange('conversations:%d:messages' % self.id, 0,-1,withscores=True):
-            messages[datetime.fromtimestamp(float(time_))] = Message(int(message))
+        messages_with_times = self.redis.zrange('conversations:%d:messages' % self.id, 0, -1, withscores=True)
+        loaded_messages = Message.load_many(m for m, _ in messages_with_times)
+        for (_, time_), message in zip(messages_with_times, loaded_messages):
+            messages[datetime.fromtimestamp(float(time_))] = message
         return messages
 
 
@@ -146,6 +259,7 @@ class OperatorDialogAction(BaseAction):
         else:
             conversation = vm_context.operators_dispatcher.get_conversation()
             if conversation is not None:
+                conversation.vm_context = vm_context
                 vm_context.conversation = conversation
                 return self.start_message,
             else:
@@ -155,12 +269,14 @@ class OperatorDialogAction(BaseAction):
 
 class Operator(StoredObject):
     MNEMONIC = 'operator'
+    PREFIX = 'operators'
+    COLLECTIONS = ('conversations', 'contexts')  # Contexts is reverse index of bot contexts with operator
+    CHILDREN = {'conversations': Conversation}
+    LIST_KEY = 'operators_list'
 
     def new_conversation(self):
         """ return new Conversation object for operator """
-        conversation = Conversation.create(self)
-        self.redis.rpush('operator:%d:conversations' % self.id, conversation.id)
-        return conversation
+        return Conversation.create(self)
 
     def regenerate_token(self):
         """ Regenerate operator token """
@@ -169,24 +285,24 @@ class Operator(StoredObject):
     @property
     def token(self):
         """ return current token """
-        return self.redis.get('operators:%d:token' % self.id).decode()
+        return self.get_field('token').decode()
 
     @token.setter
     def token(self, token):
-        self.redis.set('operators:%d:token' % self.id, token)
+        self.set_field('token', token)
 
     @property
     def name(self):
-        return self.redis.get('operators:%d:name' % self.id).decode()
+        return self.get_field('name').decode()
 
     @name.setter
     def name(self, name):
-        self.redis.set('operators:%d:name' % self.id, name)
+        self.set_field('name', name)
 
     @property
     def conversations(self):
-        conversations = self.redis.lrange('operator:%d:conversations' % self.id, 0, -1)
-        return tuple(Conversation(int(c)) for c in conversations)
+        conversations = self.redis.lrange('operators:%d:conversations' % self.id, 0, -1)
+        return Conversation.load_many(conversations)
 
     def init(self, name):
         self.name = name
@@ -196,26 +312,237 @@ class Operator(StoredObject):
     def clean_up(self):
         for conversation in self.conversations:
             conversation.delete()
-        self.redis.delete('operators:%d:conversations' % self.id)
-        self.redis.delete('operators:%d:name' % self.id)
-        self.redis.delete('operators:%d:token' % self.id)
         self.redis.lrem('operators_list', self.id)
 
     @classmethod
     def list(cls):
-        redis_ = get_redis_connection()
+        redis_ = get_storage()
         operators = redis_.lrange('operators_list', 0, -1)
-        return tuple(cls(int(o)) for o in operators)
+        return cls.load_many(operators, redis_)
+
+
+LISTEN_TIMEOUT = 1  # Seconds of waiting for message by listener before checking it is stopped
+
+
+class SharedPubSub:
+    """ One subscription to operators channels shared by dispatchers of all bots of process,
+    every dispatcher receives messages of global channels and channels it is subscribed to """
+
+    def __init__(self, redis_=None):
+        self.redis = redis_ if redis_ is not None else get_redis_connection()
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(*BOT_EVENTS)
+        self.lock = threading.RLock()
+        self.subscribers = []
+        self.routes = {}  # Channel to subscribers of channel map
+        self.listener = None
+        self.stopped = threading.Event()
+
+    def subscribe(self, channels=()):
+        """ Return new subscriber of channels with get_message() and close() of redis PubSub """
+        subscriber = _SharedSubscriber(self, channels)
+        with self.lock:
+            self.subscribers.append(subscriber)
+            new = [c for c in subscriber.channels if c not in self.routes]
+            for channel in subscriber.channels:
+                self.routes.setdefault(channel, []).append(subscriber)
+            if len(new) != 0:
+                self.pubsub.subscribe(*new)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+                unused = []
+                for channel in subscriber.channels:
+                    self.routes[channel].remove(subscriber)
+                    if len(self.routes[channel]) == 0:
+                        del self.routes[channel]
+                        unused.append(channel)
+                if len(unused) != 0:
+                    self.pubsub.unsubscribe(*unused)
+
+    def read(self):
+        """ Copy received messages to queues of subscribers, messages are read by listener if it is started """
+        if self.listener is None:
+            with self.lock:
+                message = self.pubsub.get_message()
+                while message is not None:
+                    self._deliver(message)
+                    message = self.pubsub.get_message()
+
+    def _deliver(self, message):
+        channel = message['channel'].decode()
+        with self.lock:
+            subscribers = tuple(self.subscribers if channel in BOT_EVENTS else self.routes.get(channel, ()))
+        for subscriber in subscribers:
+            if subscriber.handler is not None:
+                try:
+                    subscriber.handler(message)
+                except Exception:
+                    logger.exception('Operators message %s is not handled' % message)
+            else:
+                subscriber.messages.append(message)
+
+    def start(self):
+        """ Deliver messages by background thread as they arrive, subscribers with handler receive them
+        in it. Listener is started once """
+        with self.lock:
+            if self.listener is not None:
+                return
+            self.listener = threading.Thread(target=self._listen, name='Operators listener', daemon=True)
+        self.listener.start()
+
+    def _listen(self):
+        while not self.stopped.is_set():
+            try:
+                message = self.pubsub.get_message(timeout=LISTEN_TIMEOUT)
+            except Exception:
+                logger.exception('Operators messages are not received')
+                self.stopped.wait(LISTEN_TIMEOUT)
+                continue
+            if message is not None:
+                self._deliver(message)
+
+    def close(self):
+        self.stopped.set()
+        if self.listener is not None:
+            self.listener.join()
+        self.pubsub.close()
+
+
+class _SharedSubscriber:
+    def __init__(self, shared, channels):
+        self.shared = shared
+        self.channels = tuple(channels)
+        self.messages = deque()
+        self.handler = None  # Function called with every message by listener of shared subscription
+
+    def get_message(self):
+        if len(self.messages) == 0:
+            self.shared.read()
+        if len(self.messages) != 0:
+            return self.messages.popleft()
+
+    def close(self):
+        self.shared.unsubscribe(self)
+        self.messages.clear()
+
+
+class AsyncSharedPubSub:
+    """ One receiver of async connection shared by async dispatchers of process. aioredis keeps one receiving
+    channel per subscribed name for whole connection pool, so dispatchers can not subscribe the same channels
+    with own receivers. Subscriptions are counted per channel, messages are passed to every handler of channel """
+
+    def __init__(self, redis_):
+        from aioredis.pubsub import Receiver
+        self.redis = redis_
+        self.receiver = Receiver(on_close=lambda channel, exc=None: None)  # Kept after unsubscribing all channels
+        self.routes = {}  # Channel to handlers map
+        self.reader = None
+
+    async def subscribe(self, handler, channels):
+        """ Call await handler(channel, data) with decoded data of every message of channels """
+        new = []
+        for channel in channels:
+            handlers = self.routes.setdefault(channel, [])
+            if len(handlers) == 0:
+                new.append(channel)
+            handlers.append(handler)
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.ensure_future(self._read())
+        if len(new) != 0:
+            await self.redis.subscribe(*(self.receiver.channel(c) for c in new))
+
+    async def unsubscribe(self, handler, channels):
+        unused = []
+        for channel in channels:
+            handlers = self.routes.get(channel, [])
+            if handler in handlers:
+                handlers.remove(handler)
+                if len(handlers) == 0:
+                    del self.routes[channel]
+                    unused.append(channel)
+        if len(unused) != 0:
+            await self.redis.unsubscribe(*unused)
+
+    async def _read(self):
+        async for channel, message in self.receiver.iter(decoder=json.loads):
+            name = channel.name.decode()
+            for handler in tuple(self.routes.get(name, ())):
+                try:
+                    await handler(name, message)
+                except Exception:
+                    logger.exception('Operators message %s is not handled' % message)
+
+
+async_pubsub = None
+
+
+def get_async_pubsub():
+    """ Return AsyncSharedPubSub of current async connection """
+    global async_pubsub
+    redis_ = get_async_redis_connection()
+    if async_pubsub is None or async_pubsub.redis is not redis_:
+        async_pubsub = AsyncSharedPubSub(redis_)
+    return async_pubsub
 
 
 class OperatorsDispatcher:
-    def __init__(self, operators):
+    CHANNELS = BOT_EVENTS  # Global channels
+
+    def __init__(self, operators, pubsub=None, group=None):
+        """ Messages are received by own subscription of transport or by subscriber of SharedPubSub pubsub,
+        pubsub is used with pub/sub transport only. Subscriptions with the same group share events of streams """
         self.operators = {o.token: o for o in operators}  # Operator token to operator map
         self.redis = get_redis_connection()
-        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
-        self.pubsub.subscribe('authentication', 'disconnected', 'conversation_stopped_by_operator', 'message_to_user')
+        if pubsub is not None and isinstance(transport, PubSubTransport):
+            self.pubsub = pubsub.subscribe(self.operators_channels)
+        else:
+            self.pubsub = transport.subscribe(self.redis, self.CHANNELS + self.operators_channels, group)
         self.available_operators = {}  # Operator token to available operator map
         self.conversations = {}  # Operator token to conversation map
+        self.lock = threading.RLock()  # Messages are handled by listener thread while VM gets conversations
+        self.listening = False
+        self.listener = None
+        self.stopped = threading.Event()
+        self.push = None
+
+    @property
+    def operators_channels(self):
+        return tuple(operator_channel(e, t) for t in self.operators for e in BOT_EVENTS)
+
+    def start_listener(self, push=None):
+        """ Handle messages in background as they arrive, update() does nothing after it.
+        push(conversation) is called when message of operator is received to deliver it to chat at once """
+        self.push = push
+        self.listening = True
+        if isinstance(self.pubsub, _SharedSubscriber):
+            self.pubsub.handler = self.dispatch
+            self.pubsub.shared.start()
+        else:
+            self.listener = threading.Thread(target=self._listen, name='Operators dispatcher', daemon=True)
+            self.listener.start()
+
+    def _listen(self):
+        try:
+            while not self.stopped.is_set():
+                try:
+                    message = self.pubsub.get_message(timeout=LISTEN_TIMEOUT)
+                    if message is not None:
+                        self.dispatch(message)
+                except Exception:
+                    logger.exception('Operators message is not handled')
+                    self.stopped.wait(LISTEN_TIMEOUT)
+        finally:
+            self.pubsub.close()
+
+    def close(self):
+        """ Stop receiving messages, subscription of listener is closed by it without waiting """
+        self.stopped.set()
+        if self.listener is None:
+            self.pubsub.close()
 
     def _get_operator(self):
         """ return free operator """
@@ -227,49 +554,128 @@ class OperatorsDispatcher:
 
     def get_conversation(self):
         """ return conversation with free operator """
+        with self.lock:
+            operator = self._get_operator()
+            if operator is not None:
+                conversation = operator.new_conversation()
+                self.conversations[operator.token] = conversation
+                return conversation
+
+    def update(self):
+        """ Update information about available operators and receive messages, messages are handled
+        by listener if it is started """
+        if self.listening:
+            return
+        message = self.pubsub.get_message()
+        while message is not None:  # Read all redis queue
+            self.dispatch(message)
+            message = self.pubsub.get_message()
+        with self.lock:
+            self.clean_up_conversations()
+
+    def dispatch(self, message):
+        """ Handle pub/sub message, message of operator is pushed to chat if listener is started with push """
+        if message['type'] != 'message':
+            return
+        channel, data = channel_event(message['channel'].decode()), json.loads(message['data'].decode())
+        with self.lock:
+            reply = self.handle_message(channel, data)
+            if self.listening:
+                self.clean_up_conversations()
+            conversation = self.conversations.get(data[0]) if channel == 'message_to_user' else None
+        if reply is not None:
+            publish(self.redis, *reply)
+        if conversation is not None and self.push is not None:
+            try:
+                self.push(conversation)
+            except Exception:
+                logger.exception('Messages of operator %s are not pushed' % data[0])
+
+    def handle_message(self, channel, message):
+        """ Process message from channel, return (channel, data) reply to publish or None """
+        logger.info('Message received from channel %s: %s' % (channel, message))
+        if channel == 'authentication':
+            operator_token, auth_token = message
+            if operator_token in self.operators:
+                if operator_token in self.available_operators:
+                    authenticated = OPERATOR_ALREADY_CONNECTED
+                else:
+                    self.available_operators[operator_token] = self.operators.get(operator_token)
+                    authenticated = OPERATOR_ACCESS_GRANTED
+            else:
+                authenticated = OPERATOR_ACCESS_DENIED
+            logger.info('Operator %s authentication status sent: %d' % (operator_token, authenticated))
+            return (publishing_channel('authentication_result', operator_token),
+                    json.dumps((auth_token, authenticated)))
+        elif channel == 'disconnected':
+            if message in self.available_operators:
+                del self.available_operators[message]
+                logger.info('Operator %s disconnected' % message)
+        elif channel == 'message_to_user':
+            operator_token, text = message
+            if operator_token in self.conversations:
+                self.conversations[operator_token].incoming_messages.append(text)
+        elif channel == 'conversation_stopped_by_operator':
+            if message in self.conversations:
+                self.conversations[message].stopped = True
+                logger.info('Conversation stopped by operator %s' % message)
+
+    def restore_conversation(self, conversation_id, operator_id):
+        """ Return conversation of chat state saved before restart, None if it can not continue.
+        Restored conversation waits for its operator to reconnect """
+        operators = {o.id: o for o in self.operators.values()}
+        with self.lock:
+            if operator_id not in operators or operators[operator_id].token in self.conversations or \
+                    not Conversation.exists(conversation_id):
+                return None
+            conversation = Conversation(conversation_id, check=False)
+            conversation.operator = operators[operator_id]
+            conversation.restored = conversation.operator.token not in self.available_operators
+            self.conversations[conversation.operator.token] = conversation
+            return conversation
+
+    def clean_up_conversations(self):
+        """ Forget stopped conversations """
+        for operator_token, conversation in self.conversations.copy().items():
+            if operator_token in self.available_operators:
+                conversation.restored = False
+            elif not conversation.restored:
+                conversation.stopped = True
+            if conversation.stopped:
+                del self.conversations[operator_token]
+
+
+class AsyncOperatorsDispatcher(OperatorsDispatcher):
+    """ OperatorsDispatcher for asyncio, messages are handled by listen() task as they arrive """
+
+    def __init__(self, operators, group=None):
+        self.operators = {o.token: o for o in operators}
+        self.group = group  # Consumer group of streams transport, see OperatorsDispatcher
+        self.redis = get_async_redis_connection()
+        self.available_operators = {}
+        self.conversations = {}
+        self.lock = threading.RLock()
+
+    async def aget_conversation(self):
+        """ Async get_conversation() """
         operator = self._get_operator()
         if operator is not None:
-            conversation = operator.new_conversation()
+            conversation = await Conversation.acreate(operator)
             self.conversations[operator.token] = conversation
             return conversation
 
-    def update(self):
-        """ Update information about available operators and receive messages """
-
-        for _ in range(25):  # Read all redis queue
-            message = self.pubsub.get_message()
-            if message is not None:
-                if message['type'] == 'message':
-                    channel = message['channel'].decode()
-                    message = json.loads(message['data'].decode())
-                    logger.info('Message received from channel %s: %s' % (channel, message))
-                    if channel == 'authentication':
-                        operator_token, auth_token = message
-                        if operator_token in self.operators:
-                            if operator_token in self.available_operators:
-                                authenticated = OPERATOR_ALREADY_CONNECTED
-                            else:
-                                self.available_operators[operator_token] = self.operators.get(operator_token)
-                                authenticated = OPERATOR_ACCESS_GRANTED
-                        else:
-                            authenticated = OPERATOR_ACCESS_DENIED
-                        self.redis.publish('authentication_result', json.dumps((auth_token, authenticated)))
-                        logger.info('Operator %s authentication status sent: %d' % (operator_token, authenticated))
-                    elif channel == 'disconnected':
-                        if message in self.available_operators:
-                            del self.available_operators[message]
-                            logger.info('Operator %s disconnected' % message)
-                    elif channel == 'message_to_user':
-                        operator_token, text = message
-                        if operator_token in self.conversations:
-                            self.conversations[operator_token].incoming_messages.append(text)
-                    elif channel == 'conversation_stopped_by_operator':
-                        if message in self.conversations:
-                            self.conversations[message].stopped = True
-                            logger.info('Conversation stopped by operator %s' % message)
-            # Cleaning up stopped conversations
-            for operator_token, conversation in self.conversations.copy().items():
-                if operator_token not in self.available_operators:
-                    conversation.stopped = True
-                if conversation.stopped:
-                    del self.conversations[operator_token]
+    async def listen(self):
+        """ Handle messages until cancelled, they are received by subscription of current transport """
+        pubsub = async_subscription(self.group)
+        channels = self.CHANNELS + self.operators_channels
+        await pubsub.subscribe(self.adispatch, channels)
+        try:
+            await asyncio.get_event_loop().create_future()
+        finally:
+            await pubsub.unsubscribe(self.adispatch, channels)
+
+    async def adispatch(self, channel, message):
+        reply = self.handle_message(channel_event(channel), message)
+        if reply is not None:
+            await apublish(self.redis, *reply)
+        self.clean_up_conversations()
@@ -0,0 +1,125 @@
+""" Peephole optimization of compiled programs (see constructor.link_segments for program format) """
+
+
+def _is_forward(instruction):
+    return instruction[0] == 'Forward'
+
+
+def _is_unconditional(instruction):
+    """ Forward without condition, ForwardToScreen without condition regex is unconditional too """
+    return _is_forward(instruction) and (len(instruction) < 4 or not instruction[3])
+
+
+def thread_jumps(program):
+    """ Retarget forwards pointing to unconditional forwards to final targets, return count of changed forwards """
+    threaded = 0
+    for instruction in program:
+        if not _is_forward(instruction):
+            continue
+        target = instruction[1]
+        visited = set()
+        while target < len(program) and _is_unconditional(program[target]) and target not in visited:
+            visited.add(target)
+            target = program[target][1]
+        if target != instruction[1]:
+            instruction[1] = target
+            threaded += 1
+    return threaded
+
+
+def reachable_positions(program):
+    """ Return set of positions reachable from program start """
+    reachable = set()
+    stack = [0]
+    while len(stack) != 0:
+        position = stack.pop()
+        if position >= len(program) or position in reachable:
+            continue
+        reachable.add(position)
+        instruction = program[position]
+        if _is_forward(instruction):
+            stack.append(instruction[1])
+        if not _is_unconditional(instruction):
+            stack.append(position + 1)
+    return reachable
+
+
+def _remove(program, sources, removed):
+    """ Remove positions, forwards to removed positions go to the next kept one """
+    positions = []  # Old position to new position map, end of program included
+    kept = 0
+    for position in range(len(program) + 1):
+        positions.append(kept)
+        if position not in removed:
+            kept += 1
+    new_program = []
+    new_sources = []
+    for position, instruction in enumerate(program):
+        if position not in removed:
+            if _is_forward(instruction):
+                instruction = [instruction[0], positions[instruction[1]]] + instruction[2:]
+            new_program.append(instruction)
+            new_sources.append(sources[position])
+    return new_program, new_sources
+
+
+def _forwards_to_next(program, removed):
+    """ Return positions of forwards going to the next kept position, they do nothing """
+    found = set()
+    next_kept = len(program)
+    for position in range(len(program) - 1, -1, -1):
+        if position in removed:
+            continue
+        instruction = program[position]
+        target = instruction[1] if _is_forward(instruction) else None
+        if target is not None and position < target:
+            while target < len(program) and target in removed | found:
+                target += 1
+            if target == next_kept:
+                found.add(position)
+                continue
+        next_kept = position
+    return found
+
+
+def _merge_messages(program, sources):
+    """ Join adjacent messages if the second one is not a forward target, return count of merged messages """
+    targets = set(i[1] for i in program if _is_forward(i))
+    merged = set()
+    for position in range(len(program) - 1, 0, -1):
+        if program[position][0] == 'SendMessage' and program[position - 1][0] == 'SendMessage' and \
+                position not in targets:
+            program[position - 1] = ['SendMessage', '%s\n%s' % (program[position - 1][1], program[position][1])]
+            merged.add(position)
+    return merged
+
+
+def optimize(program, sources=None, merge_messages=False):
+    """ Return (program, sources, statistics) for optimized copy of program.
+    Jumps are threaded, unreachable instructions and forwards to the next position are removed.
+    If merge_messages is True adjacent messages are sent as one message """
+    program = [list(i) for i in program]
+    sources = list(sources) if sources is not None else [None] * len(program)
+    statistics = {'instructions_before': len(program),
+                  'threaded_jumps': 0,
+                  'removed_unreachable': 0,
+                  'removed_forwards': 0,
+                  'merged_messages': 0}
+    while True:
+        threaded = thread_jumps(program)
+        unreachable = set(range(len(program))) - reachable_positions(program)
+        forwards = _forwards_to_next(program, unreachable)
+        if len(program) != 0 and len(unreachable | forwards) == len(program):
+            forwards.discard(max(forwards))  # Program is never empty
+        statistics['threaded_jumps'] += threaded
+        statistics['removed_unreachable'] += len(unreachable)
+        statistics['removed_forwards'] += len(forwards)
+        if threaded == 0 and len(unreachable) == 0 and len(forwards) == 0:
+            break
+        program, sources = _remove(program, sources, unreachable | forwards)
+    if merge_messages:
+        merged = _merge_messages(program, sources)
+        statistics['merged_messages'] = len(merged)
+        program, sources = _remove(program, sources, merged)
+    statistics['instructions_after'] = len(program)
+    return program, sources, statistics
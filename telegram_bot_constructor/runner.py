@@ -1,15 +1,31 @@
-from . import get_redis_connection
-from . import constructor
+from . import constructor, set_redis_connection, get_redis_connection, get_async_redis_connection
+from .broadcast import Broadcast, BROADCAST_RUNNING, DEFAULT_RATE, DEFAULT_CONCURRENCY
+from .chat_states import ChatStates
 from .operators_server import Operator
-from .operators_server import OperatorsDispatcher
-from .helpers import StoredObject
+from .operators_server import OperatorsDispatcher, SharedPubSub
+from .helpers import StoredObject, get_storage, random_token
+from .statistics import visits_collector, daily_key, hourly_key, users_key, dated_collections
+from .storage import connect, connection_options, connect_options
 from telegram import Bot as TelegramBot
 from telegram_bot_vm.state import BotState
 from telegram_bot_vm.bot import Bot
-from datetime import date
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+from logging import getLogger
+import json
+import threading
 import time
 
+BOOT_CONCURRENCY = 16  # Bots started at the same time by boot_all
+
+logger = getLogger('Runner')
+
 running_bots = {}
+running_programs = {}  # Bot context id to program of running bot with its sources and compilation options
+running_broadcasts = {}  # Broadcast id to (thread, stop event) of broadcast sending in process
+running_webhooks = {}  # Bot context id to webhook server receiving updates of running bot
+running_chat_states = {}  # Bot context id to persistent chats states of running bot
+running_dispatchers = {}  # Bot context id to operators dispatcher of running bot
 
 
 class BotTemplateNotSelected(Exception):
@@ -18,6 +34,11 @@ class BotTemplateNotSelected(Exception):
 
 class BotRunnerContext(StoredObject, BotState):
     MNEMONIC = 'bot_context'
+    PREFIX = 'bot_contexts'
+    # Chats sorted set is scored by last activity, lease is owner of context in supervisor
+    COLLECTIONS = ('operators', 'visits', 'chats', 'broadcasts', 'lease')
+    CHILDREN = {'operators': Operator, 'broadcasts': Broadcast}
+    LIST_KEY = 'bot_contexts_list'
 
     def init(self, name):
         self.bot = None
@@ -27,14 +48,30 @@ class BotRunnerContext(StoredObject, BotState):
     def clean_up(self):
         for operator in self.operators:
             operator.delete()
-        self.redis.delete('bot_contexts:%d:name' % self.id)
-        self.redis.delete('bot_contexts:%d:bot_template' % self.id)
-        self.redis.delete('bot_contexts:%d:token' % self.id)
-        self.redis.delete('bot_contexts:%d:operators' % self.id)
-        self.redis.delete('bot_contexts:%d:visits' % self.id)
-        self.redis.delete('bot_contexts:%d:chats' % self.id)
         self.redis.lrem('bot_contexts_list', self.id)
 
+    @classmethod
+    def cascade_spec(cls):
+        spec = super().cascade_spec()
+        spec['collections'] += list(dated_collections())  # Statistics of retention periods
+        return spec
+
+    def before_delete(self):
+        """ Remove context from reverse indexes of its template and operators """
+        bot_template_id = self.get_field('bot_template')
+        if bot_template_id is not None:
+            self.redis.srem('bot_templates:%d:contexts' % int(bot_template_id), self.id)
+        for operator_id in self.redis.lrange('bot_contexts:%d:operators' % self.id, 0, -1):
+            self.redis.srem('operators:%d:contexts' % int(operator_id), self.id)
+
+    async def abefore_delete(self):
+        redis_ = get_async_redis_connection()
+        bot_template_id = await redis_.hget(self.key, 'bot_template')
+        if bot_template_id is not None:
+            await redis_.srem('bot_templates:%d:contexts' % int(bot_template_id), self.id)
+        for operator_id in await redis_.lrange('bot_contexts:%d:operators' % self.id, 0, -1):
+            await redis_.srem('operators:%d:contexts' % int(operator_id), self.id)
+
     @property
     def running(self):
         return self.bot is not None
@@ -54,94 +91,294 @@ class BotRunnerContext(StoredObject, BotState):
 
     @property
     def name(self):
-        n = self.redis.get('bot_contexts:%d:name' % self.id)
+        n = self.get_field('name')
         if n is not None:
             return n.decode()
 
     @name.setter
     def name(self, name):
-        self.redis.set('bot_contexts:%d:name' % self.id, name)
+        self.set_field('name', name)
 
     @property
     def token(self):
-        t = self.redis.get('bot_contexts:%d:token' % self.id)
+        t = self.get_field('token')
         if t is not None:
             return t.decode()
 
     @token.setter
     def token(self, token):
         TelegramBot._validate_token(token)
-        self.redis.set('bot_contexts:%d:token' % self.id, token)
+        self.set_field('token', token)
+
+    @property
+    def webhook_secret(self):
+        """ Path of bot webhook on webhook server, it is generated on first use """
+        secret = self.get_field('webhook_secret')
+        if secret is None:
+            secret = random_token(32)
+            self.set_field('webhook_secret', secret)
+            return secret
+        return secret.decode()
 
     @property
     def bot_template(self):
-        bot_template_id = self.redis.get('bot_contexts:%d:bot_template' % self.id)
+        bot_template_id = self.get_field('bot_template')
         if bot_template_id is not None:
             return constructor.BotTemplate(int(bot_template_id))
 
     @bot_template.setter
     def bot_template(self, bot_template):
+        old_id = self.get_field('bot_template')
+        if old_id is not None:
+            self.redis.srem('bot_templates:%d:contexts' % int(old_id), self.id)
         if bot_template is None:
-            self.redis.delete('bot_contexts:%d:bot_template' % self.id)
+            self.delete_field('bot_template')
         else:
-            self.redis.set('bot_contexts:%d:bot_template' % self.id, bot_template.id)
+            self.set_field('bot_template', bot_template.id)
+            self.redis.sadd('bot_templates:%d:contexts' % bot_template.id, self.id)
 
     def add_operator(self, operator):
-        if operator not in self.operators:
+        if not self.redis.sismember('operators:%d:contexts' % operator.id, self.id):
             self.redis.rpush('bot_contexts:%d:operators' % self.id, operator.id)
+            self.redis.sadd('operators:%d:contexts' % operator.id, self.id)
         else:
             raise OperatorAlreadyAdded
 
     def delete_operator(self, operator):
         self.redis.lrem('bot_contexts:%d:operators' % self.id, operator.id)
+        self.redis.srem('operators:%d:contexts' % operator.id, self.id)
 
     @property
     def operators(self):
         operators = self.redis.lrange('bot_contexts:%d:operators' % self.id, 0, -1)
-        return tuple(Operator(int(o)) for o in operators)
+        return Operator.load_many(operators)
 
     @classmethod
     def list(cls):
-        redis_ = get_redis_connection()
+        redis_ = get_storage()
         bot_contexts = redis_.lrange('bot_contexts_list', 0, -1)
-        return tuple(cls(int(c)) for c in bot_contexts)
+        return cls.load_many(bot_contexts, redis_)
 
     def get_visits_per_day(self, date_):
-        visits = self.redis.hget('bot_contexts:%d:visits', date_.isoformat())
+        visits = self.redis.hget(daily_key(self.id), date_.isoformat())
         return 0 if visits is None else int(visits)
 
-    def run(self):
+    def get_visits(self, start, end):
+        """ Return ((date, visits), ...) for days from start to end inclusive, with one request """
+        dates = tuple(start + timedelta(days=i) for i in range((end - start).days + 1))
+        if len(dates) == 0:
+            return ()
+        visits = self.redis.hmget(daily_key(self.id), [d.isoformat() for d in dates])
+        return tuple((d, 0 if v is None else int(v)) for d, v in zip(dates, visits))
+
+    def get_visits_per_hour(self, date_):
+        """ Return visits for every hour of day, kept for statistics.HOURS_RETENTION days """
+        visits = self.redis.hgetall(hourly_key(self.id, date_))
+        return tuple(int(visits.get(str(hour).encode(), 0)) for hour in range(24))
+
+    def get_unique_users(self, start, end=None):
+        """ Return estimated count of unique users from start to end days inclusive,
+        kept for statistics.USERS_RETENTION days """
+        end = end if end is not None else start
+        return self.redis.pfcount(*(users_key(self.id, start + timedelta(days=i))
+                                    for i in range((end - start).days + 1)))
+
+    def compile_template(self, optimize=False, merge_messages=False):
+        """ Return program of bot template with its sources and compilation options """
+        return compile_template(self.bot_template, optimize, merge_messages)
+
+    @property
+    def optimization_statistics(self):
+        """ Return statistics of running program optimization, None if it is not optimized """
+        if self.id in running_programs:
+            return running_programs[self.id]['statistics']
+
+    def run(self, optimize=False, merge_messages=False, webhook_server=None, program=None, operators=None,
+            pubsub=None):
+        """ Run bot, template program is optimized if optimize is True (see BotTemplate.compile_optimized).
+        Bot polls telegram for updates, if webhook_server is given updates are received by it.
+        Already compiled program, loaded operators and operators SharedPubSub are passed by boot_all """
         if not self.running:
-            if self.bot_template is not None:
-                actions = self.bot_template.compile()
-                self.bot = Bot(actions, self,
-                               additioanal_properties={'operators_dispatcher': OperatorsDispatcher(self.operators),
-                                                       'bot_context_id': self.id})
-                self.bot.run(self.token)
+            if self.get_field('bot_template') is not None:
+                try:
+                    self._start(optimize, merge_messages, webhook_server, program, operators, pubsub)
+                except Exception:
+                    self._clean_up_start(webhook_server)
+                    raise
             else:
                 raise BotTemplateNotSelected
 
+    def _start(self, optimize, merge_messages, webhook_server, program, operators, pubsub):
+        running_programs[self.id] = program if program is not None else \
+            self.compile_template(optimize, merge_messages)
+        dispatcher = OperatorsDispatcher(operators if operators is not None else self.operators, pubsub,
+                                         group='bot_contexts:%d' % self.id)  # Continues after restart
+        running_dispatchers[self.id] = dispatcher
+        states = ChatStates(self.id, running_programs[self.id]['sources'], dispatcher)
+        running_chat_states[self.id] = states
+        self.bot = Bot(states.track(constructor.build_actions(running_programs[self.id]['program'])), self,
+                       additioanal_properties={'operators_dispatcher': dispatcher, 'bot_context_id': self.id})
+        self.bot.contexts = states.contexts  # Chats continue from states saved before restart
+        states.start()
+        dispatcher.start_listener(self.push_operator_messages)
+        process_update = update_processor(self.bot) if webhook_server is not None else None
+        if process_update is not None:
+            running_webhooks[self.id] = webhook_server
+            webhook_server.add_bot(self.webhook_secret, self.id, self.token, process_update)
+        else:
+            if webhook_server is not None:
+                logger.warning('VM bot of context %d does not accept pushed updates, it polls telegram' % self.id)
+            self.bot.run(self.token)
+        self.resume_broadcasts()
+
+    def _clean_up_start(self, webhook_server):
+        """ Undo partial start of bot failed at any step, so it can be started again """
+        try:
+            self.stop_broadcasts()
+            if running_webhooks.pop(self.id, None) is not None:
+                webhook_server.remove_bot(self.webhook_secret, self.token, delete_webhook=False)
+            elif self.bot is not None:
+                self.bot.stop()
+            states = running_chat_states.pop(self.id, None)
+            if states is not None:
+                states.stopped.set()
+            dispatcher = running_dispatchers.pop(self.id, None)
+            if dispatcher is not None:
+                dispatcher.close()
+        except Exception:
+            logger.exception('Failed start of bot context %d is not cleaned up' % self.id)
+        finally:
+            self.bot = None
+            running_programs.pop(self.id, None)
+
     def stop(self):
         if self.running:
-            self.bot.stop()
+            self.stop_broadcasts()
+            if self.id in running_webhooks:
+                running_webhooks.pop(self.id).remove_bot(self.webhook_secret, self.token)
+            else:
+                self.bot.stop()
+            running_chat_states.pop(self.id).stop()
+            running_dispatchers.pop(self.id).close()
             self.bot = None
+            running_programs.pop(self.id, None)
+
+    def reload(self):
+        """ Install recompiled template program into running bot without restart,
+        every chat continues from the same component. Return False if program is not changed """
+        if not self.running:
+            return False
+        old = running_programs[self.id]
+        new = self.compile_template(old['optimize'], old['merge_messages'])
+        if new['program'] == old['program'] and new['sources'] == old['sources']:
+            return False
+        positions = constructor.remap_positions(old['sources'], new['sources'])
+        states = running_chat_states[self.id]
+        actions = states.track(constructor.build_actions(new['program']))
+        bot = self.bot
+        with states.lock:
+            # Program is replaced with one assignment, chats positions are remapped right after it
+            bot.actions = actions
+            for vm_context in tuple(bot.contexts.values()):
+                if 0 <= vm_context.position < len(positions):
+                    vm_context.position = positions[vm_context.position]
+            states.set_sources(new['sources'])
+        running_programs[self.id] = new
+        return True
+
+    def push_operator_messages(self, conversation, send=None):
+        """ Send received messages of operator to chat of conversation at once, it is called by listener
+        of operators dispatcher. Messages for chat not known by process are delivered by VM on its next step """
+        states = running_chat_states.get(self.id)
+        chat = states.chat_of(conversation.vm_context) if states is not None else None
+        if chat is None or conversation.stopped:
+            return
+        send = send if send is not None else TelegramBot(self.token).send_message
+        for text in conversation.receive_messages():
+            send(chat, text)
 
     def add_chat(self, chat):
-        self.redis.rpush('bot_contexts:%d:chats' % self.id, chat)
+        """ Register chat or update its last activity time """
+        self.redis.zadd('bot_contexts:%d:chats' % self.id, chat, time.time())
 
     @property
     def chats(self):
-        chats = self.redis.lrange('bot_contexts:%d:chats' % self.id, 0, -1)
+        """ Return all chats ordered by last activity, use iter_chats for large bots """
+        chats = self.redis.zrange('bot_contexts:%d:chats' % self.id, 0, -1)
         return tuple(int(c) for c in chats)
 
-    def mail_all(self, message):
-        """ Send message to all chats """
+    def iter_chats(self, batch_size=1000):
+        """ Yield chats, they are fetched by batches of about batch_size """
+        for chat, _ in self.redis.zscan_iter('bot_contexts:%d:chats' % self.id, count=batch_size):
+            yield int(chat)
+
+    @property
+    def chats_count(self):
+        return self.redis.zcard('bot_contexts:%d:chats' % self.id)
+
+    def chats_active_since(self, timestamp):
+        """ Return count of chats active since timestamp """
+        return self.redis.zcount('bot_contexts:%d:chats' % self.id, timestamp, '+inf')
+
+    def mail_all(self, message, rate=DEFAULT_RATE, concurrency=DEFAULT_CONCURRENCY, send=None):
+        """ Start broadcast of message to all chats of running bot, return Broadcast for progress tracking.
+        Messages are sent by send(chat_id, text), telegram bot of context is used by default """
         if self.running:
-            self.bot.mail_all(message)
+            broadcast = Broadcast.create(self.id, message, rate, concurrency)
+            self.start_broadcast(broadcast, send)
+            return broadcast
 
-    def increment_visits(self):
-        self.redis.hincrby('bot_contexts:%d:visits' % self.id,
-                           date.fromtimestamp(time.time()).isoformat(), 1)
+    @property
+    def broadcasts(self):
+        broadcasts = self.redis.lrange('bot_contexts:%d:broadcasts' % self.id, 0, -1)
+        return Broadcast.load_many(broadcasts)
+
+    def start_broadcast(self, broadcast, send=None):
+        """ Run broadcast in background thread """
+        if broadcast.id in running_broadcasts and running_broadcasts[broadcast.id][0].is_alive():
+            return
+        send = send if send is not None else TelegramBot(self.token).send_message
+        stop = threading.Event()
+        thread = threading.Thread(target=broadcast.run, args=(send,), kwargs={'stop': stop},
+                                  name='Broadcast %d' % broadcast.id, daemon=True)
+        running_broadcasts[broadcast.id] = (thread, stop)
+        thread.start()
+
+    def resume_broadcasts(self, send=None):
+        """ Continue broadcasts interrupted by bot stop or process crash """
+        for broadcast in self.broadcasts:
+            if broadcast.status == BROADCAST_RUNNING:
+                self.start_broadcast(broadcast, send)
+
+    def stop_broadcasts(self):
+        """ Interrupt broadcasts of context after their current batches, they continue on next run """
+        stopped = []
+        for broadcast_id in self.redis.lrange('bot_contexts:%d:broadcasts' % self.id, 0, -1):
+            if int(broadcast_id) in running_broadcasts:
+                thread, stop = running_broadcasts.pop(int(broadcast_id))
+                stop.set()
+                stopped.append(thread)
+        for thread in stopped:
+            thread.join()
+
+    def increment_visits(self, user=None):
+        """ Count visit, it is written to storage by statistics.visits_collector in background.
+        VM counts visits without user, unique users are counted by chat states of running bot """
+        visits_collector.add_visit(self.id, user)
+
+
+def update_processor(bot):
+    """ Return function passing update received by webhook (decoded JSON) to VM bot, None if bot can only poll.
+    Bot with process_update(update) gets update as is, bot built on python-telegram-bot updater
+    gets it as telegram.Update by its dispatcher """
+    process_update = getattr(bot, 'process_update', None)
+    if callable(process_update):
+        return process_update
+    dispatcher = getattr(bot, 'dispatcher', None) or getattr(getattr(bot, 'updater', None), 'dispatcher', None)
+    if dispatcher is not None:
+        from telegram import Update
+        return lambda update: dispatcher.process_update(Update.de_json(update, dispatcher.bot))
+    return None
 
 
 class OperatorAlreadyAdded(Exception):
@@ -149,15 +386,121 @@ class OperatorAlreadyAdded(Exception):
 
 
 def is_operator_locked(operator):
-    for context in BotRunnerContext.list():
-        for oper in context.operators:
-            if oper == operator:
-                return True
-    return False
+    """ Check if operator is added to some bot context """
+    return get_storage().scard('operators:%d:contexts' % operator.id) != 0
 
 
 def is_bot_template_locked(bot_template):
-    for context in BotRunnerContext.list():
-        if context.bot_template == bot_template:
-            return True
-    return False
+    """ Check if bot template is selected by some bot context """
+    return get_storage().scard('bot_templates:%d:contexts' % bot_template.id) != 0
+
+
+def compile_template(bot_template, optimize=False, merge_messages=False):
+    """ Return program of bot template with its sources and compilation options """
+    if optimize:
+        program, sources, statistics = bot_template.compile_optimized(merge_messages)
+    else:
+        (program, sources), statistics = bot_template.compile_with_sources(), None
+    return {'program': program, 'sources': sources, 'statistics': statistics,
+            'optimize': optimize, 'merge_messages': merge_messages}
+
+
+def _cached_programs(redis_, templates_ids, merge_messages):
+    """ Return template id to compiled program map for templates with program of current version """
+    pipeline = redis_.pipeline(transaction=False)
+    for template_id in templates_ids:
+        pipeline.hget('bot_templates:%d' % template_id, 'version')
+        pipeline.hmget('bot_templates:%d:compiled' % template_id, 'version', 'program', 'sources')
+    results = pipeline.execute() if len(templates_ids) != 0 else ()
+    programs = {}
+    for template_id, version, (compiled_version, program, sources) in zip(templates_ids, results[::2],
+                                                                          results[1::2]):
+        if program is not None and sources is not None and int(compiled_version) == int(version or 0):
+            programs[template_id] = {'program': json.loads(program.decode()),
+                                     'sources': json.loads(sources.decode()),
+                                     'statistics': None, 'optimize': False, 'merge_messages': merge_messages}
+    return programs
+
+
+def _init_compiler(url, options):
+    set_redis_connection(connect(url) if url is not None else connect_options(options))
+
+
+def _compile(template_id, optimize, merge_messages):
+    """ Compile template in worker process, return (program, compilation seconds) """
+    started = time.monotonic()
+    program = compile_template(constructor.BotTemplate(template_id, check=False), optimize, merge_messages)
+    return program, time.monotonic() - started
+
+
+def boot_all(optimize=False, merge_messages=False, webhook_server=None, url=None, processes=None,
+             concurrency=BOOT_CONCURRENCY):
+    """ Run all bot contexts with selected template and token at process start.
+    Contexts, their operators and compiled programs are fetched with few pipelines, templates without
+    compiled program of current version (every template if optimize is True) are compiled in pool of
+    processes connected to url, by default to the database of current redis connection. Templates of
+    embedded storage are compiled in this process, bots share one operators subscription
+    and at most concurrency bots are started at the same time.
+    Return context id to {'compile': seconds, 'cached': bool, 'start': seconds, 'error': str or None} report """
+    redis_ = get_storage()
+    contexts = [c for c in BotRunnerContext.list()
+                if not c.running and c.get_field('bot_template') is not None and c.get_field('token') is not None]
+    pipeline = redis_.pipeline(transaction=False)
+    for context in contexts:
+        pipeline.lrange('bot_contexts:%d:operators' % context.id, 0, -1)
+    operators_ids = pipeline.execute() if len(contexts) != 0 else ()
+    operators = {o.id: o for o in Operator.load_many({int(i) for ids in operators_ids for i in ids})}
+
+    if len(contexts) == 0:
+        return {}
+    templates_ids = sorted({int(c.get_field('bot_template')) for c in contexts})
+    programs = {} if optimize else _cached_programs(redis_, templates_ids, merge_messages)
+    cached = set(programs)
+    compile_times = {i: 0 for i in cached}
+    errors = {}
+    compiled = [i for i in templates_ids if i not in programs]
+    options = connection_options(get_redis_connection()) if url is None else None
+    if (url is not None or options is not None) and len(compiled) > 1:
+        with ProcessPoolExecutor(processes, initializer=_init_compiler, initargs=(url, options)) as pool:
+            futures = [(i, pool.submit(_compile, i, optimize, merge_messages)) for i in compiled]
+            results = []
+            for template_id, future in futures:
+                try:
+                    results.append((template_id, future.result()))
+                except Exception as e:
+                    errors[template_id] = repr(e)
+    else:
+        results = []
+        for template_id in compiled:
+            try:
+                results.append((template_id, _compile(template_id, optimize, merge_messages)))
+            except Exception as e:
+                errors[template_id] = repr(e)
+    for template_id, (program, seconds) in results:
+        programs[template_id] = program
+        compile_times[template_id] = seconds
+    for template_id, error in errors.items():
+        logger.error('Bot template %d is not compiled: %s' % (template_id, error))
+
+    pubsub = SharedPubSub(redis_)
+    report = {}
+
+    def start(context, context_operators):
+        template_id = int(context.get_field('bot_template'))
+        report[context.id] = {'compile': compile_times.get(template_id), 'cached': template_id in cached,
+                              'start': None, 'error': errors.get(template_id)}
+        if template_id not in programs:
+            return
+        started = time.monotonic()
+        try:
+            context.run(optimize, merge_messages, webhook_server, programs[template_id], context_operators, pubsub)
+        except Exception as e:
+            report[context.id]['error'] = repr(e)
+            logger.exception('Bot context %d failed to start' % context.id)
+            return
+        report[context.id]['start'] = time.monotonic() - started
+        logger.info('Bot context %d booted in %.3f s' % (context.id, report[context.id]['start']))
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        tuple(pool.map(start, contexts, [[operators[int(i)] for i in ids] for ids in operators_ids]))
+    return report
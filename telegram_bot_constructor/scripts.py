@@ -0,0 +1,234 @@
+""" Lua scripts executed on redis server side """
+import json
+from hashlib import sha1
+
+from .cache import INVALIDATION_CHANNEL
+
+# Delete object with owned objects tree described by spec (see StoredObject.cascade_spec).
+# Deletes at most ARGV[3] objects per call, leaves first, so large trees are deleted by chunks
+# without blocking server for long. Return 1 when root object is deleted, 0 if call must be repeated
+CASCADE_DELETE = """
+local budget = tonumber(ARGV[3])
+
+local function delete_object(node, id)
+    local object_key = node.prefix .. ':' .. id
+    for collection, child in pairs(node.children) do
+        local key = object_key .. ':' .. collection
+        local is_zset = redis.call('TYPE', key).ok == 'zset'
+        while true do
+            if budget <= 0 then
+                return false
+            end
+            local member
+            if is_zset then
+                member = redis.call('ZRANGE', key, -1, -1)[1]
+            else
+                member = redis.call('LINDEX', key, -1)
+            end
+            if not member then
+                break
+            end
+            if not delete_object(child, member) then
+                return false
+            end
+            if is_zset then
+                redis.call('ZREM', key, member)
+            else
+                redis.call('LREM', key, -1, member)
+            end
+        end
+    end
+    redis.call('SREM', node.mnemonic .. '_exists', id)
+    local keys = {object_key}
+    for _, collection in ipairs(node.collections) do
+        table.insert(keys, object_key .. ':' .. collection)
+    end
+    redis.call('DEL', unpack(keys))
+    for _, list in ipairs(node.lists) do
+        redis.call('LREM', list, 0, id)
+    end
+    if node.cached then
+        redis.call('PUBLISH', ARGV[4], '["' .. node.mnemonic .. '", ' .. id .. ', null]')
+    end
+    budget = budget - 1
+    return true
+end
+
+if delete_object(cjson.decode(ARGV[1]), ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+
+def _cascade_delete(storage, keys, args):
+    """ CASCADE_DELETE for embedded storage """
+    spec, id_, budget, channel = args
+    budget = [int(budget)]
+
+    def delete_object(node, id_):
+        object_key = '%s:%s' % (node['prefix'], id_)
+        for collection, child in node['children'].items():
+            key = '%s:%s' % (object_key, collection)
+            is_zset = storage.type(key) == b'zset'
+            while True:
+                if budget[0] <= 0:
+                    return False
+                member = (storage.zrange(key, -1, -1) or (None,))[0] if is_zset else storage.lindex(key, -1)
+                if member is None:
+                    break
+                if not delete_object(child, member.decode()):
+                    return False
+                if is_zset:
+                    storage.zrem(key, member)
+                else:
+                    storage.lrem(key, member, -1)
+        storage.srem('%s_exists' % node['mnemonic'], id_)
+        storage.delete(object_key, *('%s:%s' % (object_key, c) for c in node['collections']))
+        for list_ in node['lists']:
+            storage.lrem(list_, id_, 0)
+        if node['cached']:
+            storage.publish(channel, '["%s", %s, null]' % (node['mnemonic'], id_))
+        budget[0] -= 1
+        return True
+
+    return int(delete_object(json.loads(spec), id_.decode() if isinstance(id_, bytes) else str(id_)))
+
+
+# Append ARGV[1] to the end of ordered sorted set KEYS[1], scores are separated by ARGV[2] gaps
+ORDERED_APPEND = """
+local last = redis.call('ZREVRANGE', KEYS[1], 0, 0, 'WITHSCORES')[2]
+local score = 0
+if last then
+    score = tonumber(last) + tonumber(ARGV[2])
+end
+redis.call('ZADD', KEYS[1], string.format('%.17g', score), ARGV[1])
+return 1
+"""
+
+# Move ARGV[1] of ordered sorted set KEYS[1] to index ARGV[2]. Moved member gets score between its new
+# neighbours, all members are renumbered with ARGV[3] gaps only when there is no free score between them.
+# Return 0 if member is not in set
+ORDERED_MOVE = """
+local key, member = KEYS[1], ARGV[1]
+local index, gap = tonumber(ARGV[2]), tonumber(ARGV[3])
+local rank = redis.call('ZRANK', key, member)
+if not rank then
+    return 0
+end
+if rank == index then
+    return 1
+end
+
+-- Score at index of set without moved member
+local function score_at(i)
+    if i < 0 then
+        return nil
+    end
+    if i >= rank then
+        i = i + 1
+    end
+    local score = redis.call('ZRANGE', key, i, i, 'WITHSCORES')[2]
+    return score and tonumber(score)
+end
+
+local function new_score()
+    local previous, following = score_at(index - 1), score_at(index)
+    if previous and following then
+        local score = (previous + following) / 2
+        return score, previous < score and score < following
+    elseif previous then
+        return previous + gap, true
+    end
+    return following - gap, true
+end
+
+local score, free = new_score()
+if not free then
+    local members = redis.call('ZRANGE', key, 0, -1)
+    for i, m in ipairs(members) do
+        redis.call('ZADD', key, (i - 1) * gap, m)
+    end
+    score = new_score()
+end
+redis.call('ZADD', key, string.format('%.17g', score), member)
+return 1
+"""
+
+
+def _ordered_append(storage, keys, args):
+    """ ORDERED_APPEND for embedded storage """
+    last = storage.zrevrange(keys[0], 0, 0, withscores=True)
+    storage.zadd(keys[0], args[0], last[0][1] + float(args[1]) if len(last) != 0 else 0)
+    return 1
+
+
+def _ordered_move(storage, keys, args):
+    """ ORDERED_MOVE for embedded storage """
+    key, member, index, gap = keys[0], args[0], int(args[1]), float(args[2])
+    rank = storage.zrank(key, member)
+    if rank is None:
+        return 0
+    if rank == index:
+        return 1
+
+    def score_at(i):
+        if i < 0:
+            return None
+        items = storage.zrange(key, i + 1 if i >= rank else i, i + 1 if i >= rank else i, withscores=True)
+        return items[0][1] if len(items) != 0 else None
+
+    def new_score():
+        previous, following = score_at(index - 1), score_at(index)
+        if previous is not None and following is not None:
+            score = (previous + following) / 2
+            return score, previous < score < following
+        elif previous is not None:
+            return previous + gap, True
+        return following - gap, True
+
+    score, free = new_score()
+    if not free:
+        for i, m in enumerate(storage.zrange(key, 0, -1)):
+            storage.zadd(key, m, i * gap)
+        score, _ = new_score()
+    storage.zadd(key, member, score)
+    return 1
+
+
+# Python implementations of scripts by lua source, used by embedded storage
+PYTHON_SCRIPTS = {CASCADE_DELETE: _cascade_delete,
+                  ORDERED_APPEND: _ordered_append,
+                  ORDERED_MOVE: _ordered_move}
+
+_registered = {}
+
+
+def run_script(redis_, source, keys=(), args=()):
+    """ Run script by its sha, loading it to server if needed """
+    key = (type(redis_), source)
+    if key not in _registered:
+        _registered[key] = redis_.register_script(source)
+    return _registered[key](keys=list(keys), args=list(args), client=redis_)
+
+
+def cascade_delete(redis_, spec, id_, chunk_size=1000):
+    """ Delete object with all owned objects, every chunk of chunk_size objects is deleted atomically """
+    while not int(run_script(redis_, CASCADE_DELETE, args=(spec, id_, chunk_size, INVALIDATION_CHANNEL))):
+        pass
+
+
+async def async_run_script(redis_, source, keys=(), args=()):
+    """ run_script() for async connection """
+    try:
+        return await redis_.evalsha(sha1(source.encode()).hexdigest(), keys=list(keys), args=list(args))
+    except Exception as e:
+        if not str(e).startswith('NOSCRIPT'):
+            raise
+        return await redis_.eval(source, keys=list(keys), args=list(args))
+
+
+async def async_cascade_delete(redis_, spec, id_, chunk_size=1000):
+    while not int(await async_run_script(redis_, CASCADE_DELETE, args=(spec, id_, chunk_size,
+                                                                       INVALIDATION_CHANNEL))):
+        pass
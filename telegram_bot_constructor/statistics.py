@@ -0,0 +1,171 @@
+""" Visits statistics of bot contexts.
+
+Visits are counted in process and written by one pipeline every FLUSH_INTERVAL seconds to:
+    'bot_contexts:<id>:visits' hash - visits per day, days older than DAYS_RETENTION are pruned
+    'bot_contexts:<id>:visits:<date>' hash - visits per hour of day, expires after HOURS_RETENTION days
+    'bot_contexts:<id>:users:<date>' HyperLogLog - unique users of day, expires after USERS_RETENTION days
+Dates are local ISO dates, hours are local hours """
+import atexit
+import threading
+import time
+from datetime import date, datetime, timedelta
+from logging import getLogger
+
+from . import get_redis_connection
+
+FLUSH_INTERVAL = 5  # Seconds
+HOURS_RETENTION = 7  # Days
+USERS_RETENTION = 90  # Days
+DAYS_RETENTION = 400  # Days
+
+logger = getLogger('Statistics')
+
+
+def daily_key(context_id):
+    return 'bot_contexts:%d:visits' % context_id
+
+
+def hourly_key(context_id, date_):
+    return 'bot_contexts:%d:visits:%s' % (context_id, date_.isoformat() if isinstance(date_, date) else date_)
+
+
+def users_key(context_id, date_):
+    return 'bot_contexts:%d:users:%s' % (context_id, date_.isoformat() if isinstance(date_, date) else date_)
+
+
+def dated_collections(today=None):
+    """ Return names of dated keys of bot context which may exist, they are deleted with context """
+    today = today if today is not None else date.today()
+    days = [(today - timedelta(days=i)).isoformat() for i in range(-1, max(HOURS_RETENTION, USERS_RETENTION) + 1)]
+    return tuple('visits:%s' % d for d in days[:HOURS_RETENTION + 2]) + \
+        tuple('users:%s' % d for d in days[:USERS_RETENTION + 2])
+
+
+class VisitsCollector:
+    """ Aggregates visits of all bot contexts of process between flushes.
+    Counting is a dict update, storage is written by background thread started on the first visit """
+
+    def __init__(self, redis_=None, flush_interval=FLUSH_INTERVAL, clock=time.time):
+        self.redis = redis_
+        self.flush_interval = flush_interval  # None disables background flushing
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.visits = {}  # (context id, date, hour) to count map
+        self.users = {}  # (context id, date) to set of users map
+        self.pruned = {}  # Context id to date of the last pruning of daily hash
+        self.hour = None  # (date, hour, start timestamp, end timestamp) of current hour
+        self.flusher = None
+        self.stopped = threading.Event()
+
+    def _current_hour(self, now):
+        hour = self.hour
+        if hour is None or not hour[2] <= now < hour[3]:
+            start = datetime.fromtimestamp(now).replace(minute=0, second=0, microsecond=0)
+            hour = self.hour = (start.date().isoformat(), start.hour, start.timestamp(),
+                                (start + timedelta(hours=1)).timestamp())
+        return hour
+
+    def add_visit(self, context_id, user=None):
+        """ Count visit of bot context, unique visitors are counted if user is given """
+        day, hour, _, _ = self._current_hour(self.clock())
+        with self.lock:
+            key = (context_id, day, hour)
+            self.visits[key] = self.visits.get(key, 0) + 1
+            if user is not None:
+                self.users.setdefault((context_id, day), set()).add(user)
+        if self.flusher is None and self.flush_interval is not None:
+            self.start()
+
+    def add_user(self, context_id, user):
+        """ Count user of bot context as unique visitor of day """
+        day, _, _, _ = self._current_hour(self.clock())
+        with self.lock:
+            self.users.setdefault((context_id, day), set()).add(user)
+        if self.flusher is None and self.flush_interval is not None:
+            self.start()
+
+    def flush(self):
+        """ Write collected visits with one pipeline, return count of written visits.
+        If write fails visits are kept for the next flush """
+        with self.lock:
+            visits, users = self.visits, self.users
+            self.visits, self.users = {}, {}
+        if len(visits) == 0 and len(users) == 0:
+            return 0
+        redis_ = self.redis if self.redis is not None else get_redis_connection()
+        days = {}  # (context id, date) to count map
+        pipeline = redis_.pipeline(transaction=False)
+        for (context_id, day, hour), count in visits.items():
+            days[(context_id, day)] = days.get((context_id, day), 0) + count
+            pipeline.hincrby(hourly_key(context_id, day), hour, count)
+            pipeline.expire(hourly_key(context_id, day), HOURS_RETENTION * 86400)
+        for (context_id, day), count in days.items():
+            pipeline.hincrby(daily_key(context_id), day, count)
+        for (context_id, day), day_users in users.items():
+            pipeline.pfadd(users_key(context_id, day), *day_users)
+            pipeline.expire(users_key(context_id, day), USERS_RETENTION * 86400)
+        try:
+            pipeline.execute()
+        except Exception:
+            self._restore(visits, users)
+            raise
+        self._prune(redis_, set(context_id for context_id, _ in days))
+        return sum(visits.values())
+
+    def _restore(self, visits, users):
+        with self.lock:
+            for key, count in visits.items():
+                self.visits[key] = self.visits.get(key, 0) + count
+            for key, day_users in users.items():
+                self.users.setdefault(key, set()).update(day_users)
+
+    def _prune(self, redis_, contexts_ids):
+        """ Delete days older than DAYS_RETENTION from daily hashes, every hash is pruned once a day """
+        today = date.fromtimestamp(self.clock())
+        contexts_ids = tuple(i for i in contexts_ids if self.pruned.get(i) != today)
+        if len(contexts_ids) == 0:
+            return
+        oldest = (today - timedelta(days=DAYS_RETENTION)).isoformat()
+        pipeline = redis_.pipeline(transaction=False)
+        for context_id in contexts_ids:
+            pipeline.hkeys(daily_key(context_id))
+        pipeline_ = redis_.pipeline(transaction=False)
+        for context_id, days in zip(contexts_ids, pipeline.execute()):
+            old_days = tuple(d for d in days if d.decode() < oldest)
+            if len(old_days) != 0:
+                pipeline_.hdel(daily_key(context_id), *old_days)
+            self.pruned[context_id] = today
+        if len(pipeline_) != 0:
+            pipeline_.execute()
+
+    def start(self):
+        with self.lock:
+            if self.flusher is not None:
+                return
+            self.flusher = threading.Thread(target=self._flush_periodically, name='Visits flusher', daemon=True)
+        self.flusher.start()
+
+    def _flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Visits flush failed')
+
+    def stop(self):
+        """ Stop background flushing and flush collected visits """
+        self.stopped.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.flush()
+
+
+visits_collector = VisitsCollector()
+
+
+@atexit.register
+def _flush_on_exit():
+    try:
+        visits_collector.stop()
+    except Exception:
+        logger.exception('Visits flush failed')
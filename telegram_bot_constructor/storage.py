@@ -0,0 +1,1021 @@
+""" Storage backends: redis server or embedded in process engine with the same commands interface.
+
+Backend must provide subset of redis-py (2.x, legacy Redis class) commands used by package:
+strings, hashes, sets, lists, sorted sets, keys expiration and scanning, pipelines, pub/sub and
+registered scripts. MemoryStorage implements scripts by python twins of lua sources (see scripts module).
+Streams commands of MemoryStorage follow redis-py 3 interface, transport module adapts redis-py 2 to it """
+import bisect
+import json
+import os
+import queue
+import threading
+import time
+from fnmatch import fnmatchcase
+from functools import wraps
+
+from redis import ConnectionPool, Redis
+
+from .scripts import PYTHON_SCRIPTS
+
+
+_embedded = {}  # Embedded storages by url, same url in process means same database like for redis
+
+
+def connect(url):
+    """ Return backend for url: redis://host:port/db, memory:// or memory:///path/to/append-only-file """
+    if url.startswith('memory://'):
+        if url not in _embedded:
+            _embedded[url] = MemoryStorage(url[len('memory://'):] or None)
+        return _embedded[url]
+    return Redis.from_url(url)
+
+
+def connection_options(redis_):
+    """ Return (connection class, connection kwargs) connecting other processes to the same redis database
+    by connect_options(), None for embedded storage """
+    pool = getattr(redis_, 'connection_pool', None)
+    return (pool.connection_class, dict(pool.connection_kwargs)) if pool is not None else None
+
+
+def connect_options(options):
+    connection_class, kwargs = options
+    return Redis(connection_pool=ConnectionPool(connection_class=connection_class, **kwargs))
+
+
+class StorageError(Exception):
+    pass
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).encode()
+
+
+def _dump_argument(value):
+    """ Numbers, booleans and None are kept, other arguments are stored as latin-1 strings of their bytes """
+    return value if value is None or isinstance(value, (bool, int, float)) else _encode(value).decode('latin-1')
+
+
+def _load_argument(value):
+    return value.encode('latin-1') if isinstance(value, str) else value
+
+
+def _dump_command(name, args, kwargs):
+    return json.dumps((name, [_dump_argument(a) for a in args],
+                       {k: _dump_argument(v) for k, v in kwargs.items()})) + '\n'
+
+
+def _write(method):
+    """ Decorator of write commands, they are logged to append-only file unless called by other write command """
+
+    @wraps(method)
+    def logged(self, *args, **kwargs):
+        with self.lock:
+            self.depth += 1
+            try:
+                result = method(self, *args, **kwargs)
+            finally:
+                self.depth -= 1
+            if self.depth == 0:
+                self._log(method.__name__, args, kwargs)
+            return result
+
+    return logged
+
+
+def _range(length, start, end):
+    start, end = int(start), int(end)
+    if start < 0:
+        start = max(length + start, 0)
+    end = length + end if end < 0 else min(end, length - 1)
+    return start, end + 1
+
+
+MAX_STREAM_ID = (2 ** 64 - 1, 2 ** 64 - 1)
+
+
+def _parse_id(value, default_sequence=0):
+    """ Return (milliseconds, sequence) for stream entry id, '-' and '+' are the smallest and the largest ids """
+    value = value.decode() if isinstance(value, bytes) else str(value)
+    if value in ('-', '+'):
+        return MAX_STREAM_ID if value == '+' else (0, 0)
+    milliseconds, _, sequence = value.partition('-')
+    return int(milliseconds), int(sequence) if sequence else default_sequence
+
+
+def _format_id(id_):
+    return b'%d-%d' % id_
+
+
+def _score_bound(value):
+    """ Return (score, exclusive) for sorted set range bound """
+    value = value.decode() if isinstance(value, bytes) else str(value)
+    exclusive = value.startswith('(')
+    value = value[1:] if exclusive else value
+    return float({'-inf': '-inf', '+inf': 'inf', 'inf': 'inf'}.get(value, value)), exclusive
+
+
+class MemoryStorage:
+    """ Embedded storage engine. All data lives in process memory, writes are optionally
+    logged to append-only file and replayed on start """
+
+    def __init__(self, append_only_file=None, fsync=False):
+        self.data = {}
+        self.expires = {}  # Key to expiration timestamp map
+        self.lock = threading.RLock()
+        self.subscribers = set()
+        self.streams_changed = threading.Condition(self.lock)  # Wakes blocked stream readers
+        self.fsync = fsync
+        self.aof = None
+        self.replaying = False
+        self.depth = 0  # Depth of nested write commands, only outer ones are logged
+        if append_only_file is not None:
+            if os.path.exists(append_only_file):
+                self._replay(append_only_file)
+            self.aof = open(append_only_file, 'a', encoding='latin-1')
+
+    # Persistence
+
+    def _replay(self, path):
+        self.replaying = True
+        try:
+            with open(path, encoding='latin-1') as aof:
+                for line in aof:
+                    if line.strip():
+                        name, args, kwargs = json.loads(line)
+                        getattr(self, name)(*(_load_argument(a) for a in args),
+                                            **{k: _load_argument(v) for k, v in kwargs.items()})
+        finally:
+            self.replaying = False
+
+    def _log(self, name, args, kwargs):
+        if self.aof is not None and not self.replaying:
+            self.aof.write(_dump_command(name, args, kwargs))
+            self.aof.flush()
+            if self.fsync:
+                os.fsync(self.aof.fileno())
+
+    def rewrite_append_only_file(self):
+        """ Replace append-only file with minimal set of commands restoring current state """
+        if self.aof is None:
+            return
+        with self.lock:
+            path = self.aof.name
+            with open(path + '.rewrite', 'w', encoding='latin-1') as aof:
+                for key in tuple(self.data):
+                    value = self._get(key)
+                    if value is None:
+                        continue
+                    if isinstance(value, bytes):
+                        commands = (('_store', (key, value)),)
+                    elif isinstance(value, dict) and self._type(key) == b'hash':
+                        commands = tuple(('hset', (key, k, v)) for k, v in value.items())
+                    elif isinstance(value, set):
+                        commands = (('sadd', (key,) + tuple(value)),)
+                    elif isinstance(value, _HyperLogLog):
+                        commands = (('pfadd', (key,) + tuple(value.members)),)
+                    elif isinstance(value, list):
+                        commands = (('rpush', (key,) + tuple(value)),)
+                    elif isinstance(value, _Stream):
+                        commands = tuple(('_append', (key, _format_id(i)) + tuple(x for f in e.items() for x in f))
+                                         for i, e in zip(value.ids, value.entries.values()))
+                        commands += (('_restore_stream', (key, _format_id(value.last_id), value.dump_groups())),)
+                    else:
+                        commands = (('zadd', (key,) + tuple(x for m, s in value.items() for x in (m, s))),)
+                    if key in self.expires:
+                        commands += (('pexpireat', (key, int(self.expires[key] * 1000))),)
+                    for name, args in commands:
+                        aof.write(_dump_command(name, args, {}))
+            self.aof.close()
+            os.replace(path + '.rewrite', path)
+            self.aof = open(path, 'a', encoding='latin-1')
+
+    def close(self):
+        if self.aof is not None:
+            self.aof.close()
+            self.aof = None
+
+    # Keys
+
+    def _get(self, key, type_=None):
+        key = _encode(key)
+        if key in self.expires and self.expires[key] <= time.time():
+            del self.expires[key]
+            self.data.pop(key, None)
+        value = self.data.get(key)
+        if value is not None and type_ is not None and not isinstance(value, type_):
+            raise StorageError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def _get_or_create(self, key, type_):
+        value = self._get(key, type_)
+        if value is None:
+            value = self.data[_encode(key)] = type_()
+        return value
+
+    def _drop_empty(self, key):
+        key = _encode(key)
+        value = self.data.get(key)
+        if value is not None and not isinstance(value, bytes) and len(value) == 0:
+            del self.data[key]
+            self.expires.pop(key, None)
+
+    def _type(self, key):
+        value = self._get(key)
+        if value is None:
+            return b'none'
+        if isinstance(value, bytes):
+            return b'string'
+        return {_Hash: b'hash', set: b'set', list: b'list', _SortedSet: b'zset',
+                _HyperLogLog: b'string', _Stream: b'stream'}[type(value)]
+
+    def type(self, name):
+        with self.lock:
+            return self._type(name)
+
+    def exists(self, name):
+        with self.lock:
+            return self._get(name) is not None
+
+    @_write
+    def delete(self, *names):
+        with self.lock:
+            deleted = 0
+            for name in names:
+                if self._get(name) is not None:
+                    del self.data[_encode(name)]
+                    self.expires.pop(_encode(name), None)
+                    deleted += 1
+            return deleted
+
+    def keys(self, pattern='*'):
+        with self.lock:
+            pattern = pattern.decode() if isinstance(pattern, bytes) else pattern
+            return [k for k in tuple(self.data) if self._get(k) is not None and fnmatchcase(k.decode(), pattern)]
+
+    def scan_iter(self, match=None, count=None):
+        return iter(self.keys(match or '*'))
+
+    @_write
+    def flushdb(self):
+        with self.lock:
+            self.data.clear()
+            self.expires.clear()
+            return True
+
+    def ping(self):
+        return True
+
+    def expire(self, name, time_):
+        return self.pexpireat(name, int((time.time() + int(time_)) * 1000))
+
+    def pexpire(self, name, time_):
+        return self.pexpireat(name, int(time.time() * 1000) + int(time_))
+
+    @_write
+    def pexpireat(self, name, when):
+        with self.lock:
+            if self._get(name) is None:
+                return False
+            self.expires[_encode(name)] = int(when) / 1000
+            return True
+
+    @_write
+    def persist(self, name):
+        with self.lock:
+            return self.expires.pop(_encode(name), None) is not None
+
+    def pttl(self, name):
+        """ Return milliseconds to expiration, None if key does not exist or has no expiration """
+        with self.lock:
+            if self._get(name) is None or _encode(name) not in self.expires:
+                return None
+            return int((self.expires[_encode(name)] - time.time()) * 1000)
+
+    def ttl(self, name):
+        ttl = self.pttl(name)
+        return ttl if ttl is None else (ttl + 999) // 1000
+
+    # Strings
+
+    def get(self, name):
+        with self.lock:
+            return self._get(name, bytes)
+
+    def mget(self, keys, *args):
+        keys = (list(keys) if isinstance(keys, (list, tuple)) else [keys]) + list(args)
+        with self.lock:
+            return [self._get(k, bytes) for k in keys]
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        with self.lock:
+            exists = self._get(name) is not None
+            if (nx and exists) or (xx and not exists):
+                return None
+            self._store(name, value)
+            if ex is not None:
+                self.pexpireat(name, int((time.time() + int(ex)) * 1000))
+            elif px is not None:
+                self.pexpireat(name, int(time.time() * 1000) + int(px))
+            return True
+
+    @_write
+    def _store(self, name, value):
+        self.data[_encode(name)] = _encode(value)
+        self.expires.pop(_encode(name), None)
+
+    def setex(self, name, value, time_):
+        return self.set(name, value, ex=time_)
+
+    @_write
+    def incrby(self, name, amount=1):
+        with self.lock:
+            value = int(self._get(name, bytes) or 0) + int(amount)
+            self.data[_encode(name)] = _encode(value)
+            return value
+
+    def incr(self, name, amount=1):
+        return self.incrby(name, amount)
+
+    # Hashes
+
+    def hget(self, name, key):
+        with self.lock:
+            return (self._get(name, _Hash) or {}).get(_encode(key))
+
+    def hmget(self, name, keys, *args):
+        keys = (list(keys) if isinstance(keys, (list, tuple)) else [keys]) + list(args)
+        with self.lock:
+            hash_ = self._get(name, _Hash) or {}
+            return [hash_.get(_encode(k)) for k in keys]
+
+    def hgetall(self, name):
+        with self.lock:
+            return dict(self._get(name, _Hash) or {})
+
+    @_write
+    def hset(self, name, key, value):
+        with self.lock:
+            hash_ = self._get_or_create(name, _Hash)
+            new = _encode(key) not in hash_
+            hash_[_encode(key)] = _encode(value)
+            return int(new)
+
+    def hsetnx(self, name, key, value):
+        with self.lock:
+            if _encode(key) in (self._get(name, _Hash) or {}):
+                return 0
+            return self.hset(name, key, value)
+
+    @_write
+    def hmset(self, name, mapping):
+        with self.lock:
+            self._get_or_create(name, _Hash).update((_encode(k), _encode(v)) for k, v in mapping.items())
+            return True
+
+    @_write
+    def hdel(self, name, *keys):
+        with self.lock:
+            hash_ = self._get(name, _Hash) or {}
+            deleted = sum(1 for k in keys if hash_.pop(_encode(k), None) is not None)
+            self._drop_empty(name)
+            return deleted
+
+    @_write
+    def hincrby(self, name, key, amount=1):
+        with self.lock:
+            hash_ = self._get_or_create(name, _Hash)
+            value = int(hash_.get(_encode(key), 0)) + int(amount)
+            hash_[_encode(key)] = _encode(value)
+            return value
+
+    @_write
+    def hincrbyfloat(self, name, key, amount=1.0):
+        with self.lock:
+            hash_ = self._get_or_create(name, _Hash)
+            value = float(hash_.get(_encode(key), 0)) + float(amount)
+            hash_[_encode(key)] = _encode(value)
+            return value
+
+    def hexists(self, name, key):
+        with self.lock:
+            return _encode(key) in (self._get(name, _Hash) or {})
+
+    def hlen(self, name):
+        with self.lock:
+            return len(self._get(name, _Hash) or {})
+
+    def hkeys(self, name):
+        with self.lock:
+            return list(self._get(name, _Hash) or {})
+
+    # Sets
+
+    @_write
+    def sadd(self, name, *values):
+        with self.lock:
+            set_ = self._get_or_create(name, set)
+            added = len(set(_encode(v) for v in values) - set_)
+            set_.update(_encode(v) for v in values)
+            return added
+
+    @_write
+    def srem(self, name, *values):
+        with self.lock:
+            set_ = self._get(name, set) or set()
+            removed = len(set_ & set(_encode(v) for v in values))
+            set_.difference_update(_encode(v) for v in values)
+            self._drop_empty(name)
+            return removed
+
+    def sismember(self, name, value):
+        with self.lock:
+            return _encode(value) in (self._get(name, set) or ())
+
+    def smembers(self, name):
+        with self.lock:
+            return set(self._get(name, set) or ())
+
+    def scard(self, name):
+        with self.lock:
+            return len(self._get(name, set) or ())
+
+    # Lists
+
+    @_write
+    def rpush(self, name, *values):
+        with self.lock:
+            list_ = self._get_or_create(name, list)
+            list_.extend(_encode(v) for v in values)
+            return len(list_)
+
+    @_write
+    def lpush(self, name, *values):
+        with self.lock:
+            list_ = self._get_or_create(name, list)
+            for value in values:
+                list_.insert(0, _encode(value))
+            return len(list_)
+
+    @_write
+    def lrem(self, name, value, num=0):
+        with self.lock:
+            list_ = self._get(name, list) or []
+            value, num = _encode(value), int(num)
+            indexes = [i for i, v in enumerate(list_) if v == value]
+            if num > 0:
+                indexes = indexes[:num]
+            elif num < 0:
+                indexes = indexes[num:]
+            for i in reversed(indexes):
+                del list_[i]
+            self._drop_empty(name)
+            return len(indexes)
+
+    def lrange(self, name, start, end):
+        with self.lock:
+            list_ = self._get(name, list) or []
+            return list_[slice(*_range(len(list_), start, end))]
+
+    def llen(self, name):
+        with self.lock:
+            return len(self._get(name, list) or ())
+
+    def lindex(self, name, index):
+        with self.lock:
+            list_ = self._get(name, list) or []
+            index = int(index)
+            return list_[index] if -len(list_) <= index < len(list_) else None
+
+    @_write
+    def lpop(self, name):
+        with self.lock:
+            list_ = self._get(name, list) or []
+            value = list_.pop(0) if len(list_) != 0 else None
+            self._drop_empty(name)
+            return value
+
+    @_write
+    def rpop(self, name):
+        with self.lock:
+            list_ = self._get(name, list) or []
+            value = list_.pop() if len(list_) != 0 else None
+            self._drop_empty(name)
+            return value
+
+    @_write
+    def ltrim(self, name, start, end):
+        with self.lock:
+            list_ = self._get(name, list) or []
+            list_[:] = list_[slice(*_range(len(list_), start, end))]
+            self._drop_empty(name)
+            return True
+
+    # Sorted sets
+
+    def _sorted(self, name):
+        return sorted((self._get(name, _SortedSet) or {}).items(), key=lambda i: (i[1], i[0]))
+
+    @_write
+    def zadd(self, name, *args, **kwargs):
+        """ Legacy redis-py order: member1, score1, member2, score2 or member=score keyword arguments """
+        pairs = list(zip(args[::2], args[1::2])) + list(kwargs.items())
+        with self.lock:
+            zset = self._get_or_create(name, _SortedSet)
+            added = sum(1 for m, _ in pairs if _encode(m) not in zset)
+            for member, score in pairs:
+                zset[_encode(member)] = float(score)
+            return added
+
+    @_write
+    def zrem(self, name, *values):
+        with self.lock:
+            zset = self._get(name, _SortedSet) or {}
+            removed = sum(1 for v in values if zset.pop(_encode(v), None) is not None)
+            self._drop_empty(name)
+            return removed
+
+    @_write
+    def zincrby(self, name, value, amount=1):
+        with self.lock:
+            zset = self._get_or_create(name, _SortedSet)
+            zset[_encode(value)] = zset.get(_encode(value), 0.0) + float(amount)
+            return zset[_encode(value)]
+
+    def zscore(self, name, value):
+        with self.lock:
+            return (self._get(name, _SortedSet) or {}).get(_encode(value))
+
+    def zcard(self, name):
+        with self.lock:
+            return len(self._get(name, _SortedSet) or ())
+
+    def zrank(self, name, value):
+        with self.lock:
+            for i, (member, _) in enumerate(self._sorted(name)):
+                if member == _encode(value):
+                    return i
+
+    def zrange(self, name, start, end, desc=False, withscores=False, score_cast_func=float):
+        with self.lock:
+            items = self._sorted(name)
+            if desc:
+                items.reverse()
+            items = items[slice(*_range(len(items), start, end))]
+            return [(m, score_cast_func(s)) for m, s in items] if withscores else [m for m, _ in items]
+
+    def zrevrange(self, name, start, end, withscores=False, score_cast_func=float):
+        return self.zrange(name, start, end, True, withscores, score_cast_func)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None, withscores=False, score_cast_func=float):
+        (min_, min_exclusive), (max_, max_exclusive) = _score_bound(min), _score_bound(max)
+        with self.lock:
+            items = [(m, s) for m, s in self._sorted(name)
+                     if (s > min_ if min_exclusive else s >= min_) and (s < max_ if max_exclusive else s <= max_)]
+            if start is not None:
+                items = items[int(start):int(start) + int(num)] if int(num) >= 0 else items[int(start):]
+            return [(m, score_cast_func(s)) for m, s in items] if withscores else [m for m, _ in items]
+
+    def zcount(self, name, min, max):
+        return len(self.zrangebyscore(name, min, max))
+
+    def zremrangebyscore(self, name, min, max):
+        with self.lock:
+            members = self.zrangebyscore(name, min, max)
+            return self.zrem(name, *members) if len(members) != 0 else 0
+
+    def zscan(self, name, cursor=0, match=None, count=None, score_cast_func=float):
+        """ Members are scanned in bytes order, cursor encodes the last returned member,
+        so every member present during whole scan is returned exactly once """
+        cursor = int(cursor)
+        last = cursor.to_bytes((cursor.bit_length() + 7) // 8, 'big')[1:] if cursor != 0 else None
+        with self.lock:
+            items = sorted(i for i in (self._get(name, _SortedSet) or {}).items() if last is None or i[0] > last)
+        page = items[:int(count or 10)]
+        cursor = int.from_bytes(b'\x01' + page[-1][0], 'big') if len(page) < len(items) else 0
+        if match is not None:
+            match = match.decode() if isinstance(match, bytes) else match
+            page = [(m, s) for m, s in page if fnmatchcase(m.decode('latin-1'), match)]
+        return cursor, [(m, score_cast_func(s)) for m, s in page]
+
+    def zscan_iter(self, name, match=None, count=None, score_cast_func=float):
+        cursor = None
+        while cursor != 0:
+            cursor, items = self.zscan(name, cursor or 0, match, count, score_cast_func)
+            yield from items
+
+    # HyperLogLogs
+
+    @_write
+    def pfadd(self, name, *values):
+        with self.lock:
+            hll = self._get_or_create(name, _HyperLogLog)
+            count = len(hll.members)
+            hll.members.update(_encode(v) for v in values)
+            return int(len(hll.members) != count)
+
+    def pfcount(self, *sources):
+        """ Count is exact, redis estimates it with 0.81% standard error """
+        with self.lock:
+            members = set()
+            for source in sources:
+                members.update((self._get(source, _HyperLogLog) or _HyperLogLog()).members)
+            return len(members)
+
+    # Streams
+
+    def xadd(self, name, fields, id='*', maxlen=None, approximate=True):
+        """ Append entry, id is generated from current time unless given. Stream is trimmed exactly to maxlen """
+        with self.lock:
+            stream = self._get(name, _Stream)
+            last = stream.last_id if stream is not None else (0, 0)
+            if _encode(id) == b'*':
+                milliseconds = int(time.time() * 1000)
+                id_ = (milliseconds, 0) if milliseconds > last[0] else (last[0], last[1] + 1)
+            else:
+                id_ = _parse_id(id)
+                if id_ <= last:
+                    raise StorageError('ERR The ID specified in XADD is equal or smaller than '
+                                       'the target stream top item')
+            self._append(name, _format_id(id_), *(x for field in fields.items() for x in field))
+            if maxlen is not None:
+                self.xtrim(name, maxlen)
+            self.streams_changed.notify_all()
+            return _format_id(id_)
+
+    @_write
+    def _append(self, name, id_, *fields):
+        stream = self._get_or_create(name, _Stream)
+        stream.add(_parse_id(id_), {_encode(f): _encode(v) for f, v in zip(fields[::2], fields[1::2])})
+
+    @_write
+    def _restore_stream(self, name, last_id, groups):
+        """ Restore last id and consumer groups of stream rewritten to append-only file """
+        stream = self._get_or_create(name, _Stream)
+        stream.last_id = _parse_id(last_id)
+        stream.load_groups(groups)
+
+    @_write
+    def xtrim(self, name, maxlen, approximate=True):
+        with self.lock:
+            stream = self._get(name, _Stream)
+            return stream.trim(int(maxlen)) if stream is not None else 0
+
+    def xlen(self, name):
+        with self.lock:
+            stream = self._get(name, _Stream)
+            return len(stream.ids) if stream is not None else 0
+
+    def xrange(self, name, min='-', max='+', count=None):
+        with self.lock:
+            stream = self._get(name, _Stream)
+            if stream is None:
+                return []
+            ids = stream.range(_parse_id(min), _parse_id(max, MAX_STREAM_ID[1]))
+            return [(_format_id(i), dict(stream.entries[i])) for i in ids[:count]]
+
+    def _group(self, name, groupname):
+        stream = self._get(name, _Stream)
+        group = stream.groups.get(_encode(groupname)) if stream is not None else None
+        if group is None:
+            raise StorageError('NOGROUP No such key \'%s\' or consumer group \'%s\'' % (name, groupname))
+        return stream, group
+
+    @_write
+    def xgroup_create(self, name, groupname, id='$', mkstream=False):
+        with self.lock:
+            stream = self._get(name, _Stream)
+            if stream is None:
+                if not mkstream:
+                    raise StorageError('ERR The XGROUP subcommand requires the key to exist')
+                stream = self._get_or_create(name, _Stream)
+            if _encode(groupname) in stream.groups:
+                raise StorageError('BUSYGROUP Consumer Group name already exists')
+            stream.groups[_encode(groupname)] = _ConsumerGroup(stream.last_id if _encode(id) == b'$' else
+                                                               _parse_id(id))
+            return True
+
+    @_write
+    def xgroup_destroy(self, name, groupname):
+        with self.lock:
+            stream = self._get(name, _Stream)
+            return int(stream is not None and stream.groups.pop(_encode(groupname), None) is not None)
+
+    @_write
+    def xgroup_delconsumer(self, name, groupname, consumername):
+        """ Forget consumer, its pending entries are dropped """
+        with self.lock:
+            _, group = self._group(name, groupname)
+            pending = [i for i, p in group.pending.items() if p[0] == _encode(consumername)]
+            for id_ in pending:
+                del group.pending[id_]
+            return len(pending)
+
+    def xreadgroup(self, groupname, consumername, streams, count=None, block=None, noack=False):
+        """ Return [[stream, [(id, fields), ...]], ...] for streams name to id map, id '>' reads new entries,
+        other ids read pending entries of consumer. Waits block milliseconds for new entries if it is given """
+        deadline = time.time() + block / 1000 if block else None
+        streams = tuple(x for item in streams.items() for x in item)
+        with self.streams_changed:
+            while True:
+                result = self._read_group(groupname, consumername, *streams, count=count, noack=noack)
+                remaining = deadline - time.time() if deadline is not None else 0
+                if len(result) != 0 or remaining <= 0:
+                    return result
+                self.streams_changed.wait(remaining)
+
+    def _read_group(self, groupname, consumername, *streams, count=None, noack=False):
+        """ Read without waiting, only delivery of new entries changes group and is logged """
+        consumer = _encode(consumername)
+        now = int(time.time() * 1000)
+        result = []
+        for name, id_ in zip(streams[::2], streams[1::2]):
+            stream, group = self._group(name, groupname)
+            if _encode(id_) == b'>':
+                ids = stream.range(group.last_id, MAX_STREAM_ID, exclusive=True)[:count]
+                if len(ids) != 0:
+                    self._deliver(name, groupname, consumer, now, _format_id(ids[-1]),
+                                  *(_format_id(i) for i in ids if not noack))
+            else:
+                start = _parse_id(id_)
+                ids = [i for i, p in group.pending.items() if p[0] == consumer and i > start][:count]
+            if len(ids) != 0:
+                result.append([_encode(name), [(_format_id(i), stream.get(i)) for i in ids]])
+        return result
+
+    @_write
+    def _deliver(self, name, groupname, consumername, time_ms, last_id, *ids):
+        """ Move group to last_id, ids become pending entries of consumer delivered at time_ms """
+        _, group = self._group(name, groupname)
+        group.last_id = _parse_id(last_id)
+        for id_ in map(_parse_id, ids):
+            group.pending[id_] = [_encode(consumername), int(time_ms), 1]
+
+    @_write
+    def xack(self, name, groupname, *ids):
+        with self.lock:
+            stream = self._get(name, _Stream)
+            group = stream.groups.get(_encode(groupname)) if stream is not None else None
+            if group is None:
+                return 0
+            return sum(group.pending.pop(_parse_id(i), None) is not None for i in ids)
+
+    def xpending_range(self, name, groupname, min, max, count, consumername=None):
+        with self.lock:
+            _, group = self._group(name, groupname)
+            low, high = _parse_id(min), _parse_id(max, MAX_STREAM_ID[1])
+            now = int(time.time() * 1000)
+            return [{'message_id': _format_id(i), 'consumer': p[0], 'time_since_delivered': now - p[1],
+                     'times_delivered': p[2]}
+                    for i, p in group.pending.items()
+                    if low <= i <= high and (consumername is None or p[0] == _encode(consumername))][:count]
+
+    def xclaim(self, name, groupname, consumername, min_idle_time, message_ids):
+        """ Take pending entries idle at least min_idle_time milliseconds, return their [(id, fields), ...] """
+        with self.lock:
+            _, group = self._group(name, groupname)
+            now = int(time.time() * 1000)
+            ids = [_format_id(i) for i in map(_parse_id, message_ids)
+                   if i in group.pending and now - group.pending[i][1] >= int(min_idle_time)]
+            return self._claim(name, groupname, consumername, now, *ids) if len(ids) != 0 else []
+
+    @_write
+    def _claim(self, name, groupname, consumername, time_ms, *ids):
+        """ Transfer pending ids to consumer at time_ms, logged with time for the same state after replay """
+        stream, group = self._group(name, groupname)
+        claimed = []
+        for id_ in map(_parse_id, ids):
+            if stream.get(id_) is None or id_ not in group.pending:  # Entry is trimmed or acknowledged
+                group.pending.pop(id_, None)
+                continue
+            group.pending[id_] = [_encode(consumername), int(time_ms), group.pending[id_][2] + 1]
+            claimed.append((_format_id(id_), stream.get(id_)))
+        return claimed
+
+    # Pub/sub
+
+    def publish(self, channel, message):
+        channel, message = _encode(channel), _encode(message)
+        with self.lock:
+            subscribers = tuple(self.subscribers)
+        return sum(s.deliver(channel, message) for s in subscribers)
+
+    def pubsub(self, ignore_subscribe_messages=False, **kwargs):
+        return MemoryPubSub(self, ignore_subscribe_messages)
+
+    # Pipelines and scripts
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return MemoryPipeline(self)
+
+    def register_script(self, script):
+        if script not in PYTHON_SCRIPTS:
+            raise StorageError('No python implementation for script')
+        implementation = PYTHON_SCRIPTS[script]
+
+        def run(keys=(), args=(), client=None):
+            client = client if client is not None else self
+            if isinstance(client, MemoryPipeline):  # Script is executed with other buffered commands
+                client.commands.append((run, (keys, args, client.storage), {}))
+                return client
+            with client.lock:
+                return implementation(client, list(keys), list(args))
+
+        return run
+
+
+class _Hash(dict):
+    pass
+
+
+class _SortedSet(dict):
+    pass
+
+
+class _ConsumerGroup:
+    def __init__(self, last_id):
+        self.last_id = last_id  # Id of the last entry delivered to group
+        self.pending = {}  # Id of delivered not acknowledged entry to [consumer, delivery time ms, deliveries count]
+
+
+class _Stream:
+    """ Entries in order of ids with consumer groups """
+
+    def __init__(self):
+        self.ids = []
+        self.entries = {}
+        self.last_id = (0, 0)
+        self.groups = {}
+
+    def __len__(self):
+        return len(self.ids) + len(self.groups)  # Stream with groups is kept when empty
+
+    def add(self, id_, fields):
+        self.ids.append(id_)
+        self.entries[id_] = fields
+        self.last_id = id_
+
+    def get(self, id_):
+        fields = self.entries.get(id_)
+        return dict(fields) if fields is not None else None
+
+    def range(self, low, high, exclusive=False):
+        start = (bisect.bisect_right if exclusive else bisect.bisect_left)(self.ids, low)
+        return self.ids[start:bisect.bisect_right(self.ids, high)]
+
+    def trim(self, maxlen):
+        trimmed = self.ids[:max(len(self.ids) - maxlen, 0)]
+        for id_ in trimmed:
+            del self.entries[id_]
+        del self.ids[:len(trimmed)]
+        return len(trimmed)
+
+    def dump_groups(self):
+        return json.dumps({n.decode('latin-1'): [list(g.last_id), [list(i) + [p[0].decode('latin-1')] + p[1:]
+                                                                  for i, p in g.pending.items()]]
+                           for n, g in self.groups.items()})
+
+    def load_groups(self, groups):
+        for name, (last_id, pending) in json.loads(_encode(groups).decode('latin-1')).items():
+            group = self.groups[name.encode('latin-1')] = _ConsumerGroup(tuple(last_id))
+            for milliseconds, sequence, consumer, delivered, deliveries in pending:
+                group.pending[(milliseconds, sequence)] = [consumer.encode('latin-1'), delivered, deliveries]
+
+
+class _HyperLogLog:
+    """ Exact stand-in of redis HyperLogLog, redis stores it as string """
+
+    def __init__(self):
+        self.members = set()
+
+
+class MemoryPipeline:
+    """ Buffers commands, execute() runs them atomically """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.commands = []
+
+    def __getattr__(self, item):
+        method = getattr(self.storage, item)
+
+        def buffered(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+
+        return buffered
+
+    def register_script(self, script):
+        return self.storage.register_script(script)
+
+    def execute(self, raise_on_error=True):
+        with self.storage.lock:
+            commands, self.commands = self.commands, []
+            return [method(*args, **kwargs) for method, args, kwargs in commands]
+
+    def reset(self):
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.reset()
+
+
+class MemoryPubSub:
+    """ Subscription to storage channels, compatible with redis-py PubSub """
+
+    def __init__(self, storage, ignore_subscribe_messages=False):
+        self.storage = storage
+        self.ignore_subscribe_messages = ignore_subscribe_messages
+        self.channels = {}  # Channel to handler map
+        self.patterns = {}
+        self.messages = queue.Queue()
+        self.lock = threading.Lock()
+
+    @property
+    def subscribed(self):
+        return len(self.channels) != 0 or len(self.patterns) != 0
+
+    def deliver(self, channel, data):
+        """ Queue published message, return count of matched subscriptions """
+        delivered = 0
+        with self.lock:
+            if channel in self.channels:
+                self.messages.put({'type': 'message', 'pattern': None, 'channel': channel, 'data': data})
+                delivered += 1
+            for pattern in self.patterns:
+                if fnmatchcase(channel.decode(), pattern.decode()):
+                    self.messages.put({'type': 'pmessage', 'pattern': pattern, 'channel': channel, 'data': data})
+                    delivered += 1
+        return delivered
+
+    def _subscribe(self, subscriptions, type_, args, kwargs):
+        with self.lock:
+            new = {_encode(c): None for c in args}
+            new.update((_encode(c), h) for c, h in kwargs.items())
+            subscriptions.update(new)
+            for channel in new:
+                self.messages.put({'type': type_, 'pattern': None, 'channel': channel,
+                                   'data': len(self.channels) + len(self.patterns)})
+        with self.storage.lock:
+            self.storage.subscribers.add(self)
+
+    def _unsubscribe(self, subscriptions, type_, args):
+        with self.lock:
+            for channel in [_encode(c) for c in args] or tuple(subscriptions):
+                if subscriptions.pop(channel, False) is not False:
+                    self.messages.put({'type': type_, 'pattern': None, 'channel': channel,
+                                       'data': len(self.channels) + len(self.patterns)})
+        if not self.subscribed:
+            with self.storage.lock:
+                self.storage.subscribers.discard(self)
+
+    def subscribe(self, *args, **kwargs):
+        self._subscribe(self.channels, 'subscribe', args, kwargs)
+
+    def psubscribe(self, *args, **kwargs):
+        self._subscribe(self.patterns, 'psubscribe', args, kwargs)
+
+    def unsubscribe(self, *args):
+        self._unsubscribe(self.channels, 'unsubscribe', args)
+
+    def punsubscribe(self, *args):
+        self._unsubscribe(self.patterns, 'punsubscribe', args)
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0):
+        deadline = time.time() + (timeout or 0)
+        while True:
+            try:
+                remaining = deadline - time.time()
+                message = self.messages.get(timeout=remaining) if remaining > 0 else self.messages.get_nowait()
+            except queue.Empty:
+                return None
+            if message['type'] in ('message', 'pmessage'):
+                handlers = self.channels if message['type'] == 'message' else self.patterns
+                handler = handlers.get(message['pattern'] or message['channel'])
+                if handler is not None:
+                    handler(message)
+                    continue
+                return message
+            elif not (ignore_subscribe_messages or self.ignore_subscribe_messages):
+                return message
+
+    def listen(self):
+        while self.subscribed or not self.messages.empty():
+            message = self.get_message(timeout=1)
+            if message is not None:
+                yield message
+
+    def close(self):
+        self.unsubscribe()
+        self.punsubscribe()
+
+    reset = close
@@ -0,0 +1,267 @@
+""" Running of bot contexts by pool of worker processes on one or many hosts.
+
+Every context runs in one worker, worker owns it by expiring lease 'bot_contexts:<id>:lease' holding worker id.
+Workers heartbeat to 'workers' sorted set scored by time of the last heartbeat. On every heartbeat worker
+renews its leases, stops bots of lost ones, releases contexts above its fair share (contexts count divided by
+live workers count, rounded up) and acquires free contexts up to it. Leases of crashed workers expire and
+their contexts move to other workers, contexts of busy workers move to joined ones.
+
+Usage: python -m telegram_bot_constructor.supervisor [redis url] [processes count] """
+import math
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from logging import getLogger
+
+from . import set_redis_connection, get_redis_connection
+from .runner import BotRunnerContext
+from .scripts import PYTHON_SCRIPTS, run_script
+from .storage import connect
+
+LEASE_TIME = 15  # Seconds, worker heartbeats three times per lease time
+START_RETRY_DELAY = 60  # Seconds before next attempt to start context which failed to start
+WORKERS_KEY = 'workers'
+
+logger = getLogger('Supervisor')
+
+# Prolong leases KEYS owned by ARGV[1] for ARGV[2] milliseconds, return list of 1 for renewed, 0 for lost leases
+RENEW_LEASES = """
+local renewed = {}
+for i, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[1] then
+        redis.call('PEXPIRE', key, ARGV[2])
+        renewed[i] = 1
+    else
+        renewed[i] = 0
+    end
+end
+return renewed
+"""
+
+# Delete leases KEYS owned by ARGV[1], return count of deleted leases
+RELEASE_LEASES = """
+local released = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[1] then
+        redis.call('DEL', key)
+        released = released + 1
+    end
+end
+return released
+"""
+
+
+def _renew_leases(storage, keys, args):
+    """ RENEW_LEASES for embedded storage """
+    renewed = []
+    for key in keys:
+        owned = storage.get(key) == (args[0] if isinstance(args[0], bytes) else str(args[0]).encode())
+        if owned:
+            storage.pexpire(key, int(args[1]))
+        renewed.append(int(owned))
+    return renewed
+
+
+def _release_leases(storage, keys, args):
+    """ RELEASE_LEASES for embedded storage """
+    owner = args[0] if isinstance(args[0], bytes) else str(args[0]).encode()
+    return sum(storage.delete(key) for key in keys if storage.get(key) == owner)
+
+
+PYTHON_SCRIPTS[RENEW_LEASES] = _renew_leases
+PYTHON_SCRIPTS[RELEASE_LEASES] = _release_leases
+
+
+def lease_key(context_id):
+    return 'bot_contexts:%d:lease' % context_id
+
+
+def live_workers(redis_=None, lease_time=LEASE_TIME):
+    """ Return ids of workers which heartbeated during the last lease time """
+    redis_ = redis_ if redis_ is not None else get_redis_connection()
+    return tuple(w.decode() for w in redis_.zrangebyscore(WORKERS_KEY, time.time() - lease_time, '+inf'))
+
+
+def _run_context(context_id):
+    BotRunnerContext(context_id).run()
+
+
+def _stop_context(context_id):
+    BotRunnerContext(context_id, check=False).stop()
+
+
+def _runnable_contexts(redis_):
+    """ Return ids of contexts with selected template and token """
+    ids = redis_.lrange('bot_contexts_list', 0, -1)
+    pipeline = redis_.pipeline(transaction=False)
+    for id_ in ids:
+        pipeline.hmget('bot_contexts:%d' % int(id_), 'bot_template', 'token')
+    results = pipeline.execute() if len(ids) != 0 else ()
+    return tuple(int(id_) for id_, fields in zip(ids, results) if None not in fields)
+
+
+class Worker:
+    """ Owner of part of bot contexts, start and stop are called with context id to run and stop its bot """
+
+    def __init__(self, redis_=None, worker_id=None, lease_time=LEASE_TIME, start=_run_context, stop=_stop_context,
+                 contexts=_runnable_contexts):
+        self.redis = redis_ if redis_ is not None else get_redis_connection()
+        self.id = worker_id if worker_id is not None else '%s:%d:%04x' % (socket.gethostname(), os.getpid(),
+                                                                          random.getrandbits(16))
+        self.lease_time = lease_time
+        self.start = start
+        self.stop = stop
+        self.contexts = contexts  # Function returning ids of contexts to run
+        self.owned = set()  # Ids of contexts running in worker
+        self.failed = {}  # Id of context failed to start to time of next attempt map
+
+    def heartbeat(self):
+        """ Renew leases and rebalance contexts, return (started contexts ids, stopped contexts ids).
+        Contexts are started during at most third of lease time, the rest is started by next heartbeats """
+        deadline = time.monotonic() + self.lease_time / 3
+        now = time.time()
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.zadd(WORKERS_KEY, self.id, now)
+        pipeline.zremrangebyscore(WORKERS_KEY, '-inf', '(%r' % (now - self.lease_time))
+        pipeline.zcard(WORKERS_KEY)
+        workers_count = pipeline.execute()[2]
+        stopped = self._renew()
+        contexts = self.contexts(self.redis)
+        share = math.ceil(len(contexts) / workers_count)
+        stopped += self._release(set(self.owned) - set(contexts))
+        if len(self.owned) > share:
+            stopped += self._release(sorted(self.owned)[share:])
+        started = []
+        if len(self.owned) < share:
+            started, lost = self._acquire(contexts, share - len(self.owned), deadline)
+            stopped += lost
+        return started, stopped
+
+    def _renew(self):
+        """ Renew leases, stop bots of lost ones and return their ids """
+        owned = sorted(self.owned)
+        renewed = run_script(self.redis, RENEW_LEASES, [lease_key(i) for i in owned],
+                             [self.id, int(self.lease_time * 1000)]) if len(owned) != 0 else ()
+        lost = [i for i, r in zip(owned, renewed) if not int(r)]
+        for context_id in lost:
+            logger.warning('Lease of bot context %d is lost by worker %s' % (context_id, self.id))
+            self._stop(context_id)
+        return lost
+
+    def _release(self, contexts_ids):
+        """ Stop bots and release their leases, return ids of released contexts """
+        contexts_ids = sorted(contexts_ids)
+        for context_id in contexts_ids:
+            self._stop(context_id)
+        if len(contexts_ids) != 0:
+            run_script(self.redis, RELEASE_LEASES, [lease_key(i) for i in contexts_ids], [self.id])
+        return contexts_ids
+
+    def _acquire(self, contexts_ids, count, deadline):
+        """ Take free contexts one by one and start their bots until count of them is started or monotonic
+        deadline passes. Owned leases are renewed between starts, so they do not expire while slow bots start.
+        Return (started contexts ids, ids of contexts with lost leases) """
+        now = time.time()
+        candidates = [i for i in contexts_ids if i not in self.owned and self.failed.get(i, 0) <= now]
+        if len(candidates) == 0:
+            return [], []
+        leases = self.redis.mget([lease_key(i) for i in candidates])
+        free = [i for i, owner in zip(candidates, leases) if owner is None]
+        random.shuffle(free)  # Workers taking contexts at the same time mostly do not compete for the same ones
+        started, lost = [], []
+        for attempt, context_id in enumerate(free):
+            if len(started) == count or time.monotonic() >= deadline:
+                break
+            if attempt != 0:
+                lost += self._renew()
+            if not self.redis.set(lease_key(context_id), self.id, px=int(self.lease_time * 1000), nx=True):
+                continue  # Taken by other worker
+            try:
+                self.start(context_id)
+            except Exception:
+                logger.exception('Bot context %d failed to start' % context_id)
+                self.failed[context_id] = now + START_RETRY_DELAY
+                run_script(self.redis, RELEASE_LEASES, [lease_key(context_id)], [self.id])
+                continue
+            self.owned.add(context_id)
+            self.failed.pop(context_id, None)
+            started.append(context_id)
+        return started, lost
+
+    def _stop(self, context_id):
+        self.owned.discard(context_id)
+        try:
+            self.stop(context_id)
+        except Exception:
+            logger.exception('Bot context %d failed to stop' % context_id)
+
+    def run(self, stopped=None):
+        """ Heartbeat until stopped event is set, then release all contexts """
+        stopped = stopped if stopped is not None else threading.Event()
+        try:
+            while True:
+                try:
+                    started, released = self.heartbeat()
+                    if len(started) != 0 or len(released) != 0:
+                        logger.info('Worker %s started %s, stopped %s, runs %d bot contexts' %
+                                    (self.id, started, released, len(self.owned)))
+                except Exception:
+                    logger.exception('Heartbeat of worker %s failed' % self.id)
+                if stopped.wait(self.lease_time / 3):
+                    break
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """ Stop all bots, release leases and leave workers """
+        self._release(self.owned)
+        self.redis.zrem(WORKERS_KEY, self.id)
+
+
+def _worker_process(url, stopped):
+    set_redis_connection(connect(url))
+    Worker().run(stopped)
+
+
+class Supervisor:
+    """ Pool of worker processes, dead processes are restarted """
+
+    def __init__(self, url, processes=None):
+        self.url = url
+        self.processes_count = processes if processes is not None else os.cpu_count()
+        self.stopped = multiprocessing.Event()
+        self.processes = []
+
+    def _spawn(self):
+        process = multiprocessing.Process(target=_worker_process, args=(self.url, self.stopped), daemon=False)
+        process.start()
+        return process
+
+    def run(self, check_interval=1):
+        """ Run workers until stop() or KeyboardInterrupt """
+        self.processes = [self._spawn() for _ in range(self.processes_count)]
+        try:
+            while not self.stopped.wait(check_interval):
+                for i, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        logger.warning('Worker process %d exited with code %s, restarting' %
+                                       (process.pid, process.exitcode))
+                        self.processes[i] = self._spawn()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.stopped.set()
+        for process in self.processes:
+            process.join()
+
+
+if __name__ == '__main__':
+    Supervisor(sys.argv[1] if len(sys.argv) > 1 else 'redis://127.0.0.1:6379/0',
+               int(sys.argv[2]) if len(sys.argv) > 2 else None).run()
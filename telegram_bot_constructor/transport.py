@@ -0,0 +1,382 @@
+""" Transports of operators events between bots and operator clients.
+
+Events are published to '<event>:<operator token>' channels (see operators_server). PubSubTransport delivers
+them by redis PUBLISH, subscriber disconnected at the moment of publishing misses event.
+StreamTransport appends event to stream of its recipients, recipients read stream by consumer group and
+acknowledge handled events: events published while recipient is disconnected wait for it, events delivered to
+crashed consumer are reclaimed by other consumer of group after RECLAIM_IDLE seconds. Streams are trimmed
+to about STREAM_MAXLEN entries. Async subscriptions poll streams every POLL_INTERVAL seconds, blocking reads
+would stall other commands multiplexed to connection of aioredis pool. Transport of process is set by
+operators_server.set_transport """
+import asyncio
+import json
+import os
+import socket
+import time
+from collections import deque
+from logging import getLogger
+
+from .helpers import random_token
+
+STREAM_MAXLEN = 10000
+READ_COUNT = 100  # Entries read by one XREADGROUP
+RECLAIM_IDLE = 30  # Seconds after which entry delivered to consumer and not acknowledged is reclaimed
+RECLAIM_INTERVAL = 10  # Seconds between checks of pending entries
+MAX_DELIVERIES = 5  # Entry delivered more times is acknowledged and dropped
+POLL_INTERVAL = 0.1  # Seconds between reads of async subscription without new entries
+
+logger = getLogger('Transport')
+
+
+class PubSubTransport:
+    """ Fire-and-forget delivery by redis pub/sub """
+
+    def publish(self, redis_, channel, data):
+        redis_.publish(channel, data)
+
+    async def apublish(self, redis_, channel, data):
+        await redis_.publish(channel, data)
+
+    def subscribe(self, redis_, channels, group=None):
+        """ Return redis PubSub subscribed to channels, group is not used """
+        pubsub = redis_.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(*channels)
+        return pubsub
+
+
+class StreamTransport:
+    """ Delivery by redis streams, route(channel) returns stream of channel recipients
+    or None for channels delivered by pub/sub """
+
+    def __init__(self, route, maxlen=STREAM_MAXLEN, count=READ_COUNT, reclaim_idle=RECLAIM_IDLE,
+                 reclaim_interval=RECLAIM_INTERVAL, max_deliveries=MAX_DELIVERIES):
+        self.route = route
+        self.maxlen = maxlen
+        self.count = count
+        self.reclaim_idle = reclaim_idle
+        self.reclaim_interval = reclaim_interval
+        self.max_deliveries = max_deliveries
+
+    def publish(self, redis_, channel, data):
+        stream = self.route(channel)
+        if stream is None:
+            redis_.publish(channel, data)
+        else:
+            streams(redis_).xadd(stream, {'channel': channel, 'data': data}, maxlen=self.maxlen)
+
+    async def apublish(self, redis_, channel, data):
+        stream = self.route(channel)
+        if stream is None:
+            await redis_.publish(channel, data)
+        else:
+            await redis_.execute(b'XADD', stream, b'MAXLEN', b'~', self.maxlen, b'*', b'channel', channel,
+                                 b'data', data)
+
+    def subscribe(self, redis_, channels, group=None):
+        """ Return subscription reading streams of channels. Subscription with group continues from events
+        not handled by previous subscription of the same group, otherwise events before subscribing are skipped """
+        return StreamSubscription(self, redis_, channels, group)
+
+    def asubscribe(self, redis_, group=None):
+        """ Return AsyncStreamSubscription of aioredis connection, group is used like by subscribe() """
+        return AsyncStreamSubscription(self, redis_, group)
+
+
+class StreamSubscription:
+    """ Reader of streams of channels by consumer group, compatible with redis PubSub get_message(),
+    subscribe(), unsubscribe() and close(). Returned events are acknowledged by the next read from storage,
+    so events returned before crash of consumer are delivered again """
+
+    def __init__(self, transport, redis_, channels, group=None):
+        self.transport = transport
+        self.redis = streams(redis_)
+        self.durable = group is not None
+        self.group = group if group is not None else 'subscription:%s' % random_token()
+        self.consumer = '%s:%d:%s' % (socket.gethostname(), os.getpid(), random_token(8))
+        self.channels = set()
+        self.streams = {}  # Stream to count of subscribed channels routed to it map
+        self.buffer = deque()  # (stream, id, message) read and not returned yet
+        self.handled = {}  # Stream to ids of returned not acknowledged entries map
+        self.reclaimed = 0  # Time of the last check of pending entries
+        self.subscribe(*channels)
+
+    def subscribe(self, *channels):
+        for channel in channels:
+            channel = channel.decode() if isinstance(channel, bytes) else channel
+            stream = self.transport.route(channel)
+            if stream is None or channel in self.channels:
+                continue
+            self.channels.add(channel)
+            if stream not in self.streams:
+                self._create_group(stream)
+            self.streams[stream] = self.streams.get(stream, 0) + 1
+
+    def unsubscribe(self, *channels):
+        for channel in channels:
+            channel = channel.decode() if isinstance(channel, bytes) else channel
+            if channel in self.channels:
+                self.channels.remove(channel)
+                stream = self.transport.route(channel)
+                self.streams[stream] -= 1
+                if self.streams[stream] == 0:
+                    del self.streams[stream]
+                    self.buffer = deque(e for e in self.buffer if e[0] != stream)  # Pending entries are reclaimed
+                    self._close_stream(stream)
+
+    def _create_group(self, stream):
+        try:
+            self.redis.xgroup_create(stream, self.group, '$', mkstream=True)
+        except Exception as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def _close_stream(self, stream):
+        self._ack()
+        if not self.durable:
+            self.redis.xgroup_destroy(stream, self.group)
+        elif not any(e[0] == stream for e in self.buffer):
+            self.redis.xgroup_delconsumer(stream, self.group, self.consumer)
+
+    def get_message(self, timeout=0):
+        """ Return next event as pub/sub message, None if there are no events during timeout seconds """
+        if len(self.buffer) == 0:
+            self._ack()
+            if time.monotonic() - self.reclaimed >= self.transport.reclaim_interval:
+                self._reclaim()
+        if len(self.buffer) == 0:
+            if len(self.streams) == 0:
+                time.sleep(timeout)
+                return None
+            self._read(timeout)
+        if len(self.buffer) != 0:
+            stream, id_, message = self.buffer.popleft()
+            self.handled.setdefault(stream, []).append(id_)
+            return message
+
+    def _read(self, timeout):
+        try:
+            result = self.redis.xreadgroup(self.group, self.consumer, {s: '>' for s in self.streams},
+                                           count=self.transport.count,
+                                           block=int(timeout * 1000) if timeout else None)
+        except Exception as e:
+            if 'NOGROUP' not in str(e):
+                raise
+            for stream in self.streams:  # Stream is deleted
+                self._create_group(stream)
+            return
+        for stream, entries in result:
+            stream = stream.decode() if isinstance(stream, bytes) else stream
+            self._buffer(stream, entries)
+
+    def _buffer(self, stream, entries):
+        for id_, fields in entries:
+            if fields is None or _decode(fields[b'channel']) not in self.channels:  # Trimmed or not subscribed
+                self.redis.xack(stream, self.group, id_)
+                continue
+            self.buffer.append((stream, id_, {'type': 'message', 'pattern': None,
+                                              'channel': fields[b'channel'], 'data': fields[b'data']}))
+
+    def _ack(self):
+        for stream, ids in self.handled.items():
+            self.redis.xack(stream, self.group, *ids)
+        self.handled = {}
+
+    def _reclaim(self):
+        """ Take entries of other consumers idle for reclaim idle time, drop entries failed max deliveries times """
+        self.reclaimed = time.monotonic()
+        idle = int(self.transport.reclaim_idle * 1000)
+        for stream in tuple(self.streams):
+            pending = self.redis.xpending_range(stream, self.group, '-', '+', self.transport.count)
+            dropped, claimed = _stale(self.transport, stream, self.consumer, pending)
+            if len(dropped) != 0:
+                self.redis.xack(stream, self.group, *dropped)
+            if len(claimed) != 0:
+                self._buffer(stream, self.redis.xclaim(stream, self.group, self.consumer, idle, claimed))
+
+    def close(self):
+        """ Acknowledge returned events and leave streams, events left in buffer are reclaimed later """
+        for stream in tuple(self.streams):
+            self._close_stream(stream)
+        self.streams = {}
+        self.channels = set()
+        self.buffer.clear()
+
+
+class AsyncStreamSubscription:
+    """ Reader of streams of channels by consumer group for asyncio, interface is the same as of
+    operators_server.AsyncSharedPubSub. Entries are acknowledged after their handlers complete """
+
+    def __init__(self, transport, redis_, group=None):
+        self.transport = transport
+        self.redis = redis_
+        self.durable = group is not None
+        self.group = group if group is not None else 'subscription:%s' % random_token()
+        self.consumer = '%s:%d:%s' % (socket.gethostname(), os.getpid(), random_token(8))
+        self.routes = {}  # Channel to handlers map
+        self.streams = {}  # Stream to count of subscribed channels routed to it map
+        self.reclaimed = 0
+        self.reader = None
+
+    async def subscribe(self, handler, channels):
+        """ Call await handler(channel, data) with decoded data of every event of channels routed to streams """
+        for channel in channels:
+            stream = self.transport.route(channel)
+            if stream is None:
+                continue
+            handlers = self.routes.setdefault(channel, [])
+            if len(handlers) == 0:
+                if stream not in self.streams:
+                    await self._create_group(stream)
+                self.streams[stream] = self.streams.get(stream, 0) + 1
+            handlers.append(handler)
+        if len(self.streams) != 0 and (self.reader is None or self.reader.done()):
+            self.reader = asyncio.ensure_future(self._read())
+
+    async def unsubscribe(self, handler, channels):
+        for channel in channels:
+            handlers = self.routes.get(channel, [])
+            if handler in handlers:
+                handlers.remove(handler)
+                if len(handlers) == 0:
+                    del self.routes[channel]
+                    stream = self.transport.route(channel)
+                    self.streams[stream] -= 1
+                    if self.streams[stream] == 0:
+                        del self.streams[stream]
+                        await self._close_stream(stream)
+
+    async def _create_group(self, stream):
+        try:
+            await self.redis.execute(b'XGROUP', b'CREATE', stream, self.group, b'$', b'MKSTREAM')
+        except Exception as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    async def _close_stream(self, stream):
+        if len(self.streams) == 0 and self.reader is not None:
+            self.reader.cancel()  # Entries read and not handled are reclaimed
+            self.reader = None
+        if not self.durable:
+            await self.redis.execute(b'XGROUP', b'DESTROY', stream, self.group)
+        else:
+            await self.redis.execute(b'XGROUP', b'DELCONSUMER', stream, self.group, self.consumer)
+
+    async def _read(self):
+        while len(self.streams) != 0:
+            try:
+                if time.monotonic() - self.reclaimed >= self.transport.reclaim_interval:
+                    await self._reclaim()
+                streams = tuple(self.streams)
+                reply = await self.redis.execute(b'XREADGROUP', b'GROUP', self.group, self.consumer,
+                                                 b'COUNT', self.transport.count, b'STREAMS', *streams,
+                                                 *((b'>',) * len(streams)))
+                for stream, entries in reply or ():
+                    await self._handle(stream.decode(), ((id_, _fields(values)) for id_, values in entries))
+                if reply is None:
+                    await asyncio.sleep(POLL_INTERVAL)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if 'NOGROUP' in str(e):  # Stream is deleted
+                    for stream in tuple(self.streams):
+                        await self._create_group(stream)
+                else:
+                    logger.exception('Streams %s are not read' % tuple(self.streams))
+                    await asyncio.sleep(POLL_INTERVAL)
+
+    async def _handle(self, stream, entries):
+        handled = []
+        for id_, fields in entries:
+            channel = _decode(fields[b'channel']) if fields is not None else None  # None if entry is trimmed
+            for handler in tuple(self.routes.get(channel, ())):
+                try:
+                    await handler(channel, json.loads(fields[b'data'].decode()))
+                except Exception:
+                    logger.exception('Event %s of stream %s is not handled' % (id_, stream))
+            handled.append(id_)
+        if len(handled) != 0:
+            await self.redis.execute(b'XACK', stream, self.group, *handled)
+
+    async def _reclaim(self):
+        self.reclaimed = time.monotonic()
+        idle = int(self.transport.reclaim_idle * 1000)
+        for stream in tuple(self.streams):
+            reply = await self.redis.execute(b'XPENDING', stream, self.group, b'-', b'+', self.transport.count)
+            pending = [{'message_id': id_, 'consumer': consumer, 'time_since_delivered': int(idle_),
+                        'times_delivered': int(deliveries)} for id_, consumer, idle_, deliveries in reply]
+            dropped, claimed = _stale(self.transport, stream, self.consumer, pending)
+            if len(dropped) != 0:
+                await self.redis.execute(b'XACK', stream, self.group, *dropped)
+            if len(claimed) != 0:
+                reply = await self.redis.execute(b'XCLAIM', stream, self.group, self.consumer, idle, *claimed)
+                await self._handle(stream, ((e[0], _fields(e[1])) for e in reply if e is not None))
+
+
+def _stale(transport, stream, consumer, pending):
+    """ Return (ids to drop, ids to claim) of pending entries of other consumers idle for reclaim idle time """
+    stale = [p for p in pending if p['time_since_delivered'] >= int(transport.reclaim_idle * 1000) and
+             _decode(p['consumer']) != consumer]
+    dropped = [p['message_id'] for p in stale if p['times_delivered'] >= transport.max_deliveries]
+    if len(dropped) != 0:
+        logger.error('Events %s of stream %s are dropped after %d deliveries' %
+                     (dropped, stream, transport.max_deliveries))
+    return dropped, [p['message_id'] for p in stale if p['message_id'] not in dropped]
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _fields(values):
+    return dict(zip(values[::2], values[1::2])) if values is not None else None
+
+
+class _RedisStreams:
+    """ Streams commands of redis-py 2 connection with replies converted like redis-py 3 does """
+
+    def __init__(self, redis_):
+        self.redis = redis_
+
+    def xadd(self, name, fields, id='*', maxlen=None, approximate=True):
+        trim = ('MAXLEN',) + (('~',) if approximate else ()) + (maxlen,) if maxlen is not None else ()
+        return self.redis.execute_command('XADD', name, *trim, id, *(x for field in fields.items() for x in field))
+
+    def xlen(self, name):
+        return self.redis.execute_command('XLEN', name)
+
+    def xgroup_create(self, name, groupname, id='$', mkstream=False):
+        return self.redis.execute_command('XGROUP', 'CREATE', name, groupname, id,
+                                          *(('MKSTREAM',) if mkstream else ()))
+
+    def xgroup_destroy(self, name, groupname):
+        return self.redis.execute_command('XGROUP', 'DESTROY', name, groupname)
+
+    def xgroup_delconsumer(self, name, groupname, consumername):
+        return self.redis.execute_command('XGROUP', 'DELCONSUMER', name, groupname, consumername)
+
+    def xreadgroup(self, groupname, consumername, streams, count=None, block=None, noack=False):
+        arguments = ('GROUP', groupname, consumername)
+        arguments += ('COUNT', count) if count is not None else ()
+        arguments += ('BLOCK', block) if block is not None else ()
+        arguments += ('NOACK',) if noack else ()
+        arguments += ('STREAMS',) + tuple(streams) + tuple(streams.values())
+        return [[name, [(id_, _fields(values)) for id_, values in entries]]
+                for name, entries in self.redis.execute_command('XREADGROUP', *arguments) or ()]
+
+    def xack(self, name, groupname, *ids):
+        return self.redis.execute_command('XACK', name, groupname, *ids)
+
+    def xpending_range(self, name, groupname, min, max, count, consumername=None):
+        reply = self.redis.execute_command('XPENDING', name, groupname, min, max, count,
+                                           *((consumername,) if consumername is not None else ()))
+        return [{'message_id': id_, 'consumer': consumer, 'time_since_delivered': int(idle),
+                 'times_delivered': int(deliveries)} for id_, consumer, idle, deliveries in reply]
+
+    def xclaim(self, name, groupname, consumername, min_idle_time, message_ids):
+        reply = self.redis.execute_command('XCLAIM', name, groupname, consumername, min_idle_time, *message_ids)
+        return [(entry[0], _fields(entry[1])) for entry in reply if entry is not None]
+
+
+def streams(redis_):
+    """ Return connection with streams commands of redis-py 3 interface """
+    return redis_ if hasattr(redis_, 'xreadgroup') else _RedisStreams(redis_)
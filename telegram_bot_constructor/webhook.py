@@ -0,0 +1,166 @@
+""" One HTTP server receiving telegram updates of all bots of process by webhooks.
+
+Update of bot is posted to '<public url>/<bot secret>', it is queued to bounded queue of bot and processed
+by pool of worker threads. Updates of one bot are processed in order of receiving, bots with pending updates
+are served in turn. When queue of bot or all queues are full update is rejected with 429 status,
+telegram delivers it again later """
+import json
+import queue
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from logging import getLogger
+from urllib.request import Request, urlopen
+
+TELEGRAM_API_URL = 'https://api.telegram.org'
+MAX_UPDATE_SIZE = 1 << 20  # Bytes
+
+logger = getLogger('Webhook')
+
+
+class WebhookError(Exception):
+    pass
+
+
+def call_api(api_url, token, method, parameters, timeout=10):
+    """ Call telegram bot API method, return its result """
+    request = Request('%s/bot%s/%s' % (api_url, token, method), json.dumps(parameters).encode(),
+                      {'Content-Type': 'application/json'})
+    with urlopen(request, timeout=timeout) as response:
+        answer = json.loads(response.read().decode())
+    if not answer.get('ok'):
+        raise WebhookError('%s failed: %s' % (method, answer.get('description')))
+    return answer.get('result')
+
+
+class _BotQueue:
+    def __init__(self, context_id, process, limit):
+        self.context_id = context_id
+        self.process = process
+        self.limit = limit
+        self.updates = deque()
+        self.scheduled = False  # Bot is in ready queue or its update is being processed
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_UPDATE_SIZE:
+            self.send_response(413)
+        else:
+            body = self.rfile.read(length)
+            self.send_response(self.server.ingress.receive(self.path.lstrip('/'), body))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format_, *args):
+        logger.debug(format_ % args)
+
+
+class WebhookServer:
+    """ Receives updates of bots added by add_bot() """
+
+    def __init__(self, public_url, host='127.0.0.1', port=8443, workers=8, queue_limit=100, max_pending=10000,
+                 api_url=TELEGRAM_API_URL):
+        self.public_url = public_url.rstrip('/')
+        self.address = (host, port)
+        self.workers_count = workers
+        self.queue_limit = queue_limit  # Pending updates of one bot
+        self.max_pending = max_pending  # Pending updates of all bots
+        self.api_url = api_url
+        self.bots = {}  # Secret to bot queue map
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.ready = queue.Queue()  # Bot queues with pending updates, None stops worker
+        self.server = None
+        self.threads = []
+
+    def start(self):
+        self.server = ThreadingHTTPServer(self.address, _RequestHandler)
+        self.server.daemon_threads = True
+        self.server.ingress = self
+        self.address = self.server.server_address
+        self.threads = [threading.Thread(target=self.server.serve_forever, name='Webhook server', daemon=True)]
+        self.threads += [threading.Thread(target=self._work, name='Webhook worker %d' % i, daemon=True)
+                         for i in range(self.workers_count)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for _ in range(self.workers_count):
+            self.ready.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def add_bot(self, secret, context_id, token, process, set_webhook=True):
+        """ Route updates posted with secret to process(update) and point bot webhook to server """
+        with self.lock:
+            self.bots[secret] = _BotQueue(context_id, process, self.queue_limit)
+        if set_webhook:
+            call_api(self.api_url, token, 'setWebhook', {'url': '%s/%s' % (self.public_url, secret),
+                                                         'max_connections': self.queue_limit})
+
+    def remove_bot(self, secret, token, delete_webhook=True):
+        """ Stop receiving updates of bot, pending updates are dropped """
+        with self.lock:
+            bot = self.bots.pop(secret, None)
+            if bot is not None:
+                self.pending -= len(bot.updates)
+                bot.updates.clear()
+        if delete_webhook:
+            call_api(self.api_url, token, 'deleteWebhook', {})
+
+    def receive(self, secret, body):
+        """ Queue update, return HTTP status of response """
+        try:
+            update = json.loads(body.decode())
+        except ValueError:
+            return 400
+        with self.lock:
+            bot = self.bots.get(secret)
+            if bot is None:
+                return 404
+            if len(bot.updates) >= bot.limit or self.pending >= self.max_pending:
+                bot.rejected += 1
+                return 429
+            bot.updates.append(update)
+            self.pending += 1
+            if not bot.scheduled:
+                bot.scheduled = True
+                self.ready.put(bot)
+        return 200
+
+    def _work(self):
+        while True:
+            bot = self.ready.get()
+            if bot is None:
+                return
+            with self.lock:
+                if len(bot.updates) == 0:  # Bot is removed
+                    bot.scheduled = False
+                    continue
+                update = bot.updates.popleft()
+                self.pending -= 1
+            try:
+                bot.process(update)
+                bot.processed += 1
+            except Exception:
+                bot.failed += 1
+                logger.exception('Update of bot context %d failed' % bot.context_id)
+            with self.lock:
+                if len(bot.updates) != 0:
+                    self.ready.put(bot)  # Other bots are served before the next update of this one
+                else:
+                    bot.scheduled = False
+
+    @property
+    def statistics(self):
+        """ Return context id to counts of processed, failed, rejected and pending updates map """
+        with self.lock:
+            return {b.context_id: {'processed': b.processed, 'failed': b.failed, 'rejected': b.rejected,
+                                   'pending': len(b.updates)} for b in self.bots.values()}
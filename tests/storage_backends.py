@@ -0,0 +1,28 @@
+""" Base of tests of server side scripts. Embedded storage runs their python implementations from
+scripts.PYTHON_SCRIPTS, redis server runs lua scripts, so tests are repeated with REDIS_URL by subclasses """
+from unittest import TestCase, SkipTest
+
+from telegram_bot_constructor import set_redis_connection, get_redis_connection
+from telegram_bot_constructor.storage import connect
+
+REDIS_URL = 'redis://127.0.0.1:6379/9'
+
+
+class StorageTestCase(TestCase):
+    URL = 'memory://'
+
+    @classmethod
+    def setUpClass(cls):
+        redis_ = connect(cls.URL)
+        try:
+            redis_.ping()
+        except Exception:
+            raise SkipTest('Storage %s is not available' % cls.URL)
+        cls.previous_connection = get_redis_connection()
+        cls.redis = redis_
+        set_redis_connection(redis_)
+        redis_.flushdb()
+
+    @classmethod
+    def tearDownClass(cls):
+        set_redis_connection(cls.previous_connection)
@@ -0,0 +1,97 @@
+import asyncio
+import json
+from unittest import IsolatedAsyncioTestCase
+
+import aioredis
+from redis import Redis
+
+from telegram_bot_constructor import set_redis_connection, get_redis_connection, set_async_redis_connection
+from telegram_bot_constructor.constructor import BotTemplate, SendMessage
+from telegram_bot_constructor.operator_client import AsyncOperatorInterfaceDispatcher
+from telegram_bot_constructor.operators_server import Operator, AsyncOperatorsDispatcher, OPERATOR_ACCESS_GRANTED, \
+    get_async_pubsub, set_transport, streams_transport, operator_channel, apublish
+from telegram_bot_constructor.transport import PubSubTransport
+
+
+
+class TestAsync(IsolatedAsyncioTestCase):
+    """ Async API works with aioredis only, so redis server is needed """
+
+    async def asyncSetUp(self):
+        self.redis_connection = get_redis_connection()
+        set_redis_connection(Redis(host='127.0.0.1', port=6379, db=9))
+        get_redis_connection().flushdb()
+        set_async_redis_connection(await aioredis.create_redis_pool('redis://127.0.0.1:6379/9'))
+
+    async def asyncTearDown(self):
+        set_async_redis_connection(None)
+        set_redis_connection(self.redis_connection)
+
+    async def test_objects(self):
+        template = await BotTemplate.acreate('Template')
+        self.assertTrue(await BotTemplate.aexists(template.id))
+        self.assertEqual(template.name, 'Template')
+        component = await SendMessage.acreate('Text')
+        template.screens[0].add_component(component)
+        await component.aset(text='New text')
+        self.assertEqual((await SendMessage.aget(component.id)).text, 'New text')
+        self.assertEqual(SendMessage(component.id).text, 'New text')
+        self.assertEqual(len(await template.acompile()), 2)
+        await template.adelete()
+        self.assertFalse(await BotTemplate.aexists(template.id))
+        self.assertFalse(await SendMessage.aexists(component.id))
+
+    async def wait(self, condition):
+        for _ in range(200):
+            if condition():
+                return True
+            await asyncio.sleep(0.01)
+        return False
+
+    async def test_dispatchers(self):
+        operator = await Operator.acreate('Operator')
+        first, second = AsyncOperatorsDispatcher((operator,)), AsyncOperatorsDispatcher((operator,))
+        clients = AsyncOperatorInterfaceDispatcher()
+        listeners = [asyncio.ensure_future(d.listen()) for d in (first, second, clients)]
+        await asyncio.sleep(0.1)
+        interface = await clients.aget_interface(operator.token)
+        self.assertTrue(await self.wait(lambda: interface.authentication == OPERATOR_ACCESS_GRANTED))
+        self.assertTrue(await self.wait(lambda: operator.token in second.available_operators))
+        self.assertIn(operator.token, first.available_operators)  # Every dispatcher of pool receives events
+        listeners[0].cancel()
+        await asyncio.gather(listeners[0], return_exceptions=True)
+        await clients.arelease_interface(interface)
+        self.assertTrue(await self.wait(lambda: second.available_operators == {}))  # Shared channels are kept
+        self.assertIn(operator.token, first.available_operators)
+        for listener in listeners[1:]:
+            listener.cancel()
+        await asyncio.gather(*listeners[1:], return_exceptions=True)
+        self.assertEqual(get_async_pubsub().routes, {})
+        await operator.adelete()
+
+    async def test_streams_transport(self):
+        set_transport(streams_transport(reclaim_idle=0, reclaim_interval=0))
+        try:
+            operator = await Operator.acreate('Operator')
+            dispatcher = AsyncOperatorsDispatcher((operator,), group='bot_contexts:1')
+            clients = AsyncOperatorInterfaceDispatcher()
+            listeners = [asyncio.ensure_future(d.listen()) for d in (dispatcher, clients)]
+            await asyncio.sleep(0.1)
+            interface = await clients.aget_interface(operator.token)
+            self.assertTrue(await self.wait(lambda: interface.authentication == OPERATOR_ACCESS_GRANTED))
+            self.assertIn(operator.token, dispatcher.available_operators)
+            listeners[1].cancel()  # Client is disconnected
+            await asyncio.gather(listeners[1], return_exceptions=True)
+            await apublish(clients.redis, operator_channel('message_to_operator', operator.token),
+                           json.dumps((operator.token, 'While disconnected')))
+            clients = AsyncOperatorInterfaceDispatcher()
+            listeners[1] = asyncio.ensure_future(clients.listen())
+            await asyncio.sleep(0.1)
+            interface = await clients.aget_interface(operator.token)
+            self.assertTrue(await self.wait(lambda: interface.incoming_messages == ['While disconnected']))
+            for listener in listeners:
+                listener.cancel()
+            await asyncio.gather(*listeners, return_exceptions=True)
+            await operator.adelete()
+        finally:
+            set_transport(PubSubTransport())
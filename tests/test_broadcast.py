@@ -0,0 +1,136 @@
+import threading
+from unittest import TestCase
+
+from telegram_bot_constructor import set_redis_connection, get_redis_connection
+from telegram_bot_constructor.broadcast import Broadcast, TokenBucket, BROADCAST_FINISHED, BROADCAST_RUNNING, \
+    BROADCAST_CANCELLED
+from telegram_bot_constructor.constructor import BotTemplate, SendMessage
+from telegram_bot_constructor.runner import BotRunnerContext, running_broadcasts
+from telegram_bot_constructor.storage import connect
+
+set_redis_connection(connect('memory://'))
+get_redis_connection().flushdb()
+
+
+class RetryAfter(Exception):
+    def __init__(self, retry_after):
+        super().__init__('Flood control exceeded')
+        self.retry_after = retry_after
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestTokenBucket(TestCase):
+    def test_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, capacity=5, clock=clock, sleep=clock.sleep)
+        for _ in range(25):
+            bucket.acquire()
+        self.assertAlmostEqual(clock.now, 2.0)
+
+    def test_delay(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, capacity=1, clock=clock, sleep=clock.sleep)
+        bucket.acquire()
+        bucket.delay(3)
+        bucket.acquire()
+        self.assertAlmostEqual(clock.now, 3.1)
+
+
+class TestBroadcast(TestCase):
+    def setUp(self):
+        self.context = BotRunnerContext.create('Bot')
+        for chat in range(1, 251):
+            self.context.add_chat(chat)
+        self.clock = FakeClock()
+        self.sent = []
+
+    def tearDown(self):
+        self.context.stop()
+        self.context.delete()
+
+    def send(self, chat, text):
+        self.sent.append((chat, text))
+
+    def run_broadcast(self, broadcast, send=None, stop=None):
+        broadcast.run(send or self.send, batch_size=100, stop=stop, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_chats(self):
+        self.context.add_chat(1)
+        self.assertEqual(self.context.chats_count, 250)
+        self.assertEqual(self.context.chats[-1], 1)
+        self.assertEqual(sorted(self.context.iter_chats(batch_size=7)), list(range(1, 251)))
+
+    def test_broadcast(self):
+        broadcast = Broadcast.create(self.context.id, 'News', 50, 4)
+        self.run_broadcast(broadcast)
+        self.assertEqual(sorted(self.sent), [(chat, 'News') for chat in range(1, 251)])
+        statistics = broadcast.statistics
+        self.assertEqual(statistics['status'], BROADCAST_FINISHED)
+        self.assertEqual((statistics['sent'], statistics['failed'], statistics['total']), (250, 0, 250))
+        self.assertAlmostEqual(statistics['duration'], 200 / 50)  # Bucket is full at start
+        self.assertAlmostEqual(statistics['throughput'], 250 / 4)
+
+    def test_failures(self):
+        attempts = {}
+
+        def send(chat, text):
+            attempts[chat] = attempts.get(chat, 0) + 1
+            if chat == 7:
+                raise ValueError('Chat not found')
+            if chat == 8 and attempts[chat] == 1:
+                raise RetryAfter(5)
+            self.send(chat, text)
+
+        broadcast = Broadcast.create(self.context.id, 'News')
+        self.run_broadcast(broadcast, send)
+        self.assertEqual(len(self.sent), 249)
+        self.assertEqual(attempts[8], 2)
+        self.assertEqual(broadcast.failures, {7: 'ValueError: Chat not found'})
+        self.assertEqual(broadcast.statistics['failed'], 1)
+
+    def test_resume(self):
+        stop = threading.Event()
+
+        def send(chat, text):
+            stop.set()
+            self.send(chat, text)
+
+        broadcast = Broadcast.create(self.context.id, 'News')
+        self.run_broadcast(broadcast, send, stop)
+        self.assertEqual(len(self.sent), 100)
+        self.assertEqual(broadcast.statistics['status'], BROADCAST_RUNNING)
+        self.run_broadcast(Broadcast(broadcast.id))
+        self.assertEqual(sorted(c for c, _ in self.sent), list(range(1, 251)))
+        self.assertEqual(broadcast.statistics['sent'], 250)
+
+    def test_cancel(self):
+        broadcast = Broadcast.create(self.context.id, 'News')
+        broadcast.cancel()
+        self.run_broadcast(broadcast)
+        self.assertEqual(self.sent, [])
+        self.assertEqual(broadcast.statistics['status'], BROADCAST_CANCELLED)
+
+    def test_mail_all(self):
+        template = BotTemplate.create('Template')
+        template.start_screen.add_component(SendMessage.create('Hello'))
+        self.context.bot_template = template
+        self.context.run()
+        broadcast = self.context.mail_all('News', rate=1000, send=self.send)
+        running_broadcasts[broadcast.id][0].join()
+        self.assertEqual(len(self.sent), 250)
+        self.assertEqual(self.context.broadcasts, (broadcast,))
+        self.context.stop()
+        self.context.delete()
+        self.assertFalse(Broadcast.exists(broadcast.id))
+        self.context = BotRunnerContext.create('Bot')
+        template.delete()
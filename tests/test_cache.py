@@ -0,0 +1,47 @@
+import time
+from unittest import TestCase
+
+from telegram_bot_constructor import set_redis_connection, get_redis_connection
+from telegram_bot_constructor.cache import enable_cache, disable_cache, INVALIDATION_CHANNEL
+from telegram_bot_constructor.constructor import Screen
+from telegram_bot_constructor.storage import connect
+
+set_redis_connection(connect('memory://'))
+redis_ = get_redis_connection()
+redis_.flushdb()
+
+
+class TestCache(TestCase):
+    def setUp(self):
+        self.cache = enable_cache(maxsize=100)
+        self.screen = Screen.create('Screen')
+
+    def tearDown(self):
+        disable_cache()
+
+    def test_read_through(self):
+        self.assertEqual(Screen(self.screen.id).name, 'Screen')
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(Screen(self.screen.id).name, 'Screen')
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_local_invalidation(self):
+        self.assertEqual(self.screen.name, 'Screen')
+        self.screen.name = 'Renamed'
+        self.assertEqual(Screen(self.screen.id).name, 'Renamed')
+
+    def test_remote_invalidation(self):
+        self.assertEqual(self.screen.name, 'Screen')
+        redis_.hset(self.screen.key, 'name', 'Renamed')
+        redis_.publish(INVALIDATION_CHANNEL, '["screen", %d, "name"]' % self.screen.id)
+        for _ in range(50):
+            if self.screen.name == 'Renamed':
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.screen.name, 'Renamed')
+
+    def test_eviction(self):
+        screens = Screen.create_many(('Screen',) for _ in range(200))
+        for screen in screens:
+            self.assertEqual(screen.name, 'Screen')
+        self.assertLessEqual(len(self.cache.entries), 100)
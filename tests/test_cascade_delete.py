@@ -0,0 +1,73 @@
+import contextlib
+
+from telegram_bot_constructor.constructor import BotTemplate, Screen, SendMessage
+from telegram_bot_constructor.helpers import session
+from telegram_bot_constructor.operators_server import Operator
+from telegram_bot_constructor.runner import BotRunnerContext
+from telegram_bot_constructor.statistics import visits_collector
+
+from storage_backends import StorageTestCase, REDIS_URL
+
+
+class TestCascadeDelete(StorageTestCase):
+    def setUp(self):
+        self.redis.flushdb()
+
+    def assertOnlyCountersLeft(self):
+        self.assertEqual([k for k in self.redis.keys() if not k.startswith(b'last_')], [])
+
+    def test_bot_template(self):
+        template = BotTemplate.create('Template')
+        for _ in range(3):
+            screen = Screen.create('Screen')
+            template.add_screen(screen)
+            for component in SendMessage.create_many(('Text',) for _ in range(5)):
+                screen.add_component(component)
+        template.delete(chunk_size=4)
+        self.assertFalse(BotTemplate.exists(template.id))
+        self.assertEqual(BotTemplate.list(), ())
+        self.assertOnlyCountersLeft()
+
+    def test_operator(self):
+        operator = Operator.create('Operator')
+        for _ in range(3):
+            conversation = operator.new_conversation()
+            for _ in range(5):
+                conversation.send_message('Text')
+        operator.delete(chunk_size=2)
+        self.assertFalse(Operator.exists(operator.id))
+        self.assertOnlyCountersLeft()
+
+    def test_before_delete(self):
+        class IndexedOperator(Operator):
+            def before_delete(self):
+                self.redis.srem('indexed_operators', self.id)  # Not described by cascade spec
+
+        for in_session in (False, True):
+            operator = IndexedOperator.create('Operator')
+            self.redis.sadd('indexed_operators', operator.id)
+            with session() if in_session else contextlib.nullcontext():
+                operator.delete()
+            self.assertEqual(self.redis.smembers('indexed_operators'), set())
+        template = BotTemplate.create('Template')
+        for in_session in (False, True):
+            context = BotRunnerContext.create('Bot')
+            context.bot_template = template
+            context.add_operator(Operator.create('Operator'))
+            context.increment_visits(user=1)
+            visits_collector.flush()
+            self.assertNotEqual(self.redis.keys('bot_contexts:%d:users:*' % context.id), [])
+            if in_session:
+                with session():
+                    BotRunnerContext(context.id).delete()
+            else:
+                context.delete()
+            self.assertEqual(self.redis.smembers('bot_templates:%d:contexts' % template.id), set())
+            self.assertEqual(self.redis.keys('bot_contexts:%d*' % context.id), [])
+            self.assertEqual(self.redis.keys('operators:*'), [])
+        template.delete()
+        self.assertOnlyCountersLeft()
+
+
+class TestCascadeDeleteRedis(TestCascadeDelete):
+    URL = REDIS_URL  # Lua scripts
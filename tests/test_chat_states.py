@@ -0,0 +1,123 @@
+from types import SimpleNamespace
+from unittest import TestCase
+
+from telegram_bot_constructor import set_redis_connection, get_redis_connection
+from telegram_bot_constructor.chat_states import ChatStates
+from telegram_bot_constructor.operators_server import Operator, OperatorsDispatcher
+from telegram_bot_constructor.storage import connect
+
+set_redis_connection(connect('memory://'))
+redis_ = get_redis_connection()
+
+SOURCES = [[1, 10], [1, 11], [2, 20], [2, 21]]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def step(vm_context):
+    vm_context.position += 1
+
+
+class TestChatStates(TestCase):
+    def setUp(self):
+        redis_.flushdb()
+        self.clock = Clock()
+
+    def states(self, sources=SOURCES, dispatcher=None):
+        return ChatStates(1, sources, dispatcher, redis_, idle_timeout=60, clock=self.clock)
+
+    def test_restart(self):
+        states = self.states()
+        action, = states.track([SimpleNamespace(exec=step)])
+        vm_context = SimpleNamespace(position=0, variables={'name': 'John'})
+        states.contexts[100] = vm_context
+        action.exec(vm_context)
+        action.exec(vm_context)
+        self.assertEqual(states.flush(), 1)
+        self.assertEqual(states.flush(), 0)
+        self.assertEqual(redis_.ttl(states.key(100)), 7 * 86400)
+        restarted = self.states()
+        vm_context = SimpleNamespace(position=0, variables={})
+        restarted.contexts[100] = vm_context
+        self.assertEqual((vm_context.position, vm_context.variables), (2, {'name': 'John'}))
+        restarted.contexts[200] = SimpleNamespace(position=0)  # New chat
+        self.assertEqual(restarted.contexts[200].position, 0)
+
+    def test_unserializable_state(self):
+        states = self.states()
+        action, = states.track([SimpleNamespace(exec=step)])
+        broken, healthy = SimpleNamespace(position=0, variables={'b': b'bytes'}), SimpleNamespace(position=0)
+        states.contexts[100], states.contexts[200] = broken, healthy
+        action.exec(broken)
+        action.exec(healthy)
+        with self.assertLogs('Chat states', 'ERROR'):
+            self.assertEqual(states.flush(), 1)
+        self.assertIsNone(redis_.get(states.key(100)))
+        self.assertIsNotNone(redis_.get(states.key(200)))  # Other chats are saved
+        broken.variables = {'b': 'text'}
+        action.exec(broken)
+        self.assertEqual(states.flush(), 1)
+        self.assertIsNotNone(redis_.get(states.key(100)))
+
+    def test_changed_template(self):
+        states = self.states()
+        vm_context = SimpleNamespace(position=3)
+        states.contexts[100] = vm_context
+        states.contexts[101] = SimpleNamespace(position=1)
+        states.dirty = {100: vm_context, 101: states.contexts[101]}
+        states.flush()
+        restarted = self.states([[2, 20], [2, 21], [3, 30]])  # Screen 1 is deleted
+        restarted.contexts[100] = SimpleNamespace(position=0)
+        restarted.contexts[101] = SimpleNamespace(position=2)
+        self.assertEqual(restarted.contexts[100].position, 1)
+        self.assertEqual(restarted.contexts[101].position, 0)
+
+    def test_eviction(self):
+        states = self.states()
+        action, = states.track([SimpleNamespace(exec=step)])
+        states.contexts[100] = SimpleNamespace(position=0)
+        states.contexts[101] = SimpleNamespace(position=0)
+        self.clock.now = 50
+        action.exec(states.contexts[101])
+        self.clock.now = 100
+        states.flush()
+        self.assertEqual(list(states.contexts), [101])
+        self.assertEqual(list(states.chats.values()), [101])
+        vm_context = SimpleNamespace(position=0)
+        states.contexts[101] = vm_context  # VM creates context of evicted chat again
+        self.assertEqual(vm_context.position, 1)
+
+    def test_conversation(self):
+        operator = Operator.create('Operator')
+        dispatcher = OperatorsDispatcher((operator,))
+        conversation = operator.new_conversation()
+        states = self.states(dispatcher=dispatcher)
+        vm_context = SimpleNamespace(position=1, conversation=conversation)
+        conversation.operator = operator
+        states.contexts[100] = vm_context
+        states.dirty[100] = vm_context
+        states.flush()
+        dispatcher = OperatorsDispatcher((operator,))
+        restarted = self.states(dispatcher=dispatcher)
+        vm_context = SimpleNamespace(position=0, conversation=None)
+        restarted.contexts[100] = vm_context
+        self.assertEqual(vm_context.conversation.id, conversation.id)
+        self.assertTrue(vm_context.conversation.restored)
+        dispatcher.clean_up_conversations()
+        self.assertFalse(vm_context.conversation.stopped)  # Waits for operator
+        dispatcher.handle_message('authentication', (operator.token, 'auth'))
+        dispatcher.clean_up_conversations()
+        self.assertFalse(vm_context.conversation.restored)
+        dispatcher.handle_message('disconnected', operator.token)
+        dispatcher.clean_up_conversations()
+        self.assertTrue(vm_context.conversation.stopped)
+        vm_context = SimpleNamespace(position=0, conversation=None)
+        self.states(dispatcher=OperatorsDispatcher(())).contexts[100] = vm_context
+        self.assertIsNone(vm_context.conversation)  # Operator is removed from bot
+        operator.delete()
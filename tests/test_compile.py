@@ -0,0 +1,77 @@
+import json
+from unittest import TestCase
+
+from telegram_bot_constructor import set_redis_connection, get_redis_connection
+from telegram_bot_constructor.constructor import BotTemplate, Screen, SendMessage, ForwardToScreen, remap_positions
+from telegram_bot_constructor.storage import connect
+
+set_redis_connection(connect('memory://'))
+redis_ = get_redis_connection()
+redis_.flushdb()
+
+
+class TestCompile(TestCase):
+    def setUp(self):
+        self.template = BotTemplate.create('Template')
+        self.component = SendMessage.create('Text')
+        self.template.start_screen.add_component(self.component)
+
+    def tearDown(self):
+        self.template.delete()
+
+    def test_versions(self):
+        version = self.template.get_version()
+        screen_version = self.template.start_screen.get_version()
+        self.component.text = 'New text'
+        self.assertEqual(self.template.get_version(), version + 1)
+        self.assertEqual(self.template.start_screen.get_version(), screen_version + 1)
+        screen = Screen.create('Screen')
+        screen.add_component(SendMessage.create('Text'))
+        self.template.add_screen(screen)
+        version = self.template.get_version()
+        screen.components[0].text = 'New text'
+        self.assertEqual(self.template.get_version(), version + 1)
+        self.template.delete_screen(screen)
+        self.assertEqual(self.template.get_version(), version + 2)
+
+    def test_compiled_program_cache(self):
+        self.assertEqual(self.template.compile_program(), [['SendMessage', 'Text'], ['Forward', 2]])
+        # Program is not compiled again while template version is the same
+        redis_.hset(self.template.collection_key('compiled'), 'program', json.dumps([['SendMessage', 'Cached']]))
+        self.assertEqual(self.template.compile_program(), [['SendMessage', 'Cached']])
+        self.assertEqual(len(self.template.compile()), 1)
+        self.component.text = 'New text'
+        self.assertEqual(self.template.compile_program(), [['SendMessage', 'New text'], ['Forward', 2]])
+
+    def test_forward_to_screen(self):
+        screen = Screen.create('Screen')
+        self.template.add_screen(screen)
+        screen.add_component(ForwardToScreen.create('variable', self.template.start_screen, 'yes'))
+        self.template.start_screen.add_component(ForwardToScreen.create('variable', screen, 'no'))
+        self.assertEqual(self.template.compile_program(), [['SendMessage', 'Text'],
+                                                           ['Forward', 3, 'variable', 'no'],
+                                                           ['Forward', 5],
+                                                           ['Forward', 0, 'variable', 'yes'],
+                                                           ['Forward', 5]])
+
+    def test_incremental_compilation(self):
+        screen = Screen.create('Screen')
+        self.template.add_screen(screen)
+        screen.add_component(SendMessage.create('Second'))
+        self.template.compile_program()
+        # Segment of unchanged screen is reused
+        segments_key = self.template.collection_key('segments')
+        segment = json.loads(redis_.hget(segments_key, self.template.start_screen.id).decode())
+        segment['instructions'] = [['SendMessage', 'Stored']]
+        redis_.hset(segments_key, self.template.start_screen.id, json.dumps(segment))
+        screen.components[0].text = 'Changed'
+        self.assertEqual(self.template.compile_program(), [['SendMessage', 'Stored'], ['Forward', 4],
+                                                           ['SendMessage', 'Changed'], ['Forward', 4]])
+        self.template.delete_screen(screen)
+        self.template.compile_program()
+        self.assertEqual(redis_.hkeys(segments_key), [str(self.template.start_screen.id).encode()])
+
+    def test_remap_positions(self):
+        self.assertEqual(remap_positions([[1, 10], [1, 11], [1, None], [2, 20], [2, None], [3, None]],
+                                         [[1, 11], [1, 12], [1, None], [2, None]]),
+                         [0, 0, 2, 3, 3, 0])
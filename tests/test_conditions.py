@@ -0,0 +1,39 @@
+from unittest import TestCase
+
+from telegram_bot_constructor import set_redis_connection, get_redis_connection
+from telegram_bot_constructor.conditions import InvalidCondition, compile_condition, validate_condition
+from telegram_bot_constructor.constructor import BotTemplate, ForwardToScreen, build_actions
+from telegram_bot_constructor.storage import connect
+
+set_redis_connection(connect('memory://'))
+get_redis_connection().flushdb()
+
+
+class TestConditions(TestCase):
+    def test_validation(self):
+        for condition in ('yes|no', r'^\d+$', r'(\w+\s?)?', r'[a-z]+@[a-z]+\.com', r'(ab){2,5}', r'(yes|no)+',
+                          r'(ab|a)*c', r'(\s?\w)+', r'[\w.-]+', r'((ab)*c)+', r'^[a-z]+( [a-z]+)*$', r'^\d+(\.\d+)*$',
+                          r'^(\w+,)*\w+$'):  # Nested repeats separated by other characters are linear
+            validate_condition(condition)
+        for condition in ('(', '[a-', r'(a+)+$', r'(\w*\s?)*x', 'a' * 1001, r'(a|aa)*b', r'(a|a)*$', r'(\w|\d)+x',
+                          r'(aa?)*', r'(x|\w+)*', r'(\w+\s?)+$', r'(a*)*b', r'(x+x+)+y'):
+            self.assertRaises(InvalidCondition, validate_condition, condition)
+
+    def test_stored_condition(self):
+        with self.assertLogs('Conditions', 'WARNING'):
+            action, = build_actions([['Forward', 0, 'variable', '(a|aa)*b']])  # Stored before validation
+        self.assertEqual(action.condition_regex.pattern, '(a|aa)*b')
+
+    def test_interning(self):
+        self.assertIs(compile_condition('yes|no'), compile_condition('yes|no'))
+        actions = build_actions([['Forward', 0, 'variable', 'yes|no'], ['Forward', 0, 'other', 'yes|no']])
+        self.assertIs(actions[0].condition_regex, actions[1].condition_regex)
+
+    def test_component(self):
+        template = BotTemplate.create('Template')
+        forward = ForwardToScreen.create('variable', template.start_screen, 'yes')
+        with self.assertRaises(InvalidCondition):
+            forward.condition_regex = '(a+)+'
+        self.assertEqual(forward.condition_regex, 'yes')
+        self.assertRaises(InvalidCondition, ForwardToScreen.create, 'variable', template.start_screen, '(')
+        template.delete()
@@ -1,11 +1,11 @@
 from telegram_bot_constructor import set_redis_connection, get_redis_connection
-from redis import Redis
 from telegram_bot_constructor.operators_server import Operator, Message
+from telegram_bot_constructor.storage import connect
 import time
 import uuid
 import random
 
-set_redis_connection(Redis(host='127.0.0.1', port=6379, db=9))
+set_redis_connection(connect('memory://'))
 redis_ = get_redis_connection()
 redis_.flushdb()
 
@@ -0,0 +1,72 @@
+import io
+from unittest import TestCase
+
+from telegram_bot_constructor import set_redis_connection, get_redis_connection
+from telegram_bot_constructor.constructor import BotTemplate, Screen, SendMessage, GetInput, ForwardToScreen, \
+    OperatorDialog
+from telegram_bot_constructor.exchange import InvalidTemplateStream, read_records
+from telegram_bot_constructor.storage import connect
+
+set_redis_connection(connect('memory://'))
+get_redis_connection().flushdb()
+
+
+class TestExchange(TestCase):
+    def setUp(self):
+        self.template = BotTemplate.create('Template')
+        screen = Screen.create('Second')
+        self.template.add_screen(screen)
+        for component in (SendMessage.create('Text'), GetInput.create('variable'),
+                          ForwardToScreen.create('variable', screen, 'yes')):
+            self.template.start_screen.add_component(component)
+        screen.add_component(OperatorDialog.create('Start', 'Stop', 'Fail'))
+        screen.add_component(ForwardToScreen.create('variable', self.template.start_screen, ''))
+
+    def tearDown(self):
+        self.template.delete()
+
+    def test_export_import(self):
+        for compress in (True, False):
+            stream = io.BytesIO()
+            self.template.export(stream, compress)
+            stream.seek(0)
+            imported = BotTemplate.import_(stream, batch_size=2)
+            self.assertIn(imported, BotTemplate.list())
+            self.assertEqual(imported.name, 'Template')
+            self.assertEqual([s.name for s in imported.screens], ['Start screen', 'Second'])
+            self.assertEqual(imported.compile_program(), self.template.compile_program())
+            self.assertEqual(imported.screens[1].components[1].target_screen, imported.start_screen.id)
+            version = imported.get_version()
+            imported.screens[1].components[0].start_message = 'New start'
+            self.assertEqual(imported.get_version(), version + 1)
+            imported.delete()
+
+    def test_records(self):
+        stream = io.BytesIO()
+        self.template.export(stream)
+        stream.seek(0)
+        records = list(read_records(stream, chunk_size=7))
+        self.assertEqual([r['record'] for r in records], ['template'] + ['screen'] * 2 + ['component'] * 5 + ['end'])
+        self.assertEqual(records[3]['fields'], {'text': 'Text', 'type': 'SendMessage'})
+
+    def test_invalid_stream(self):
+        stream = io.BytesIO()
+        self.template.export(stream, compress=False)
+        templates = len(BotTemplate.list())
+        self.assertRaises(InvalidTemplateStream, BotTemplate.import_, io.BytesIO(stream.getvalue()[:-20]))
+        self.assertRaises(InvalidTemplateStream, BotTemplate.import_, io.BytesIO(b'template'))
+        self.assertEqual(len(BotTemplate.list()), templates)
+
+    def test_clone(self):
+        clone = self.template.clone('Clone')
+        self.assertEqual(clone.name, 'Clone')
+        self.assertEqual(clone.compile_program(), self.template.compile_program())
+        clone.delete()
+
+    def test_stored_condition(self):
+        forward = self.template.start_screen.components[2]
+        get_redis_connection().hset(forward.key, 'condition', '(a|aa)*b')  # Stored before validation
+        with self.assertLogs('Exchange', 'WARNING'):
+            clone = self.template.clone('Clone')
+        self.assertEqual(clone.start_screen.components[2].condition_regex, '(a|aa)*b')
+        clone.delete()
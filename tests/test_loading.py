@@ -0,0 +1,41 @@
+from unittest import TestCase
+
+from telegram_bot_constructor import set_redis_connection, get_redis_connection
+from telegram_bot_constructor.constructor import Screen, SendMessage, GetInput, load_components
+from telegram_bot_constructor.helpers import ObjectDoesNotExist
+from telegram_bot_constructor.storage import connect
+
+set_redis_connection(connect('memory://'))
+get_redis_connection().flushdb()
+
+
+class TestLoading(TestCase):
+    def test_load_many(self):
+        screens = Screen.create_many(('Screen %d' % i,) for i in range(5))
+        loaded = Screen.load_many(s.id for s in screens)
+        self.assertEqual(loaded, screens)
+        self.assertEqual([s.name for s in loaded], ['Screen %d' % i for i in range(5)])
+        screens[0].delete()
+        self.assertRaises(ObjectDoesNotExist, Screen.load_many, (s.id for s in screens))
+
+    def test_snapshot(self):
+        screen = Screen.create('Screen')
+        loaded, = Screen.load_many((screen.id,))
+        Screen(screen.id).name = 'Renamed'
+        self.assertEqual(loaded.name, 'Screen')  # Fields are read from snapshot
+        self.assertEqual(loaded.refresh().name, 'Renamed')
+        Screen(screen.id).name = 'Renamed again'
+        self.assertEqual(loaded.name, 'Renamed again')
+        screen.delete()
+
+    def test_load_components(self):
+        screen = Screen.create('Screen')
+        components = (SendMessage.create('Text'), GetInput.create('variable'))
+        for component in components:
+            screen.add_component(component)
+        loaded = load_components(c.id for c in components)
+        self.assertIsInstance(loaded[0], SendMessage)
+        self.assertIsInstance(loaded[1], GetInput)
+        self.assertEqual(loaded[0].text, 'Text')
+        self.assertEqual(loaded[1].variable_name, 'variable')
+        self.assertEqual(screen.components, loaded)
@@ -0,0 +1,70 @@
+from telegram_bot_constructor.constructor import BotTemplate, SendMessage
+from telegram_bot_constructor.migrations import migrate_to_hashes, add_back_references, add_contexts_indexes, \
+    chats_to_sorted_sets
+from telegram_bot_constructor.operators_server import Operator
+from telegram_bot_constructor.runner import BotRunnerContext, is_operator_locked, is_bot_template_locked
+
+from storage_backends import StorageTestCase, REDIS_URL
+
+
+class TestHashLayoutMigration(StorageTestCase):
+    def test_migration(self):
+        self.redis.sadd('operator_exists', 100)
+        self.redis.set('operators:100:name', 'Old operator')
+        self.redis.set('operators:100:token', 'old_token')
+        self.redis.rpush('operators:100:conversations', 1)
+        self.redis.rpush('operator:100:conversations', 1)
+        self.assertEqual(migrate_to_hashes(self.redis, batch_size=1), 2)
+        operator = Operator(100).load()
+        self.assertEqual(operator.name, 'Old operator')
+        self.assertEqual(operator.token, 'old_token')
+        self.assertFalse(self.redis.exists('operators:100:name'))
+        self.assertFalse(self.redis.exists('operator:100:conversations'))
+        self.assertEqual(self.redis.lrange('operators:100:conversations', 0, -1), [b'1'])
+        self.assertEqual(migrate_to_hashes(self.redis), 0)
+
+    def test_current_layout_keys(self):
+        self.redis.flushdb()
+        context = BotRunnerContext.create('Bot')
+        self.redis.set('bot_contexts:%d:lease' % context.id, 'worker')
+        self.redis.set('bot_contexts:%d:token' % context.id, 'legacy_token')
+        self.assertEqual(migrate_to_hashes(self.redis), 1)  # Lease of running bot is kept
+        self.assertEqual(self.redis.get('bot_contexts:%d:lease' % context.id), b'worker')
+        self.assertEqual(context.token, 'legacy_token')
+
+    def test_back_references(self):
+        self.redis.flushdb()
+        template = BotTemplate.create('Template')
+        component = SendMessage.create('Text')
+        template.start_screen.add_component(component)
+        self.redis.hdel(template.start_screen.key, 'bot_template')
+        self.redis.hdel(component.key, 'bot_template', 'screen')
+        self.assertEqual(add_back_references(self.redis), 2)
+        version = template.get_version()
+        component.text = 'New text'
+        self.assertEqual(template.get_version(), version + 1)
+
+    def test_contexts_indexes(self):
+        self.redis.flushdb()
+        template = BotTemplate.create('Template')
+        operator = Operator.create('Operator')
+        context = BotRunnerContext.create('Bot')
+        context.bot_template = template
+        context.add_operator(operator)
+        self.redis.delete('bot_templates:%d:contexts' % template.id, 'operators:%d:contexts' % operator.id)
+        self.assertFalse(is_bot_template_locked(template))
+        self.assertEqual(add_contexts_indexes(self.redis), 2)
+        self.assertTrue(is_bot_template_locked(template))
+        self.assertTrue(is_operator_locked(operator))
+
+    def test_chats_to_sorted_sets(self):
+        self.redis.flushdb()
+        context = BotRunnerContext.create('Bot')
+        self.redis.rpush('bot_contexts:%d:chats' % context.id, 1, 2, 1)
+        self.assertEqual(chats_to_sorted_sets(self.redis), 1)
+        self.assertEqual(context.chats, (1, 2))
+        self.assertEqual(chats_to_sorted_sets(self.redis), 0)
+
+
+class TestHashLayoutMigrationRedis(TestHashLayoutMigration):
+    URL = REDIS_URL  # Lua scripts
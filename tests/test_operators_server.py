@@ -1,10 +1,15 @@
 from unittest import TestCase
 from telegram_bot_constructor import set_redis_connection, get_redis_connection
-from redis import Redis
-from telegram_bot_constructor.operators_server import Operator
+from telegram_bot_constructor.operator_client import OperatorInterfaceDispatcher
+from telegram_bot_constructor.operators_server import Operator, OperatorsDispatcher, SharedPubSub, \
+    OPERATOR_ACCESS_GRANTED, set_legacy_channels, operator_channel
+from telegram_bot_constructor.storage import connect
+import json
+import queue
+import time
 import uuid
 
-set_redis_connection(Redis(host='127.0.0.1', port=6379, db=9))
+set_redis_connection(connect('memory://'))
 redis_ = get_redis_connection()
 redis_.flushdb()
 
@@ -38,3 +43,132 @@ class TestOperator(TestCase):
     def test_deletion(self):
         self.operator.delete()
         self.assertFalse(self.operator in Operator.list())
+
+    def test_bulk_creation(self):
+        names = [uuid.uuid4().hex for _ in range(10)]
+        operators = Operator.create_many((name,) for name in names)
+        self.assertEqual(len(operators), 10)
+        self.assertEqual(len(set(o.id for o in operators)), 10)
+        self.assertEqual([o.name for o in operators], names)
+        for operator in operators:
+            self.assertTrue(Operator.exists(operator.id))
+            self.assertTrue(operator in Operator.list())
+
+
+class TestOperatorsListener(TestCase):
+    def setUp(self):
+        self.operator = Operator.create('Operator')
+        self.pushed = queue.Queue()
+
+    def tearDown(self):
+        self.operator.delete()
+
+    def authenticate(self, dispatcher):
+        redis_.publish('authentication', json.dumps((self.operator.token, 'auth')))
+        for _ in range(50):
+            if self.operator.token in dispatcher.available_operators:
+                return
+            time.sleep(0.02)
+        self.fail('Operator is not authenticated')
+
+    def check_listener(self, dispatcher):
+        dispatcher.start_listener(lambda c: self.pushed.put(c.receive_messages()))
+        self.authenticate(dispatcher)
+        dispatcher.update()  # Does nothing
+        conversation = dispatcher.get_conversation()
+        for i in range(30):
+            redis_.publish('message_to_user', json.dumps((self.operator.token, 'Message %d' % i)))
+        received = []
+        while len(received) < 30:
+            received += self.pushed.get(timeout=2)
+        self.assertEqual(received, ['Message %d' % i for i in range(30)])
+        self.assertEqual(len(conversation.messages), 30)
+        redis_.publish('conversation_stopped_by_operator', json.dumps(self.operator.token))
+        for _ in range(50):
+            if conversation.stopped:
+                break
+            time.sleep(0.02)
+        self.assertTrue(conversation.stopped)
+        dispatcher.close()
+
+    def test_own_subscription(self):
+        self.check_listener(OperatorsDispatcher((self.operator,)))
+
+    def test_shared_subscription(self):
+        shared = SharedPubSub(redis_)
+        polling = OperatorsDispatcher((self.operator,), shared)
+        self.check_listener(OperatorsDispatcher((self.operator,), shared))
+        polling.update()
+        self.assertIn(self.operator.token, polling.available_operators)  # Messages are queued for polling one
+        shared.close()
+
+
+class TestOperatorChannels(TestCase):
+    def setUp(self):
+        self.first, self.second = Operator.create('First'), Operator.create('Second')
+
+    def tearDown(self):
+        set_legacy_channels(False)
+        self.first.delete()
+        self.second.delete()
+
+    @staticmethod
+    def wait(condition, *dispatchers):
+        """ Update dispatchers until condition is true, messages are delivered asynchronously by redis """
+        for _ in range(100):
+            for dispatcher in dispatchers:
+                dispatcher.update()
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+
+    @staticmethod
+    def get_message(pubsub):
+        for _ in range(100):
+            message = pubsub.get_message()
+            if message is not None:
+                return message
+            time.sleep(0.01)
+
+    def check_conversation(self, dispatcher):
+        clients = OperatorInterfaceDispatcher()
+        interface = clients.get_interface(self.first.token)
+        self.assertTrue(self.wait(lambda: interface.authentication == OPERATOR_ACCESS_GRANTED, dispatcher, clients))
+        conversation = dispatcher.get_conversation()
+        self.assertTrue(self.wait(lambda: interface.conversation_started, clients))
+        conversation.send_message('Question')
+        self.assertTrue(self.wait(lambda: interface.incoming_messages == ['Question'], clients))
+        interface.send_message('Answer')
+        self.assertTrue(self.wait(lambda: conversation.incoming_messages == ['Answer'], dispatcher))
+        clients.release_interface(interface)
+        self.assertTrue(self.wait(lambda: dispatcher.available_operators == {}, dispatcher))
+
+    def test_operator_channels(self):
+        other = OperatorsDispatcher((self.second,))
+        self.check_conversation(OperatorsDispatcher((self.first,)))
+        self.assertIsNone(other.pubsub.get_message())  # Events of operators of other bots are not received
+
+    def test_legacy_channels(self):
+        set_legacy_channels(True)
+        legacy = redis_.pubsub(ignore_subscribe_messages=True)
+        legacy.subscribe('authentication_result', 'message_to_operator')
+        self.check_conversation(OperatorsDispatcher((self.first,)))
+        self.assertEqual(self.get_message(legacy)['channel'], b'authentication_result')
+        self.assertEqual(self.get_message(legacy)['channel'], b'message_to_operator')
+        legacy.close()
+
+    def test_shared_routing(self):
+        shared = SharedPubSub(redis_)
+        first = OperatorsDispatcher((self.first,), shared)
+        second = OperatorsDispatcher((self.second,), shared)
+        redis_.publish(operator_channel('disconnected', self.first.token), json.dumps(self.first.token))
+        redis_.publish('disconnected', json.dumps(self.second.token))
+        self.assertEqual([self.get_message(first.pubsub)['channel'], self.get_message(first.pubsub)['channel']],
+                         [operator_channel('disconnected', self.first.token).encode(), b'disconnected'])
+        self.assertEqual(self.get_message(second.pubsub)['channel'], b'disconnected')
+        self.assertIsNone(second.pubsub.get_message())
+        first.close()
+        self.assertNotIn(operator_channel('disconnected', self.first.token), shared.routes)
+        self.check_conversation(OperatorsDispatcher((self.first,), shared))
+        shared.close()
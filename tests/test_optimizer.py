@@ -0,0 +1,50 @@
+from unittest import TestCase
+
+from telegram_bot_constructor.optimizer import optimize
+
+
+class TestOptimizer(TestCase):
+    def test_forwards(self):
+        program = [['SendMessage', 'Start'],
+                   ['Forward', 4, 'variable', 'yes'],
+                   ['SendMessage', 'No'],
+                   ['Forward', 8],
+                   ['Forward', 6],
+                   ['SendMessage', 'Unreachable'],
+                   ['GetInput', 'variable'],
+                   ['Forward', 8]]
+        sources = list(range(len(program)))
+        program, sources, statistics = optimize(program, sources)
+        self.assertEqual(program, [['SendMessage', 'Start'],
+                                   ['Forward', 4, 'variable', 'yes'],
+                                   ['SendMessage', 'No'],
+                                   ['Forward', 5],
+                                   ['GetInput', 'variable']])
+        self.assertEqual(sources, [0, 1, 2, 3, 6])
+        self.assertEqual(statistics, {'instructions_before': 8,
+                                      'instructions_after': 5,
+                                      'threaded_jumps': 1,
+                                      'removed_unreachable': 2,
+                                      'removed_forwards': 1,
+                                      'merged_messages': 0})
+
+    def test_loop(self):
+        program = [['GetInput', 'variable'], ['Forward', 0]]
+        self.assertEqual(optimize(program)[0], program)
+        self.assertEqual(optimize([['Forward', 1]])[0], [['Forward', 1]])
+
+    def test_merge_messages(self):
+        program = [['SendMessage', 'First'],
+                   ['SendMessage', 'Second'],
+                   ['GetInput', 'variable'],
+                   ['SendMessage', 'Third'],
+                   ['SendMessage', 'Target'],
+                   ['Forward', 4]]
+        self.assertEqual(optimize(program)[0], program)
+        program, _, statistics = optimize(program, merge_messages=True)
+        self.assertEqual(program, [['SendMessage', 'First\nSecond'],
+                                   ['GetInput', 'variable'],
+                                   ['SendMessage', 'Third'],
+                                   ['SendMessage', 'Target'],
+                                   ['Forward', 3]])
+        self.assertEqual(statistics['merged_messages'], 1)
@@ -0,0 +1,57 @@
+import random
+
+from telegram_bot_constructor.constructor import Screen, SendMessage
+from telegram_bot_constructor.helpers import session
+
+from storage_backends import StorageTestCase, REDIS_URL
+
+
+class TestComponentsOrdering(StorageTestCase):
+    def setUp(self):
+        self.screen = Screen.create('Screen')
+        self.components = list(SendMessage.create_many(('Message %d' % i,) for i in range(10)))
+        for component in self.components:
+            self.screen.add_component(component)
+
+    def tearDown(self):
+        self.screen.delete()
+
+    def assertOrder(self):
+        self.assertEqual([c.id for c in self.screen.components], [c.id for c in self.components])
+
+    def test_moves(self):
+        self.assertOrder()
+        moves = random.Random(1)
+        for _ in range(200):
+            component = moves.choice(self.components)
+            index = moves.randrange(len(self.components))
+            self.components.remove(component)
+            self.components.insert(index, component)
+            self.screen.change_component_position(component, index)
+            self.assertOrder()
+
+    def test_rebalancing(self):
+        # Every move halves the gap between the first two components
+        for i in range(100):
+            component = self.components.pop(2 + i % 2)
+            self.components.insert(1, component)
+            self.screen.change_component_position(component, 1)
+        self.assertOrder()
+
+    def test_delete(self):
+        self.screen.delete_component(self.components.pop(3))
+        self.screen.change_component_position(self.components[0], 8)
+        self.components.append(self.components.pop(0))
+        self.assertOrder()
+
+    def test_session(self):
+        with session():
+            screen = Screen(self.screen.id)
+            screen.change_component_position(self.components[0], 9)
+            self.assertEqual(screen.components[0].id, self.components[0].id)
+        self.components.append(self.components.pop(0))
+        self.assertOrder()
+
+
+class TestComponentsOrderingRedis(TestComponentsOrdering):
+    URL = REDIS_URL  # Lua scripts
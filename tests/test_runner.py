@@ -0,0 +1,130 @@
+import time
+from types import SimpleNamespace
+from unittest import TestCase
+
+from telegram_bot_constructor import set_redis_connection, get_redis_connection
+from telegram_bot_constructor.constructor import BotTemplate, SendMessage
+from telegram_bot_constructor.operators_server import Operator
+from telegram_bot_constructor.runner import BotRunnerContext, OperatorAlreadyAdded, is_operator_locked, \
+    is_bot_template_locked, boot_all, running_dispatchers, running_chat_states
+from telegram_bot_constructor.storage import connect
+
+set_redis_connection(connect('memory://'))
+get_redis_connection().flushdb()
+
+
+class TestBotRunnerContext(TestCase):
+    def setUp(self):
+        self.template = BotTemplate.create('Template')
+        self.context = BotRunnerContext.create('Bot')
+        self.context.bot_template = self.template
+
+    def tearDown(self):
+        self.context.stop()
+        self.context.delete()
+        self.template.delete()
+
+    def test_reload(self):
+        first, second = SendMessage.create('First'), SendMessage.create('Second')
+        self.template.start_screen.add_component(first)
+        self.template.start_screen.add_component(second)
+        self.context.run()
+        self.assertFalse(self.context.reload())
+        chat = SimpleNamespace(position=1)
+        self.context.bot.contexts = {1: chat}
+        self.template.start_screen.delete_component(first)
+        self.assertTrue(self.context.reload())
+        self.assertEqual(len(self.context.bot.actions), 2)
+        self.assertEqual(chat.position, 0)
+
+    def test_optimized_run(self):
+        self.template.start_screen.add_component(SendMessage.create('First'))
+        self.template.start_screen.add_component(SendMessage.create('Second'))
+        self.context.run(optimize=True, merge_messages=True)
+        self.assertEqual(len(self.context.bot.actions), 1)
+        self.assertEqual(self.context.optimization_statistics['merged_messages'], 1)
+
+    def test_push_operator_messages(self):
+        operator = Operator.create('Operator')
+        self.context.add_operator(operator)
+        self.context.run()
+        vm_context = SimpleNamespace(position=0)
+        running_chat_states[self.context.id].contexts[42] = vm_context
+        conversation = operator.new_conversation()
+        conversation.incoming_messages = ['Hello']
+        sent = []
+        self.context.push_operator_messages(conversation, lambda chat, text: sent.append((chat, text)))
+        self.assertEqual(sent, [])  # Chat of conversation is unknown
+        conversation.vm_context = vm_context
+        self.context.push_operator_messages(conversation, lambda chat, text: sent.append((chat, text)))
+        self.assertEqual(sent, [(42, 'Hello')])
+        self.assertEqual(conversation.receive_messages(), [])
+
+    def test_locks(self):
+        operator = Operator.create('Operator')
+        self.assertTrue(is_bot_template_locked(self.template))
+        self.assertFalse(is_operator_locked(operator))
+        self.context.add_operator(operator)
+        self.assertTrue(is_operator_locked(operator))
+        self.assertRaises(OperatorAlreadyAdded, self.context.add_operator, operator)
+        self.context.delete_operator(operator)
+        self.assertFalse(is_operator_locked(operator))
+        other = BotTemplate.create('Other')
+        self.context.bot_template = other
+        self.assertFalse(is_bot_template_locked(self.template))
+        self.assertTrue(is_bot_template_locked(other))
+        self.context.add_operator(operator)
+        self.context.delete()
+        self.assertFalse(is_bot_template_locked(other))
+        self.assertFalse(get_redis_connection().exists('operators:%d:contexts' % operator.id))
+        self.context = BotRunnerContext.create('Bot')
+        other.delete()
+
+
+class TestBootAll(TestCase):
+    def setUp(self):
+        get_redis_connection().flushdb()
+        self.templates = [BotTemplate.create('First'), BotTemplate.create('Second')]
+        for template in self.templates:
+            template.start_screen.add_component(SendMessage.create(template.name))
+        self.templates[0].compile_program()  # Second template is not compiled yet
+        self.operator = Operator.create('Operator')
+        self.contexts = [BotRunnerContext.create('Bot %d' % i) for i in range(4)]
+        for i, context in enumerate(self.contexts):
+            context.bot_template = self.templates[i % 2]
+            context.token = '123:token'
+        self.contexts[0].add_operator(self.operator)
+        self.contexts[3].delete_field('token')
+
+    def tearDown(self):
+        for context in self.contexts:
+            context.stop()
+            context.delete()
+        for template in self.templates:
+            template.delete()
+        self.operator.delete()
+
+    def test_boot(self):
+        report = boot_all(concurrency=2)
+        self.assertEqual(sorted(report), [c.id for c in self.contexts[:3]])
+        self.assertTrue(report[self.contexts[0].id]['cached'])
+        self.assertFalse(report[self.contexts[1].id]['cached'])
+        self.assertTrue(all(r['error'] is None and r['start'] >= 0 for r in report.values()))
+        self.assertTrue(all(c.running for c in self.contexts[:3]))
+        self.assertFalse(self.contexts[3].running)
+        self.assertEqual(list(running_dispatchers[self.contexts[0].id].operators.values()), [self.operator])
+        self.assertEqual(running_dispatchers[self.contexts[1].id].operators, {})
+        self.assertEqual(boot_all(), {})  # Contexts are already running
+
+    def test_shared_pubsub(self):
+        boot_all()
+        first, second = (running_dispatchers[c.id] for c in self.contexts[:2])
+        get_redis_connection().publish('authentication', '["%s", "auth"]' % self.operator.token)
+        for _ in range(50):  # Messages are handled by listener of shared subscription
+            if self.operator.token in first.available_operators:
+                break
+            time.sleep(0.02)
+        self.assertIn(self.operator.token, first.available_operators)
+        self.assertNotIn(self.operator.token, second.available_operators)  # Operator is not added to bot
+        self.contexts[0].stop()
+        self.assertEqual(len(second.pubsub.shared.subscribers), 2)
@@ -0,0 +1,61 @@
+from unittest import TestCase
+
+from telegram_bot_constructor import set_redis_connection, get_redis_connection
+from telegram_bot_constructor.constructor import Screen, SendMessage
+from telegram_bot_constructor.helpers import session, ObjectDoesNotExist, ResultNotAvailable
+from telegram_bot_constructor.storage import connect
+
+set_redis_connection(connect('memory://'))
+redis_ = get_redis_connection()
+redis_.flushdb()
+
+
+class TestSession(TestCase):
+    def setUp(self):
+        self.screen = Screen.create('Screen')
+
+    def test_identity_map(self):
+        with session():
+            self.assertIs(Screen(self.screen.id), Screen(self.screen.id))
+        self.assertIsNot(Screen(self.screen.id), Screen(self.screen.id))
+
+    def test_buffered_writes(self):
+        with session():
+            screen = Screen(self.screen.id)
+            screen.name = 'Renamed'
+            self.assertEqual(Screen(self.screen.id).name, 'Renamed')
+            self.assertEqual(redis_.hget(self.screen.key, 'name'), b'Screen')
+            component = SendMessage.create('Text')
+            self.assertEqual(component.text, 'Text')
+            self.assertFalse(redis_.sismember('component_exists', component.id))
+        self.assertEqual(self.screen.name, 'Renamed')
+        self.assertEqual(SendMessage(component.id).text, 'Text')
+
+    def test_buffered_delete(self):
+        with session():
+            Screen(self.screen.id).delete()
+            self.assertRaises(ObjectDoesNotExist, Screen, self.screen.id)
+            self.assertTrue(redis_.sismember('screen_exists', self.screen.id))
+        self.assertFalse(Screen.exists(self.screen.id))
+
+    def test_rollback(self):
+        with self.assertRaises(KeyError):
+            with session():
+                Screen(self.screen.id).name = 'Renamed'
+                raise KeyError
+        self.assertEqual(self.screen.name, 'Screen')
+
+    def test_write_results(self):
+        redis_.sadd('members', 1)
+        with session() as current:
+            storage = current.redis
+            result = storage.srem('members', 1)
+            self.assertRaises(ResultNotAvailable, bool, result)
+            self.assertRaises(ResultNotAvailable, int, storage.hincrby(self.screen.key, 'counter', 1))
+            with self.assertRaises(ResultNotAvailable):
+                if storage.lrem('list', 'value') == 0:
+                    pass
+            self.assertFalse(storage.sismember('members', 1))  # Session-safe reads see buffered changes
+            self.assertEqual(storage.scard('members'), 1)  # Immediate commands read committed state
+        self.assertEqual(redis_.scard('members'), 0)
+        self.assertEqual(storage.srem('members', 2), 0)  # Proxy of closed session returns results
@@ -0,0 +1,125 @@
+import os
+import pickle
+import tempfile
+import time
+from unittest import TestCase
+
+from telegram_bot_constructor import set_redis_connection, get_redis_connection
+from telegram_bot_constructor.constructor import BotTemplate, SendMessage
+from telegram_bot_constructor.storage import MemoryStorage, connect, connection_options, connect_options
+
+
+class TestMemoryStorage(TestCase):
+    def setUp(self):
+        self.redis_connection = get_redis_connection()
+        self.path = os.path.join(tempfile.mkdtemp(), 'storage.aof')
+
+    def tearDown(self):
+        set_redis_connection(self.redis_connection)
+
+    def test_append_only_file(self):
+        storage = MemoryStorage(self.path)
+        set_redis_connection(storage)
+        template = BotTemplate.create('Template')
+        component = SendMessage.create('Text')
+        template.start_screen.add_component(component)
+        deleted = SendMessage.create('Deleted')
+        deleted.delete()
+        storage.incr('counter')
+        storage.incr('counter')
+        storage.set('expiring', 'value', ex=100)
+        storage.close()
+        for _ in range(2):
+            storage = MemoryStorage(self.path)
+            set_redis_connection(storage)
+            self.assertEqual(BotTemplate(template.id).name, 'Template')
+            self.assertEqual(BotTemplate(template.id).start_screen.components[0].text, 'Text')
+            self.assertFalse(SendMessage.exists(deleted.id))
+            self.assertEqual(storage.get('counter'), b'2')
+            self.assertGreater(storage.ttl('expiring'), 90)
+            storage.rewrite_append_only_file()
+            storage.close()
+
+    def test_expiration(self):
+        storage = MemoryStorage()
+        storage.set('key', 'value', px=50)
+        self.assertEqual(storage.get('key'), b'value')
+        time.sleep(0.1)
+        self.assertIsNone(storage.get('key'))
+        self.assertFalse(storage.exists('key'))
+
+    def test_pubsub(self):
+        storage = MemoryStorage()
+        pubsub = storage.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe('channel')
+        pubsub.psubscribe('chan*')
+        self.assertEqual(storage.publish('channel', 'message'), 2)
+        self.assertEqual(pubsub.get_message(timeout=1)['data'], b'message')
+        self.assertEqual(pubsub.get_message(timeout=1)['pattern'], b'chan*')
+        pubsub.close()
+        self.assertEqual(storage.publish('channel', 'message'), 0)
+
+    def test_zscan(self):
+        storage = MemoryStorage()
+        storage.zadd('zset', *(item for i in range(30) for item in (i, i)))
+        cursor, scanned = storage.zscan('zset', 0, count=10)
+        storage.zrem('zset', scanned[0][0])
+        storage.zadd('zset', 'new', 100)
+        while cursor != 0:
+            cursor, items = storage.zscan('zset', cursor, count=10)
+            scanned += items
+        self.assertEqual(len(scanned), len(set(scanned)))
+        self.assertTrue(set((str(i).encode(), float(i)) for i in range(30)) <= set(scanned))
+        self.assertEqual(len(list(storage.zscan_iter('zset', match='1*'))), 11)
+
+    def test_streams(self):
+        storage = MemoryStorage(self.path)
+        for i in range(5):
+            storage.xadd('stream', {'number': i}, maxlen=4)
+        self.assertEqual(storage.xlen('stream'), 4)
+        storage.xgroup_create('stream', 'group', '0')
+        (name, entries), = storage.xreadgroup('group', 'consumer', {'stream': '>'}, count=3)
+        self.assertEqual([fields[b'number'] for _, fields in entries], [b'1', b'2', b'3'])
+        self.assertEqual(storage.xack('stream', 'group', entries[0][0]), 1)
+        pending = storage.xpending_range('stream', 'group', '-', '+', 10)
+        self.assertEqual([p['message_id'] for p in pending], [entries[1][0], entries[2][0]])
+        claimed = storage.xclaim('stream', 'group', 'other', 0, [entries[1][0]])
+        self.assertEqual(claimed, [entries[1]])
+        storage.close()
+        storage = MemoryStorage(self.path)
+        pending = storage.xpending_range('stream', 'group', '-', '+', 10)
+        self.assertEqual([(p['consumer'], p['times_delivered']) for p in pending], [(b'other', 2), (b'consumer', 1)])
+        self.assertEqual(storage.xreadgroup('group', 'consumer', {'stream': '>'}, block=10)[0][1][0][1],
+                         {b'number': b'4'})
+        self.assertEqual(storage.xreadgroup('group', 'consumer', {'stream': '>'}, block=10), [])
+        storage.close()
+
+    def test_streams_log(self):
+        storage = MemoryStorage(self.path)
+        storage.xgroup_create('stream', 'group', '$', mkstream=True)
+        size = os.path.getsize(self.path)
+        for _ in range(3):
+            self.assertEqual(storage.xreadgroup('group', 'consumer', {'stream': '>'}), [])
+        self.assertEqual(storage.xreadgroup('group', 'consumer', {'stream': '0'}), [])
+        self.assertEqual(os.path.getsize(self.path), size)  # Empty polls are not logged
+        storage.xadd('stream', {'number': 1})
+        (_, ((id_, _),)), = storage.xreadgroup('group', 'consumer', {'stream': '>'})
+        time.sleep(0.05)
+        storage.xclaim('stream', 'group', 'other', 0, [id_])
+        idle = storage.xpending_range('stream', 'group', '-', '+', 10)[0]['time_since_delivered']
+        storage.close()
+        time.sleep(0.05)
+        storage = MemoryStorage(self.path)
+        pending, = storage.xpending_range('stream', 'group', '-', '+', 10)
+        self.assertEqual((pending['consumer'], pending['times_delivered']), (b'other', 2))
+        self.assertGreaterEqual(pending['time_since_delivered'], idle + 50)  # Claim time is restored
+        self.assertEqual(storage.xreadgroup('group', 'consumer', {'stream': '>'}), [])
+        storage.close()
+
+    def test_connection_options(self):
+        for url in ('redis://:p@ss@127.0.0.1:6380/9', 'unix:///tmp/redis.sock?db=2'):
+            redis_ = connect(url)
+            connected = connect_options(pickle.loads(pickle.dumps(connection_options(redis_))))  # In other process
+            self.assertEqual(connected.connection_pool.connection_kwargs, redis_.connection_pool.connection_kwargs)
+            self.assertIs(connected.connection_pool.connection_class, redis_.connection_pool.connection_class)
+        self.assertIsNone(connection_options(connect('memory://')))  # Not shared with other processes
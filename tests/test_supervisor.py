@@ -0,0 +1,74 @@
+import time
+
+from telegram_bot_constructor.supervisor import Worker, live_workers, lease_key
+
+from storage_backends import StorageTestCase, REDIS_URL
+
+CONTEXTS = (1, 2, 3, 4, 5)
+
+
+class TestWorkers(StorageTestCase):
+    def setUp(self):
+        self.redis.flushdb()
+        self.bots = {}  # Worker id to set of running contexts map
+
+    @property
+    def running(self):
+        """ Return context id to worker id map, context must run in one worker """
+        running = {}
+        for worker_id, contexts in self.bots.items():
+            for context_id in contexts:
+                self.assertNotIn(context_id, running)
+                running[context_id] = worker_id
+        return running
+
+    def worker(self, worker_id, lease_time=10, start_time=0):
+        def start(context_id):
+            if context_id == 5 and worker_id == 'broken':
+                raise RuntimeError
+            time.sleep(start_time)
+            self.bots.setdefault(worker_id, set()).add(context_id)
+
+        def stop(context_id):
+            self.bots[worker_id].remove(context_id)
+
+        return Worker(self.redis, worker_id, lease_time, start, stop, lambda _: CONTEXTS)
+
+    def test_rebalance(self):
+        first, second = self.worker('first'), self.worker('second')
+        self.assertEqual(sorted(first.heartbeat()[0]), list(CONTEXTS))
+        self.assertEqual(second.heartbeat(), ([], []))
+        self.assertEqual(len(first.heartbeat()[1]), 2)
+        self.assertEqual(len(second.heartbeat()[0]), 2)
+        self.assertEqual(first.heartbeat(), ([], []))
+        self.assertEqual(sorted(self.running), list(CONTEXTS))
+        self.assertEqual(sorted(live_workers(self.redis)), ['first', 'second'])
+        second.shutdown()
+        self.assertEqual(len(first.heartbeat()[0]), 2)
+        self.assertEqual(set(self.running.values()), {'first'})
+
+    def test_lost_leases(self):
+        first, second = self.worker('first', lease_time=0.2), self.worker('second', lease_time=0.2)
+        first.heartbeat()
+        time.sleep(0.3)  # First worker hangs, its leases and heartbeat expire
+        self.assertEqual(sorted(second.heartbeat()[0]), list(CONTEXTS))
+        self.assertEqual(sorted(first.heartbeat()[1]), list(CONTEXTS))
+        self.assertEqual(set(self.running.values()), {'second'})
+
+    def test_failed_start(self):
+        worker = self.worker('broken')
+        self.assertEqual(sorted(worker.heartbeat()[0]), [1, 2, 3, 4])
+        self.assertIsNone(self.redis.get(lease_key(5)))
+        self.assertEqual(worker.heartbeat(), ([], []))
+
+    def test_slow_start(self):
+        slow, other = self.worker('slow', lease_time=1, start_time=0.4), self.worker('other', lease_time=1)
+        self.assertEqual(len(slow.heartbeat()[0]), 1)  # Starts are limited by third of lease time
+        while len(slow.owned) != len(CONTEXTS):  # Takes longer than lease time
+            self.assertEqual(slow.heartbeat()[1], [])
+        self.assertEqual(other.heartbeat(), ([], []))  # Leases of slow worker are renewed
+        self.assertEqual(set(self.running.values()), {'slow'})
+
+
+class TestWorkersRedis(TestWorkers):
+    URL = REDIS_URL  # Lua scripts
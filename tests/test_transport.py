@@ -0,0 +1,145 @@
+import json
+import queue
+import time
+from unittest import TestCase
+
+from telegram_bot_constructor import set_redis_connection, get_redis_connection
+from telegram_bot_constructor.operator_client import OperatorInterfaceDispatcher
+from telegram_bot_constructor.operators_server import Operator, OperatorsDispatcher, OPERATOR_ACCESS_GRANTED, \
+    set_transport, streams_transport, operator_channel, operator_stream, publish
+from telegram_bot_constructor.storage import connect
+from telegram_bot_constructor.transport import PubSubTransport, StreamTransport, streams
+
+set_redis_connection(connect('memory://'))
+redis_ = get_redis_connection()
+
+
+def route(channel):
+    return 'stream' if channel.startswith('events') else None
+
+
+class TestStreamTransport(TestCase):
+    def setUp(self):
+        redis_.flushdb()
+        self.transport = StreamTransport(route, maxlen=1000, count=10, reclaim_idle=0, reclaim_interval=0)
+
+    def receive(self, subscription, count):
+        messages = [subscription.get_message(timeout=0.1) for _ in range(count)]
+        return [m['data'] if m is not None else None for m in messages]
+
+    def test_disconnected_subscriber(self):
+        subscription = self.transport.subscribe(redis_, ('events:1',), 'group')
+        self.transport.publish(redis_, 'events:1', 'first')
+        self.assertEqual(self.receive(subscription, 1), [b'first'])
+        subscription.close()
+        for i in range(25):
+            self.transport.publish(redis_, 'events:1', i)  # Subscriber is disconnected
+        subscription = self.transport.subscribe(redis_, ('events:1',), 'group')
+        self.assertEqual(self.receive(subscription, 26), [str(i).encode() for i in range(25)] + [None])
+        self.assertEqual(streams(redis_).xpending_range('stream', 'group', '-', '+', 10), [])
+        transient = self.transport.subscribe(redis_, ('events:1',))
+        self.assertIsNone(transient.get_message())  # Events before subscribing are skipped
+        transient.close()
+
+    def test_reclaim(self):
+        crashed = self.transport.subscribe(redis_, ('events:1',), 'group')
+        self.transport.publish(redis_, 'events:1', 'lost')
+        self.assertEqual(self.receive(crashed, 1), [b'lost'])  # Not acknowledged
+        subscription = self.transport.subscribe(redis_, ('events:1',), 'group')
+        self.assertEqual(self.receive(subscription, 2), [b'lost', None])
+        self.transport.max_deliveries = 3
+        self.transport.publish(redis_, 'events:1', 'poison')
+        self.assertEqual(self.receive(crashed, 1), [b'poison'])
+        self.assertEqual(self.receive(subscription, 1), [b'poison'])  # Second delivery
+        other = self.transport.subscribe(redis_, ('events:1',), 'group')
+        self.assertEqual(self.receive(other, 1), [b'poison'])
+        self.assertEqual(self.receive(subscription, 1), [None])  # Dropped after 3 deliveries
+        self.assertEqual(streams(redis_).xpending_range('stream', 'group', '-', '+', 10), [])
+
+    def test_maxlen(self):
+        self.transport.maxlen = 10
+        for i in range(300):
+            self.transport.publish(redis_, 'events:1', i)
+        self.assertLess(streams(redis_).xlen('stream'), 200)  # Trimmed approximately by whole stream nodes
+
+    def test_routing(self):
+        subscription = self.transport.subscribe(redis_, ('events:1', 'other'))
+        self.assertEqual(list(subscription.streams), ['stream'])
+        self.transport.publish(redis_, 'events:2', 'not subscribed')
+        self.transport.publish(redis_, 'events:1', 'subscribed')
+        self.assertEqual(subscription.get_message(timeout=0.1)['channel'], b'events:1')
+        subscription.subscribe('events:2')
+        subscription.unsubscribe('events:1')
+        self.transport.publish(redis_, 'events:2', 'second')
+        self.assertEqual(self.receive(subscription, 2), [b'second', None])
+        subscription.unsubscribe('events:2')
+        self.assertEqual(subscription.streams, {})
+        self.assertIsNone(subscription.get_message(timeout=0.01))
+        subscription.close()
+
+
+class TestStreamConversation(TestCase):
+    def setUp(self):
+        redis_.flushdb()
+        set_transport(streams_transport())
+        self.operator = Operator.create('Operator')
+
+    def tearDown(self):
+        set_transport(PubSubTransport())
+        self.operator.delete()
+
+    @staticmethod
+    def wait(condition, *dispatchers):
+        for _ in range(100):
+            for dispatcher in dispatchers:
+                dispatcher.update()
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_conversation(self):
+        self.assertEqual(operator_stream(operator_channel('authentication', 'token')), 'operator_events:token:bots')
+        self.assertIsNone(operator_stream('authentication'))
+        pushed = queue.Queue()
+        dispatcher = OperatorsDispatcher((self.operator,), group='bot_contexts:1')
+        dispatcher.start_listener(lambda c: pushed.put(c.receive_messages()))
+        clients = OperatorInterfaceDispatcher()
+        interface = clients.get_interface(self.operator.token)
+        self.assertTrue(self.wait(lambda: interface.authentication == OPERATOR_ACCESS_GRANTED, clients))
+        conversation = dispatcher.get_conversation()
+        self.assertTrue(self.wait(lambda: interface.conversation_started, clients))
+        conversation.send_message('Question')
+        self.assertTrue(self.wait(lambda: interface.incoming_messages == ['Question'], clients))
+        interface.send_message('Answer')
+        self.assertEqual(pushed.get(timeout=2), ['Answer'])
+        dispatcher.close()
+        dispatcher.listener.join()
+        interface.send_message('While restarting')  # Received by the next dispatcher of bot context
+        restarted = OperatorsDispatcher((self.operator,), group='bot_contexts:1')
+        restored = restarted.restore_conversation(conversation.id, self.operator.id)
+        restarted.update()
+        self.assertEqual(restored.incoming_messages, ['While restarting'])
+        other = OperatorsDispatcher((self.operator,), group='bot_contexts:2')
+        clients.release_interface(interface)
+        interface = clients.get_interface(self.operator.token)
+        self.assertTrue(self.wait(lambda: not restored.restored, restarted))  # Operator is connected again
+        other.update()
+        self.assertIn(self.operator.token, other.available_operators)  # Every bot context receives events
+        restarted.close()
+        other.close()
+        clients.pubsub.close()
+
+    def test_disconnected_client(self):
+        dispatcher = OperatorsDispatcher((self.operator,), group='bot_contexts:1')
+        clients = OperatorInterfaceDispatcher()
+        interface = clients.get_interface(self.operator.token)
+        self.assertTrue(self.wait(lambda: interface.authentication == OPERATOR_ACCESS_GRANTED, dispatcher, clients))
+        clients.pubsub.close()  # Process of operator client exits
+        publish(redis_, operator_channel('message_to_operator', self.operator.token),
+                json.dumps((self.operator.token, 'While disconnected')))
+        clients = OperatorInterfaceDispatcher()
+        interface = clients.get_interface(self.operator.token)
+        self.assertTrue(self.wait(lambda: interface.incoming_messages == ['While disconnected'], clients))
+        dispatcher.close()
+        clients.pubsub.close()
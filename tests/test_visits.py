@@ -0,0 +1,96 @@
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+from unittest import TestCase
+
+from telegram_bot_constructor import set_redis_connection, get_redis_connection
+from telegram_bot_constructor.constructor import BotTemplate, SendMessage
+from telegram_bot_constructor.runner import BotRunnerContext, running_chat_states
+from telegram_bot_constructor.statistics import VisitsCollector, daily_key, DAYS_RETENTION, visits_collector
+from telegram_bot_constructor.storage import connect
+
+set_redis_connection(connect('memory://'))
+redis_ = get_redis_connection()
+redis_.flushdb()
+
+
+class UnavailableStorage:
+    def pipeline(self, transaction=True):
+        return self
+
+    def __getattr__(self, item):
+        return lambda *args: None
+
+    def execute(self):
+        raise ConnectionError
+
+
+class TestVisits(TestCase):
+    def setUp(self):
+        self.context = BotRunnerContext.create('Bot')
+        self.now = datetime(2020, 3, 1, 10, 30).timestamp()
+        self.collector = VisitsCollector(flush_interval=None, clock=lambda: self.now)
+
+    def tearDown(self):
+        self.context.delete()
+
+    def test_visits(self):
+        for user in (1, 2, 1):
+            self.collector.add_visit(self.context.id, user)
+        self.now += 3600
+        self.collector.add_visit(self.context.id, 3)
+        self.assertEqual(self.context.get_visits_per_day(date(2020, 3, 1)), 0)
+        self.assertEqual(self.collector.flush(), 4)
+        self.assertEqual(self.collector.flush(), 0)
+        self.now += 86400
+        self.collector.add_visit(self.context.id, 1)
+        self.collector.flush()
+        self.assertEqual(self.context.get_visits_per_day(date(2020, 3, 1)), 4)
+        self.assertEqual(self.context.get_visits(date(2020, 2, 29), date(2020, 3, 2)),
+                         ((date(2020, 2, 29), 0), (date(2020, 3, 1), 4), (date(2020, 3, 2), 1)))
+        self.assertEqual(self.context.get_visits_per_hour(date(2020, 3, 1))[10:12], (3, 1))
+        self.assertEqual(self.context.get_unique_users(date(2020, 3, 1)), 3)
+        self.assertEqual(self.context.get_unique_users(date(2020, 3, 1), date(2020, 3, 2)), 3)
+        self.assertEqual(self.context.get_unique_users(date(2020, 3, 2)), 1)
+
+    def test_failed_flush(self):
+        self.collector.add_visit(self.context.id)
+        self.collector.redis = UnavailableStorage()
+        self.assertRaises(ConnectionError, self.collector.flush)
+        self.collector.redis = None
+        self.assertEqual(self.collector.flush(), 1)
+
+    def test_retention(self):
+        old_day = date(2020, 3, 1) - timedelta(days=DAYS_RETENTION + 1)
+        redis_.hset(daily_key(self.context.id), old_day.isoformat(), 5)
+        self.collector.add_visit(self.context.id)
+        self.collector.flush()
+        self.assertEqual(self.context.get_visits_per_day(old_day), 0)
+        self.assertEqual(self.context.get_visits_per_day(date(2020, 3, 1)), 1)
+
+    def test_increment_visits(self):
+        self.context.increment_visits(user=1)
+        visits_collector.flush()
+        self.assertEqual(self.context.get_visits_per_day(date.today()), 1)
+
+    def test_running_bot(self):
+        template = BotTemplate.create('Template')
+        template.start_screen.add_component(SendMessage.create('Hello'))
+        self.context.bot_template = template
+        self.context.token = 'token'
+        self.context.run()
+        states = running_chat_states[self.context.id]
+        action, = states.track([SimpleNamespace(exec=lambda vm_context: None)])
+        for chat in (100, 200, 100):
+            vm_context = SimpleNamespace(position=0)
+            states.contexts[chat] = vm_context
+            self.context.increment_visits()  # VM does not pass user
+            action.exec(vm_context)
+        self.context.stop()
+        visits_collector.flush()
+        self.assertEqual(self.context.get_visits_per_day(date.today()), 3)
+        self.assertEqual(self.context.get_unique_users(date.today()), 2)
+        self.context.delete()
+        self.assertEqual(redis_.keys('bot_contexts:%d:visits*' % self.context.id), [])
+        self.assertEqual(redis_.keys('bot_contexts:%d:users:*' % self.context.id), [])
+        self.context = BotRunnerContext.create('Bot')
+        template.delete()
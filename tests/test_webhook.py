@@ -0,0 +1,150 @@
+import json
+import threading
+from http.client import HTTPConnection
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from unittest import TestCase
+from unittest.mock import patch
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from telegram_bot_constructor import set_redis_connection, get_redis_connection
+from telegram_bot_constructor.constructor import BotTemplate, SendMessage
+from telegram_bot_constructor.runner import Bot, BotRunnerContext, running_programs, running_dispatchers, \
+    running_chat_states, running_webhooks
+from telegram_bot_constructor.storage import connect
+from telegram_bot_constructor.webhook import WebhookServer, MAX_UPDATE_SIZE
+
+set_redis_connection(connect('memory://'))
+get_redis_connection().flushdb()
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.calls.append((self.path, json.loads(body.decode())))
+        answer = json.dumps({'ok': True, 'result': True}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
+
+    def log_message(self, format_, *args):
+        pass
+
+
+class TestWebhookServer(TestCase):
+    def setUp(self):
+        self.telegram = HTTPServer(('127.0.0.1', 0), FakeTelegramHandler)
+        self.telegram.calls = []
+        threading.Thread(target=self.telegram.serve_forever, daemon=True).start()
+        self.server = WebhookServer('https://example.com/updates/', port=0, workers=2, queue_limit=2,
+                                    api_url='http://127.0.0.1:%d' % self.telegram.server_address[1])
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.telegram.shutdown()
+        self.telegram.server_close()
+
+    def post(self, path, body):
+        request = Request('http://127.0.0.1:%d/%s' % (self.server.address[1], path), body,
+                          {'Content-Type': 'application/json'})
+        try:
+            with urlopen(request, timeout=5) as response:
+                return response.status
+        except HTTPError as e:
+            return e.code
+
+    def test_routing(self):
+        processed = {1: [], 2: []}
+        done = threading.Event()
+
+        def process(context_id):
+            def process_update(update):
+                processed[context_id].append(update['update_id'])
+                if sum(len(p) for p in processed.values()) == 4:
+                    done.set()
+            return process_update
+
+        self.server.queue_limit = 10
+        self.server.add_bot('first', 1, 'token1', process(1))
+        self.server.add_bot('second', 2, 'token2', process(2))
+        self.assertEqual(self.telegram.calls[0], ('/bottoken1/setWebhook',
+                                                  {'url': 'https://example.com/updates/first', 'max_connections': 10}))
+        for update_id in range(3):
+            self.assertEqual(self.post('first', json.dumps({'update_id': update_id}).encode()), 200)
+        self.assertEqual(self.post('second', b'{"update_id": 10}'), 200)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(processed, {1: [0, 1, 2], 2: [10]})
+        self.assertEqual(self.post('unknown', b'{}'), 404)
+        self.assertEqual(self.post('first', b'not json'), 400)
+        connection = HTTPConnection('127.0.0.1', self.server.address[1], timeout=5)
+        connection.putrequest('POST', '/first')
+        connection.putheader('Content-Length', str(MAX_UPDATE_SIZE + 1))
+        connection.endheaders()
+        self.assertEqual(connection.getresponse().status, 413)  # Body is not read
+        connection.close()
+        self.server.remove_bot('first', 'token1')
+        self.assertEqual(self.telegram.calls[-1], ('/bottoken1/deleteWebhook', {}))
+        self.assertEqual(self.post('first', b'{}'), 404)
+
+    def test_backpressure(self):
+        release = threading.Event()
+        self.server.add_bot('slow', 1, 'token', lambda update: release.wait(5), set_webhook=False)
+        statuses = [self.post('slow', b'{}') for _ in range(4)]
+        self.assertEqual(statuses[-1], 429)
+        self.assertLessEqual(self.server.statistics[1]['pending'], 2)
+        release.set()
+
+    def test_bot_context(self):
+        template = BotTemplate.create('Template')
+        template.start_screen.add_component(SendMessage.create('Hello'))
+        context = BotRunnerContext.create('Bot')
+        context.bot_template = template
+        context.token = 'token'
+        context.run(webhook_server=self.server)
+        secret = context.webhook_secret
+        self.assertEqual(self.telegram.calls[0][1]['url'], 'https://example.com/updates/%s' % secret)
+        self.assertEqual(self.post(secret, b'{"update_id": 1}'), 200)
+        context.stop()
+        self.assertEqual(self.post(secret, b'{}'), 404)
+        self.assertEqual(context.webhook_secret, secret)
+        context.delete()
+        template.delete()
+
+    def test_polling_bot(self):
+        class PollingBot(Bot):
+            process_update = None  # VM without pushed updates
+
+        template = BotTemplate.create('Template')
+        template.start_screen.add_component(SendMessage.create('Hello'))
+        context = BotRunnerContext.create('Bot')
+        context.bot_template = template
+        context.token = 'token'
+        with patch('telegram_bot_constructor.runner.Bot', PollingBot), self.assertLogs('Runner', 'WARNING'):
+            context.run(webhook_server=self.server)
+        self.assertEqual(context.bot.token, 'token')  # Polls
+        self.assertEqual(self.telegram.calls, [])
+        context.stop()
+        context.delete()
+        template.delete()
+
+    def test_failed_start(self):
+        template = BotTemplate.create('Template')
+        template.start_screen.add_component(SendMessage.create('Hello'))
+        context = BotRunnerContext.create('Bot')
+        context.bot_template = template
+        context.token = 'token'
+        api_url = self.server.api_url
+        self.server.api_url = 'http://127.0.0.1:1'  # setWebhook fails
+        self.assertRaises(Exception, context.run, webhook_server=self.server)
+        self.assertFalse(context.running)
+        for running in (running_programs, running_dispatchers, running_chat_states, running_webhooks):
+            self.assertNotIn(context.id, running)
+        self.assertEqual(self.server.bots, {})
+        self.server.api_url = api_url
+        context.run(webhook_server=self.server)  # Started again
+        self.assertTrue(context.running)
+        context.stop()
+        context.delete()
+        template.delete()